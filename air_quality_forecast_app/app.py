@@ -1,10 +1,12 @@
 import streamlit as st
 import os
-import joblib
 import pandas as pd
 import numpy as np
 import plotly.express as px
 
+# Must be the first Streamlit command in the script
+st.set_page_config(layout="wide", page_title="CleanAir: Air Quality Forecast", page_icon="🌬️")
+
 # Inject custom CSS for styling
 st.markdown('''
 <style>
@@ -198,72 +200,119 @@ h4 { font-size: 1.4em; }
 ''', unsafe_allow_html=True)
 
 # Import utility functions and UI components
-from utils.data_fetching import get_realtime_data
-from utils.preprocess import preprocess_data
-from components.health_alerts import display_health_alert
+from utils.spatial_index import StationIndex
+from utils.gazetteer import Gazetteer, DEFAULT_CITIES
+from utils.model_metadata import load_metadata
+from utils.model_bundle import load_shared_models
+from utils.alerting import AlertEngine, RULES_FILE
+from utils.forecast_store import ForecastStore, NO_PM25_ERROR
+from utils.aqi import aqi_category_codes, aqi_category_names
+from utils.history_store import HistoryStore
+from utils.export import store_stations
+from components.health_alerts import display_health_alert, display_alert_subscription
 from components.map_view import display_map, get_aqi_category
 from components.time_series_plot import display_aqi_trends
 from components.feature_importance import display_feature_importance
 from components.temporal_heatmap import display_temporal_heatmap
 from components.anomaly_detection import display_anomaly_detection
 from components.carbon_footprint_estimator import display_carbon_footprint_estimator
+from components.data_export import display_data_export
+from components.city_dashboard import display_city_dashboard
+
+# --- City Gazetteer (for search and map centering) ---
+@st.cache_resource
+def load_gazetteer():
+    """Loads the bundled world-city gazetteer once per server process."""
+    return Gazetteer.load()
+
+gazetteer = load_gazetteer()
+default_cities = [city for city in map(gazetteer.lookup, DEFAULT_CITIES) if city is not None] # A rebuilt gazetteer may lack one
+
+def select_city(container, label, key):
+    """Renders a type-ahead city search box plus a selectbox of matches and returns the chosen City."""
+    query = container.text_input(f"Search {label}", key=f"{key}_search", placeholder="Type a city name...")
+    options = gazetteer.search(query, limit=20) if query else default_cities
+    if not options:
+        container.warning(f"No cities match '{query}'.")
+        options = default_cities
+    return container.selectbox(label, options, format_func=lambda city: city.label, key=key)
+
+# --- Forecast Store and Model Metadata ---
+# Real stations shown around a city on its map and used for the interpolated surface
+NEARBY_STATIONS = 12
+NEARBY_RADIUS_KM = 300
+# Cells per side of the interpolated PM2.5 surface under the city map
+SURFACE_RESOLUTION = 60
 
-# --- City Coordinates (for map centering) ---
-city_coordinates = {
-    "Delhi": {"lat": 28.7041, "lon": 77.1025},
-    "London": {"lat": 51.5074, "lon": 0.1278},
-    "Beijing": {"lat": 39.9042, "lon": 116.4074},
-    "New York": {"lat": 40.7128, "lon": -74.0060},
-    "Tokyo": {"lat": 35.6895, "lon": 139.6917},
-}
 
-# --- Model Loading ---
 @st.cache_resource
-def load_models(forecast_horizons=[1, 3, 6, 12]):
-    """Loads the trained ML models and scalers for multiple forecast horizons."""
-    models = {}
-    scalers = {}
-    for horizon in forecast_horizons:
-        try:
-            BASE_DIR = os.path.dirname(__file__)
-            MODEL_DIR = os.path.join(BASE_DIR, "model")
-            model_path = os.path.join(MODEL_DIR, f"air_quality_model_{horizon}h.joblib")
-            scaler_path = os.path.join(MODEL_DIR, f"data_scaler_{horizon}h.joblib")
-            models[horizon] = joblib.load(model_path)
-            scalers[horizon] = joblib.load(scaler_path)
-        except FileNotFoundError:
-            st.error(f"Model or scaler files not found for {horizon}-hour forecast. Please ensure all models are trained and saved.")
-            st.stop()
-    return models, scalers
+def load_forecast_store():
+    """
+    The store materialize_forecasts.py fills after each ingest cycle. Pages only read it,
+    so no model runs while serving a city.
+    """
+    return ForecastStore()
 
-forecast_horizons = [1, 3, 6, 12]
-models, scalers = load_models(forecast_horizons)
+@st.cache_resource
+def load_model_metadata(forecast_horizons=[1, 3, 6, 12]):
+    """Loads the metadata (version, permutation importance) stored next to each model."""
+    return {horizon: load_metadata(horizon) for horizon in forecast_horizons}
 
-# --- Prediction Function ---
-def run_multi_hour_prediction(raw_data_df, models, scalers, forecast_horizons):
+@st.cache_resource(max_entries=1)
+def load_alert_engine(rules_mtime=None):
     """
-    Runs the prediction pipeline for multiple forecast horizons.
-    Returns a dictionary of forecasted PM2.5 values.
+    One alert engine per server process, with the saved subscriptions. It only registers new
+    subscriptions; materialize_forecasts.py evaluates them and sends the notifications. Keyed
+    by the rules file's mtime, so subscriptions saved by other server processes show up too.
     """
-    if raw_data_df.empty:
-        return {horizon: None for horizon in forecast_horizons}
+    engine = AlertEngine(sink=None)
+    if os.path.exists(RULES_FILE):
+        engine.load(RULES_FILE)
+    return engine
 
-    processed_df = preprocess_data(raw_data_df)
-    
-    if processed_df.empty:
-        st.warning("Processed data is empty. Cannot make predictions.")
-        return {horizon: None for horizon in forecast_horizons}
-
-    forecasted_values = {}
-    for horizon in forecast_horizons:
-        model = models[horizon]
-        scaler = scalers[horizon]
-
-        scaled_data = scaler.transform(processed_df)
-        forecast = model.predict(scaled_data)
-        forecasted_values[horizon] = forecast[0] # Assuming single prediction for each horizon
-    
-    return forecasted_values
+@st.cache_resource(ttl=600, max_entries=1)
+def load_export_models(forecast_horizons=(1, 3, 6, 12)):
+    """
+    FlatForests and scalers mapped from the host's shared model bundle, so exports add no
+    per-worker model memory. Re-attached every 10 minutes to pick up retrained models.
+    """
+    return load_shared_models(forecast_horizons)
+
+@st.cache_data(ttl=600)
+def load_store_stations():
+    """Cities in the local history store, refreshed every 10 minutes as backfills add more."""
+    return store_stations(HistoryStore())
+
+@st.cache_data(ttl=60)
+def load_station_map():
+    """Every materialized city's 1-hour forecast, the station set behind the maps; shared by all sessions for a minute."""
+    stations = forecast_store.stations(horizon=1)
+    stations['AQI_Category'] = aqi_category_names(aqi_category_codes(stations['PM2.5']))
+    return stations
+
+@st.cache_resource(max_entries=4)
+def build_station_index(stations):
+    """KD-tree over the station set, built once per distinct set."""
+    return StationIndex.from_dataframe(stations)
+
+@st.cache_data(ttl=60, max_entries=64)
+def build_station_surface(stations, resolution=SURFACE_RESOLUTION):
+    """IDW PM2.5 surface between the stations, cached per station set and grid for as long as the station map."""
+    return StationIndex.from_dataframe(stations).idw_surface_df(resolution=resolution)
+
+def nearby_stations(city, stations, k=NEARBY_STATIONS, radius_km=NEARBY_RADIUS_KM):
+    """The k stations nearest to a City within radius_km, excluding the city itself, nearest first."""
+    if stations.empty:
+        return stations
+    distances, idx = build_station_index(stations).nearest(city.lat, city.lon, k=k + 1)
+    distances, idx = np.atleast_1d(distances), np.atleast_1d(idx)
+    nearby = stations.iloc[idx[distances <= radius_km]]
+    return nearby[nearby['key'] != city.waqi_key].head(k)
+
+forecast_horizons = [1, 3, 6, 12]
+forecast_store = load_forecast_store()
+model_metadata = load_model_metadata(forecast_horizons)
+alert_engine = load_alert_engine(os.path.getmtime(RULES_FILE) if os.path.exists(RULES_FILE) else None)
 
 # --- AQI Calculation (Placeholder) ---
 def calculate_aqi(pm25_value):
@@ -280,21 +329,18 @@ def calculate_aqi(pm25_value):
     elif pm25_value <= 250.4: return "Very Unhealthy"
     else: return "Hazardous"
 
-def create_raw_data_chart(raw_data):
+def create_raw_data_chart(observation):
     """Creates an interactive Plotly bar chart for the raw data."""
-    if raw_data.empty:
+    if observation is None:
         return None
 
-    # Melt the dataframe to have a long format for Plotly
-    raw_data_melted = raw_data.melt(id_vars=['timestamp'], var_name='Pollutant', value_name='Value')
-
+    measurements = observation.measurements()
     fig = px.bar(
-        raw_data_melted,
-        x='Pollutant',
-        y='Value',
-        color='Pollutant',
+        x=list(measurements),
+        y=list(measurements.values()),
+        color=list(measurements),
         title='Latest Raw Air Quality and Weather Data',
-        labels={'Value': 'Measurement Value', 'Pollutant': 'Pollutant/Metric'},
+        labels={'y': 'Measurement Value', 'x': 'Pollutant/Metric', 'color': 'Pollutant/Metric'},
         template='plotly_white'
     )
     fig.update_layout(
@@ -306,9 +352,15 @@ def create_raw_data_chart(raw_data):
     )
     return fig
 
+def format_time(value):
+    return pd.Timestamp(value).strftime("%Y-%m-%d %H:%M UTC")
+
 def display_city_data(selected_city, chart_key_prefix, current_mode):
-    """Fetches and displays the data for a single city."""
-    
+    """Displays the materialized reading and forecasts for a single city (a gazetteer City record)."""
+    city_name = selected_city.name
+    materialized = forecast_store.read(selected_city) # Two primary-key lookups; no fetch, no model
+    forecast_store.track([selected_city]) # Tracks a new city; otherwise records the view, so it doesn't expire
+
     with st.container(): # Wrap the entire city display in a container for responsiveness
         # Adjust section titles based on mode for conciseness in comparison view
         if current_mode == "City Comparison":
@@ -322,41 +374,37 @@ def display_city_data(selected_city, chart_key_prefix, current_mode):
             health_alerts_title = "🚨 Health Advisory"
             visualizations_title = "📊 Insightful Visualizations"
 
-        st.subheader(f"Air Quality for {selected_city}") # Use st.subheader for city title
+        st.subheader(f"Air Quality for {selected_city.label}") # Use st.subheader for city title
+        if materialized is None:
+            # The scheduler picks up newly tracked cities on its next poll
+            st.info(f"{selected_city.label} has been added to the cities the forecast scheduler tracks. "
+                    "Its reading and forecasts appear within a minute or so; reload the page then.")
+            return
+        observation = materialized.observation
 
         # Section 1: Real-time Data Fetching
         st.container(border=True).markdown(f"### {data_acquisition_title}")
         with st.container(border=True):
-            st.markdown(f"#### Fetching latest air quality and weather data for {selected_city}...")
-            with st.spinner("Connecting to data sources..."):
-                raw_data, error_message = get_realtime_data(city=selected_city.lower()) # WAQI uses lowercase city names
-
-            if raw_data is not None and not raw_data.empty:
-                st.success("Data fetched successfully!")
-                with st.expander("View Raw Data and Visualization"):
-                    st.write("Latest Raw Data:")
-                    st.dataframe(raw_data, use_container_width=True) # Ensure responsiveness
-                    st.write("Raw Data Visualization:")
-                    st.plotly_chart(create_raw_data_chart(raw_data), use_container_width=True, key=f"{chart_key_prefix}raw_data_chart_{selected_city}")
+            if observation is None:
+                st.error(f"No reading could be fetched for {city_name} yet: {materialized.error}")
+                return
+            if materialized.error == NO_PM25_ERROR:
+                st.warning(f"{NO_PM25_ERROR} in its {format_time(observation.timestamp)} reading, so no forecast can be made.")
+            elif materialized.error:
+                st.warning(f"The latest fetch failed ({materialized.error}). Showing the reading from {format_time(observation.timestamp)}.")
             else:
-                st.error("Failed to fetch real-time data. Please check your API keys and internet connection.")
-                st.info("Using dummy data for demonstration purposes if real data cannot be fetched.")
-                # Fallback to dummy data for demonstration if API fails
-                raw_data = pd.DataFrame({
-                    'pm25': [150],
-                    'temperature': [25],
-                    'humidity': [60],
-                    'wind_speed': [5],
-                    'pressure': [1010],
-                    'timestamp': [pd.to_datetime('now')]
-                })
-                st.write("Using Dummy Data for Forecast:")
-                st.dataframe(raw_data, use_container_width=True) # Ensure responsiveness
+                st.success(f"Latest reading: {format_time(observation.timestamp)}")
+            with st.expander("View Raw Data and Visualization"):
+                st.write("Latest Raw Data:")
+                st.dataframe(observation.to_frame(), use_container_width=True) # Ensure responsiveness
+                st.write("Raw Data Visualization:")
+                st.plotly_chart(create_raw_data_chart(observation), use_container_width=True, key=f"{chart_key_prefix}raw_data_chart_{city_name}")
 
         # Section 2: Air Quality Forecasting
         st.container(border=True).markdown(f"### {forecasting_title}")
         with st.container(border=True):
-            forecasted_pm25_values = run_multi_hour_prediction(raw_data, models, scalers, forecast_horizons)
+            forecasted_pm25_values = {h: materialized.forecasts.get(h) for h in forecast_horizons}
+            forecast_intervals = materialized.intervals
 
             if all(value is not None for value in forecasted_pm25_values.values()):
                 st.markdown("#### Forecasted PM2.5 Values:")
@@ -365,49 +413,50 @@ def display_city_data(selected_city, chart_key_prefix, current_mode):
                     with cols[i]:
                         st.metric(label=f"PM2.5 (+{horizon}h)", value=f"{forecasted_pm25_values[horizon]:.2f} µg/m³")
                         st.write(f"AQI: {calculate_aqi(forecasted_pm25_values[horizon])}")
+                        if horizon in forecast_intervals:
+                            band = forecast_intervals[horizon]
+                            st.caption(f"80% range: {band[0.1]:.1f}–{band[0.9]:.1f} µg/m³")
+                versions = ", ".join(sorted({v for v in materialized.model_versions.values() if v}))
+                st.caption(f"Computed {format_time(pd.Timestamp(materialized.computed_at, unit='s'))} from the "
+                           f"{format_time(materialized.input_timestamp)} reading · models {versions or 'unknown'}")
+            elif materialized.error == NO_PM25_ERROR:
+                st.error(f"No forecasts for {city_name} until its station reports PM2.5 again.")
+                return
             else:
-                st.error("Could not generate all forecasts. Please check data fetching and preprocessing.")
+                st.error("No forecasts are stored for all horizons yet. Please check that materialize_forecasts.py is running.")
+                return
 
         # Section 3: Health Alerts
         st.container(border=True).markdown(f"### {health_alerts_title}")
         with st.container(border=True):
             display_health_alert(forecasted_pm25_values[1])
+            display_alert_subscription(alert_engine, selected_city.waqi_key, selected_city.label, forecast_horizons, RULES_FILE, key_prefix=chart_key_prefix)
 
         # Section 4: Visualizations
         st.container(border=True).markdown(f"### {visualizations_title}")
         with st.container(border=True):
-            # Prepare data for map: current city + dummy nearby locations
+            # Map data: the current city plus, in Single City Analysis, the real stations around it
             map_locations = [{
-                'City': selected_city,
-                'Latitude': city_coordinates[selected_city]["lat"],
-                'Longitude': city_coordinates[selected_city]["lon"],
+                'City': selected_city.label,
+                'Latitude': selected_city.lat,
+                'Longitude': selected_city.lon,
                 'PM2.5': forecasted_pm25_values[1], # Use 1-hour forecast for map
                 'AQI_Category': get_aqi_category(forecasted_pm25_values[1])
             }]
-
-            # Add dummy nearby locations for demonstration in Single City Analysis mode
-            if current_mode == "Single City Analysis":
-                map_locations.append({
-                    'City': 'Nearby A',
-                    'Latitude': city_coordinates[selected_city]["lat"] + 0.1,
-                    'Longitude': city_coordinates[selected_city]["lon"] + 0.1,
-                    'PM2.5': forecasted_pm25_values[1] * 1.2, # Slightly higher pollution
-                    'AQI_Category': get_aqi_category(forecasted_pm25_values[1] * 1.2)
-                })
-                map_locations.append({
-                    'City': 'Nearby B',
-                    'Latitude': city_coordinates[selected_city]["lat"] - 0.05,
-                    'Longitude': city_coordinates[selected_city]["lon"] + 0.08,
-                    'PM2.5': forecasted_pm25_values[1] * 0.8, # Slightly lower pollution
-                    'AQI_Category': get_aqi_category(forecasted_pm25_values[1] * 0.8)
-                })
-            
             map_data_df = pd.DataFrame(map_locations)
-            display_map(map_data_df, chart_key_prefix) # Pass DataFrame to map
-            display_aqi_trends(raw_data, forecasted_pm25_values, selected_city, chart_key_prefix) # Pass all forecasts to trend plot
-            display_feature_importance(models[1], scalers[1], raw_data, selected_city, chart_key_prefix) # Pass 1-hour model, scaler, and raw data
-            display_temporal_heatmap(raw_data, selected_city, chart_key_prefix) # Pass raw_data for now, will use dummy historical data within the component
-            display_anomaly_detection(forecasted_pm25_values[1], raw_data, selected_city, chart_key_prefix) # Pass 1-hour forecast and raw_data for historical context
+            if current_mode == "Single City Analysis":
+                nearby = nearby_stations(selected_city, load_station_map())
+                map_data_df = pd.concat([map_data_df, nearby[map_data_df.columns]], ignore_index=True)
+
+            surface_df = None
+            if len(map_data_df) > 1 and map_data_df['PM2.5'].notna().all():
+                # Interpolate PM2.5 between the stations for the map's density layer
+                surface_df = build_station_surface(map_data_df)
+            display_map(map_data_df, chart_key_prefix, surface_df) # Pass DataFrame to map
+            display_aqi_trends(observation, forecasted_pm25_values, city_name, chart_key_prefix, forecast_intervals) # Pass all forecasts and their bands to trend plot
+            display_feature_importance(observation, city_name, chart_key_prefix, model_metadata[1], materialized.attributions.get(1)) # Pass observation, 1-hour model metadata and materialized attributions
+            display_temporal_heatmap(observation, city_name, chart_key_prefix) # Pass the observation for now, will use dummy historical data within the component
+            display_anomaly_detection(forecasted_pm25_values[1], observation, city_name, chart_key_prefix) # Pass 1-hour forecast and observation for historical context
 
         # Section 5: Carbon Footprint Estimator (only in Single City Analysis mode)
         if current_mode == "Single City Analysis":
@@ -416,8 +465,6 @@ def display_city_data(selected_city, chart_key_prefix, current_mode):
                 display_carbon_footprint_estimator(chart_key_prefix)
 
 # --- Streamlit UI ---
-st.set_page_config(layout="wide", page_title="CleanAir: Air Quality Forecast", page_icon="🌬️")
-
 # Custom header with improved styling
 st.markdown('<h1 class="main-title">🌬️ CleanAir: AI-Powered Air Quality Forecasting</h1>', unsafe_allow_html=True)
 st.markdown('<p class="app-description">A comprehensive web application providing real-time air quality forecasts, health alerts, and insightful visualizations to empower informed decisions for your well-being.</p>', unsafe_allow_html=True)
@@ -426,22 +473,51 @@ st.markdown("---") # Visual separator
 
 # Sidebar for mode and city selection
 st.sidebar.header("Navigation")
-mode = st.sidebar.radio("Choose Application Mode:", ("Single City Analysis", "City Comparison"), key="mode_selection")
+mode = st.sidebar.radio("Choose Application Mode:", ("Single City Analysis", "City Comparison", "City Dashboard", "Data Export"), key="mode_selection")
 
 if mode == "Single City Analysis":
     st.sidebar.subheader("Select Your City")
-    selected_city = st.sidebar.selectbox(
-        "City:",
-        list(city_coordinates.keys()),
-        key="single_city_select"
-    )
+    selected_city = select_city(st.sidebar, "City:", "single_city_select")
     
-    st.header(f"Real-time Air Quality for {selected_city}")
+    st.header(f"Real-time Air Quality for {selected_city.name}")
     st.markdown("Stay informed about the air you breathe.")
     
     # Main content for single city
     display_city_data(selected_city, "single_city_", mode)
 
+elif mode == "City Dashboard":
+    st.header("Air Quality Dashboard")
+    st.markdown("Current readings and forecasts for many cities at a glance. Open a tile for the full analysis.")
+    st.sidebar.subheader("Dashboard Cities")
+    city_count = st.sidebar.slider("Largest cities", min_value=4, max_value=200, value=60, step=4, key="dashboard_city_count")
+    extra_names = st.sidebar.text_area("Also include (one city per line)", key="dashboard_extra_cities")
+    dashboard_cities = gazetteer.largest(city_count)
+    for name in extra_names.splitlines():
+        city = gazetteer.lookup(name.strip()) if name.strip() else None
+        if city is not None and city not in dashboard_cities:
+            dashboard_cities.append(city)
+
+    materialized = forecast_store.read_many(dashboard_cities, forecast_horizons)
+    # Cities not materialized yet are picked up on the scheduler's next poll; the rest record the view
+    forecast_store.track(dashboard_cities)
+    display_city_dashboard(
+        dashboard_cities, materialized, forecast_horizons,
+        render_detail=lambda city: display_city_data(city, "dashboard_detail_", mode),
+        key_prefix="dashboard_",
+    )
+    with st.expander("Map of every tracked city"):
+        # Every materialized station, clustered per zoom level once there are more than the map can show individually
+        display_map(load_station_map(), "dashboard_all_")
+
+elif mode == "Data Export":
+    st.header("Export Air Quality Data")
+    st.markdown("Download historical readings with their AQI categories and forecasts for analysis elsewhere.")
+    export_models, export_scalers = load_export_models(tuple(forecast_horizons))
+    # The scheduler stores readings under WAQI keys; show those as city labels
+    station_labels = {city.waqi_key: city.label for city in forecast_store.tracked()}
+    display_data_export(HistoryStore(), load_store_stations(), export_models, export_scalers, forecast_horizons, "export_",
+                        station_labels)
+
 else: # City Comparison Mode
     st.header("Compare Air Quality Between Cities")
     st.markdown("Analyze and compare air quality trends and forecasts for two different locations.")
@@ -449,11 +525,11 @@ else: # City Comparison Mode
     col1, col2 = st.columns(2)
     with col1:
         st.subheader("City 1")
-        city1 = st.selectbox("Select City 1", list(city_coordinates.keys()), key='city1_select')
+        city1 = select_city(st, "Select City 1", 'city1_select')
         display_city_data(city1, "city1_", mode)
     with col2:
         st.subheader("City 2")
-        city2 = st.selectbox("Select City 2", list(city_coordinates.keys()), key='city2_select')
+        city2 = select_city(st, "Select City 2", 'city2_select')
         display_city_data(city2, "city2_", mode)
 
 st.sidebar.markdown("---")
@@ -0,0 +1,258 @@
+"""
+Bulk-loads historical PM2.5 and weather exports (CSV, optionally gzip/bz2/xz compressed, or Parquet) into
+the local partitioned history store, streaming each file in bounded-memory chunks.
+
+Source columns are mapped onto the model's feature schema (see COLUMN_ALIASES, or pass
+--map target=source), rows are appended by parallel writers and each touched partition is
+then compacted, de-duplicating on (station, timestamp) with the last-imported row winning.
+
+    python backfill.py exports/*.csv.gz --workers 4
+    python backfill.py delhi_2019.csv --station Delhi --map pm25="PM2.5 (ug/m3)"
+"""
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+
+from utils.history_store import HistoryStore, HISTORY_DIR, STORE_SCHEMA, next_sequence
+from utils.preprocess import FEATURE_COLUMNS
+
+# Accepted source column names for each store column, compared after normalize_column_name
+COLUMN_ALIASES = {
+    'station': ['station', 'station_name', 'station_id', 'city', 'site', 'site_name', 'location'],
+    'timestamp': ['timestamp', 'datetime', 'date_time', 'datetime_utc', 'time', 'date', 'utc', 'measured_at'],
+    'pm25': ['pm25', 'pm2_5', 'pm25_ugm3', 'pm2_5_ugm3', 'pm25_ug_m3', 'pm2_5_ug_m3'],
+    'temperature': ['temperature', 'temp', 't', 'temperature_c', 'air_temperature'],
+    'humidity': ['humidity', 'rh', 'h', 'relative_humidity', 'humidity_pct'],
+    'wind_speed': ['wind_speed', 'windspeed', 'ws', 'w', 'wind', 'wind_speed_ms'],
+    'pressure': ['pressure', 'p', 'pres', 'slp', 'pressure_hpa', 'sea_level_pressure'],
+}
+NULL_VALUES = ["", "NA", "N/A", "NaN", "nan", "null", "NULL", "None", "-", "--"]
+DEFAULT_CHUNK_MB = 64
+PARQUET_BATCH_ROWS = 1_000_000
+NUMBER_PATTERN = r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?\s*$"
+TIMESTAMP_FORMATS = ["%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M", "%Y-%m-%d",
+                     "%Y-%m-%dT%H:%M:%S%z", "%Y-%m-%d %H:%M:%S%z"]
+COMPRESSED_OPENERS = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+
+def normalize_column_name(name):
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+def map_columns(source_columns, overrides=None):
+    """
+    Returns {store column: source column} for the source columns that match an alias.
+    overrides ({store column: source column}) take precedence.
+    """
+    by_normalized = {}
+    for column in source_columns:
+        by_normalized.setdefault(normalize_column_name(column), column)
+    mapping = {}
+    for target, aliases in COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in by_normalized:
+                mapping[target] = by_normalized[alias]
+                break
+    for target, source in (overrides or {}).items():
+        if target not in COLUMN_ALIASES:
+            raise ValueError(f"Unknown store column '{target}'; expected one of {', '.join(COLUMN_ALIASES)}")
+        if source not in source_columns:
+            raise ValueError(f"Column '{source}' not found; available: {', '.join(source_columns)}")
+        mapping[target] = source
+    return mapping
+
+def is_parquet(path):
+    return path.lower().endswith(".parquet")
+
+def open_source(path):
+    """Opens a CSV export as a binary file, decompressing by extension."""
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1].lower(), open)
+    return opener(path, "rb")
+
+def source_columns(path):
+    if is_parquet(path):
+        return pq.ParquetFile(path).schema_arrow.names
+    with open_source(path) as f:
+        return pa_csv.read_csv(pa.BufferReader(f.readline())).column_names
+
+def csv_blocks(f, block_bytes):
+    """Yields the file's remaining bytes in blocks of about block_bytes, each ending on a line boundary."""
+    carry = b""
+    while True:
+        data = f.read(block_bytes)
+        if not data:
+            break
+        data = carry + data
+        cut = data.rfind(b"\n") + 1
+        carry = data[cut:]
+        if cut:
+            yield data[:cut]
+    if carry.strip():
+        yield carry
+
+def read_batches(path, mapping, chunk_mb=DEFAULT_CHUNK_MB):
+    """Yields Arrow tables of the mapped source columns, one bounded chunk at a time."""
+    columns = list(dict.fromkeys(mapping.values()))
+    if is_parquet(path):
+        yield from pq.ParquetFile(path).iter_batches(batch_size=PARQUET_BATCH_ROWS, columns=columns)
+        return
+    # Blocks are cut and parsed here rather than with open_csv, whose read-ahead
+    # buffers far past the current block and lets memory grow with the file size
+    names = source_columns(path)
+    numeric = {mapping[f] for f in FEATURE_COLUMNS if f in mapping} - {mapping.get('station'), mapping.get('timestamp')}
+    text_types = {column: pa.string() for column in columns}
+    options = [
+        # Fast path parses measurements straight to float; a block with a malformed cell is
+        # re-read as text so to_float can null out just the bad cells
+        pa_csv.ConvertOptions(include_columns=columns, column_types={**text_types, **{c: pa.float64() for c in numeric}},
+                              null_values=NULL_VALUES, strings_can_be_null=True),
+        pa_csv.ConvertOptions(include_columns=columns, column_types=text_types, null_values=NULL_VALUES, strings_can_be_null=True),
+    ]
+    read_options = pa_csv.ReadOptions(column_names=names)
+    with open_source(path) as f:
+        f.readline() # Header
+        for block in csv_blocks(f, chunk_mb << 20):
+            try:
+                yield pa_csv.read_csv(pa.BufferReader(block), read_options=read_options, convert_options=options[0])
+            except pa.ArrowInvalid:
+                yield pa_csv.read_csv(pa.BufferReader(block), read_options=read_options, convert_options=options[1])
+
+def to_float(array):
+    """Casts a column to float64; values that don't parse become null."""
+    try:
+        return pc.cast(array, pa.float64())
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        # Null out just the malformed cells instead of abandoning the vectorized cast
+        text = pc.cast(array, pa.string())
+        numeric = pc.fill_null(pc.match_substring_regex(text, NUMBER_PATTERN), False)
+        return pc.cast(pc.if_else(numeric, pc.utf8_trim_whitespace(text), None), pa.float64())
+
+def to_timestamps(array):
+    """Parses a timestamp column (datetime, epoch seconds/milliseconds or text) into UTC timestamp[s]; unparseable values become null."""
+    if pa.types.is_timestamp(array.type) or pa.types.is_date(array.type):
+        return pc.cast(array, pa.timestamp("s"), safe=False)
+    if pa.types.is_integer(array.type) or pa.types.is_floating(array.type):
+        seconds = pc.cast(array, pa.float64())
+        # Epoch milliseconds are larger than any plausible epoch-seconds value
+        if pc.max(seconds).as_py() is not None and pc.max(seconds).as_py() > 1e11:
+            seconds = pc.divide(seconds, 1000.0)
+        return pc.cast(pc.cast(seconds, pa.int64(), safe=False), pa.timestamp("s"))
+    try:
+        return pc.cast(array, pa.timestamp("s"))
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+        pass
+    # Mixed formats or malformed cells: try the common layouts vectorized, then hand pandas only what's left
+    parsed = pa.nulls(len(array), pa.timestamp("s"))
+    for fmt in TIMESTAMP_FORMATS:
+        parsed = pc.coalesce(parsed, pc.strptime(array, format=fmt, unit="s", error_is_null=True))
+        leftover = pc.fill_null(pc.and_(pc.is_null(parsed), pc.is_valid(array)), False)
+        if not pc.any(leftover).as_py():
+            return parsed
+    indices = pc.indices_nonzero(leftover).to_numpy()
+    values = parsed.to_numpy(zero_copy_only=False).astype("datetime64[s]")
+    rest = pd.to_datetime(pd.Series(pc.take(array, indices).to_pandas()), errors="coerce", utc=True, format="mixed")
+    values[indices] = rest.dt.tz_convert(None).to_numpy().astype("datetime64[s]")
+    return pa.array(values, type=pa.timestamp("s"), from_pandas=True)
+
+def to_store_table(batch, mapping, station=None):
+    """
+    Converts a source batch to STORE_SCHEMA. Returns (table, rejected) where rejected counts
+    rows dropped for lacking a parseable timestamp or a station.
+    """
+    n = batch.num_rows
+    if 'station' in mapping:
+        stations = pc.utf8_trim_whitespace(pc.cast(batch.column(mapping['station']), pa.string()))
+        if station:
+            stations = pc.fill_null(stations, station)
+    else:
+        stations = pa.array([station] * n, type=pa.string()) if station else pa.nulls(n, pa.string())
+    columns = {'station': stations, 'timestamp': to_timestamps(batch.column(mapping['timestamp']))}
+    for feature in FEATURE_COLUMNS:
+        columns[feature] = to_float(batch.column(mapping[feature])) if feature in mapping else pa.nulls(n, pa.float64())
+
+    table = pa.table(columns)
+    valid = pc.and_(pc.is_valid(table['timestamp']), pc.and_(pc.is_valid(table['station']), pc.not_equal(table['station'], "")))
+    valid = pc.fill_null(valid, False)
+    table = table.filter(valid)
+    return table.cast(STORE_SCHEMA), n - table.num_rows
+
+def backfill(paths, store, overrides=None, station=None, workers=4, chunk_mb=DEFAULT_CHUNK_MB, log=print):
+    """
+    Streams every file into the store and compacts the partitions it touched.
+    At most 2 * workers converted chunks wait for a writer at any time, which bounds memory.
+    """
+    stats = {'files': len(paths), 'rows_read': 0, 'rows_rejected': 0, 'rows_written': 0, 'duplicates_dropped': 0}
+    start = time.perf_counter()
+    touched = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for path in paths:
+            mapping = map_columns(source_columns(path), overrides)
+            if 'timestamp' not in mapping:
+                raise ValueError(f"{path}: no timestamp column found; pass --map timestamp=<column>")
+            if 'station' not in mapping and not station:
+                raise ValueError(f"{path}: no station column found; pass --station or --map station=<column>")
+            log(f"{path}: " + ", ".join(f"{target} <- {source}" for target, source in mapping.items()))
+
+            for batch in read_batches(path, mapping, chunk_mb):
+                table, rejected = to_store_table(batch, mapping, station)
+                stats['rows_read'] += batch.num_rows
+                stats['rows_rejected'] += rejected
+                stats['rows_written'] += table.num_rows
+                pending.append(executor.submit(store.write, table, next_sequence()))
+                while len(pending) >= 2 * workers:
+                    touched.update(pending.popleft().result())
+                elapsed = time.perf_counter() - start
+                log(f"  {stats['rows_read']:,} rows read ({stats['rows_read'] / elapsed:,.0f} rows/s)")
+        while pending:
+            touched.update(pending.popleft().result())
+
+    stats['write_seconds'] = time.perf_counter() - start
+    before, after = store.compact_all(touched, workers)
+    stats['duplicates_dropped'] = before - after
+    stats['partitions'] = len(touched)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+def print_report(stats):
+    seconds = max(stats['seconds'], 1e-9)
+    print(f"\nFiles: {stats['files']}  Rows read: {stats['rows_read']:,}  Rejected: {stats['rows_rejected']:,}  "
+          f"Duplicates dropped: {stats['duplicates_dropped']:,}  Partitions: {stats['partitions']:,}")
+    print(f"Write: {stats['write_seconds']:.2f} s  Total with compaction: {stats['seconds']:.2f} s  "
+          f"Throughput: {stats['rows_read'] / seconds:,.0f} rows/s")
+
+def parse_mapping(values):
+    overrides = {}
+    for value in values or []:
+        target, sep, source = value.partition("=")
+        if not sep:
+            raise argparse.ArgumentTypeError(f"--map expects target=source, got '{value}'")
+        overrides[target.strip()] = source
+    return overrides
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill historical air-quality archives into the local history store.")
+    parser.add_argument("paths", nargs="+", help="CSV (optionally .gz/.bz2/.xz) or Parquet files.")
+    parser.add_argument("--store", default=HISTORY_DIR, help="History store directory.")
+    parser.add_argument("--map", action="append", metavar="TARGET=SOURCE",
+                        help=f"Map a source column onto a store column ({', '.join(COLUMN_ALIASES)}); repeatable.")
+    parser.add_argument("--station", help="Station name for files without a station column (also fills blanks).")
+    parser.add_argument("--workers", type=int, default=4, help="Parallel partition writers.")
+    parser.add_argument("--chunk-mb", type=int, default=DEFAULT_CHUNK_MB, help="CSV block size read per chunk.")
+    args = parser.parse_args()
+
+    stats = backfill(args.paths, HistoryStore(args.store), parse_mapping(args.map), args.station, args.workers, args.chunk_mb)
+    print_report(stats)
+
+if __name__ == "__main__":
+    main()
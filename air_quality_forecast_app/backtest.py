@@ -0,0 +1,175 @@
+"""
+Rolling-origin backtest of the horizon models over the local history store.
+
+At each forecast origin (every --step-days after an initial --initial-days of history) and for
+each horizon, the production pipeline (train_models.fit_horizon_model) is refitted on readings
+whose h-hour-ahead target was already observed before the origin, then scored on the following
+step of readings for every city. A persistence forecast (PM2.5 stays where it is) is scored
+alongside as the baseline to beat.
+
+The feature matrix and per-horizon targets are built once from the store; folds only slice
+them. (origin, horizon) folds run in a process pool whose workers receive the matrices once,
+at start-up, and send back per-city error sums.
+
+    python backtest.py --initial-days 180 --step-days 30 --workers 8 --out-dir backtest_results
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from train_models import forecast_horizons, fit_horizon_model, build_dataset, HOUR, DAY
+from utils.aqi import aqi_category_codes
+from utils.history_store import HistoryStore, HISTORY_DIR
+from utils.preprocess import FEATURE_COLUMNS
+
+MIN_TRAIN_ROWS = 50
+# Per-city sums each fold returns: (model, persistence) x (abs error, squared error, AQI category hits)
+SUM_FIELDS = ("n", "abs", "sq", "hits", "persistence_abs", "persistence_sq", "persistence_hits")
+
+def fold_origins(times, initial_days, step_days):
+    """Forecast origins (epoch seconds): the first after initial_days of history, then every step_days."""
+    return np.arange(times[0] + initial_days * DAY, times[-1] + 1, step_days * DAY)
+
+_DATA = None
+
+def _init_worker(data):
+    global _DATA
+    _DATA = data
+
+def evaluate_fold(origin, horizon, step_days, window_days=None, max_train_rows=None, n_estimators=10, seed=42):
+    """
+    Fits on readings before the origin whose target was observed before it, and scores the
+    next step_days of readings. Returns {field: per-station sums} or None if the fold is too small.
+    """
+    d = _DATA
+    times, y = d.times, d.targets[horizon]
+    # A reading at t may be used for training only if its target (at t + h) is already known at the origin
+    train_end = np.searchsorted(times, origin - horizon * HOUR, side="left")
+    train_start = 0 if window_days is None else np.searchsorted(times, origin - window_days * DAY, side="left")
+    train_idx = train_start + np.flatnonzero(~np.isnan(y[train_start:train_end]))
+    if max_train_rows and len(train_idx) > max_train_rows:
+        train_idx = train_idx[-max_train_rows:] # Most recent readings
+    test_start, test_end = np.searchsorted(times, [origin, origin + step_days * DAY], side="left")
+    test_idx = test_start + np.flatnonzero(~np.isnan(y[test_start:test_end]))
+    if len(train_idx) < MIN_TRAIN_ROWS or len(test_idx) == 0:
+        return None
+
+    scaler, model = fit_horizon_model(d.X[train_idx], y[train_idx], n_estimators, seed)
+    actual = y[test_idx]
+    predicted = model.predict(scaler.transform(d.X[test_idx]))
+    persistence = d.X[test_idx, FEATURE_COLUMNS.index("pm25")]
+    actual_codes = aqi_category_codes(actual)
+
+    codes = d.codes[test_idx]
+    n_stations = len(d.stations)
+    def per_station(values):
+        return np.bincount(codes, weights=values, minlength=n_stations)
+    return {
+        "n": per_station(np.ones(len(test_idx))),
+        "abs": per_station(np.abs(predicted - actual)),
+        "sq": per_station(np.square(predicted - actual)),
+        "hits": per_station((aqi_category_codes(predicted) == actual_codes).astype(np.float64)),
+        "persistence_abs": per_station(np.abs(persistence - actual)),
+        "persistence_sq": per_station(np.square(persistence - actual)),
+        "persistence_hits": per_station((aqi_category_codes(persistence) == actual_codes).astype(np.float64)),
+    }
+
+def _evaluate_task(task):
+    origin, horizon, kwargs = task
+    return origin, horizon, evaluate_fold(origin, horizon, **kwargs)
+
+def run_backtest(data, horizons=forecast_horizons, initial_days=90, step_days=30, window_days=None,
+                 max_train_rows=None, n_estimators=10, workers=None, log=print):
+    """
+    Runs every (origin, horizon) fold across a process pool.
+    Returns {horizon: {field: per-station sums over all folds}} and one row per fold.
+    """
+    origins = fold_origins(data.times, initial_days, step_days)
+    kwargs = dict(step_days=step_days, window_days=window_days, max_train_rows=max_train_rows, n_estimators=n_estimators)
+    # Latest origins have the most training rows; starting them first keeps the pool busy to the end
+    tasks = [(int(origin), horizon, kwargs) for origin in origins[::-1] for horizon in horizons]
+    log(f"{len(data.times):,} readings from {len(data.stations)} cities, {len(origins)} origins x {len(horizons)} horizons = {len(tasks)} folds")
+
+    totals = {horizon: {field: np.zeros(len(data.stations)) for field in SUM_FIELDS} for horizon in horizons}
+    fold_rows = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(data,)) as executor:
+        for done, (origin, horizon, sums) in enumerate(executor.map(_evaluate_task, tasks, chunksize=1), 1):
+            if sums is None:
+                continue
+            for field in SUM_FIELDS:
+                totals[horizon][field] += sums[field]
+            fold_rows.append({"origin": pd.Timestamp(origin, unit="s"), "horizon": horizon,
+                              **_metrics({field: sums[field].sum() for field in SUM_FIELDS})})
+            if done % max(1, len(tasks) // 10) == 0:
+                log(f"  {done}/{len(tasks)} folds")
+    folds = pd.DataFrame(fold_rows)
+    if not folds.empty:
+        folds["n"] = folds["n"].astype(np.int64)
+        folds = folds.sort_values(["origin", "horizon"], ignore_index=True)
+    return totals, folds
+
+def _metrics(sums):
+    n = np.maximum(sums["n"], 1)
+    return {
+        "n": sums["n"],
+        "mae": sums["abs"] / n,
+        "rmse": np.sqrt(sums["sq"] / n),
+        "aqi_hit_rate": sums["hits"] / n,
+        "persistence_mae": sums["persistence_abs"] / n,
+        "persistence_rmse": np.sqrt(sums["persistence_sq"] / n),
+        "persistence_aqi_hit_rate": sums["persistence_hits"] / n,
+    }
+
+def metrics_table(totals, stations):
+    """MAE / RMSE / AQI-category hit rate per city and horizon, plus an all-cities row per horizon."""
+    frames = []
+    for horizon, sums in totals.items():
+        per_city = pd.DataFrame({"city": stations, "horizon": horizon, **_metrics(sums)})
+        overall = pd.DataFrame({"city": ["All cities"], "horizon": [horizon],
+                                **{k: [v] for k, v in _metrics({f: sums[f].sum() for f in SUM_FIELDS}).items()}})
+        frames.append(pd.concat([overall, per_city[per_city["n"] > 0]], ignore_index=True))
+    table = pd.concat(frames, ignore_index=True)
+    table["n"] = table["n"].astype(np.int64)
+    return table
+
+def main():
+    parser = argparse.ArgumentParser(description="Rolling-origin backtest of the horizon models over the history store.")
+    parser.add_argument("--store", default=HISTORY_DIR)
+    parser.add_argument("--stations", nargs="+", help="Cities to include (default: all in the store).")
+    parser.add_argument("--start", help="First timestamp to use, e.g. 2021-01-01.")
+    parser.add_argument("--end", help="Timestamp to stop before.")
+    parser.add_argument("--horizons", nargs="+", type=int, default=forecast_horizons)
+    parser.add_argument("--initial-days", type=float, default=90, help="History before the first origin.")
+    parser.add_argument("--step-days", type=float, default=30, help="Spacing between origins (and test window length).")
+    parser.add_argument("--window-days", type=float, default=None, help="Train on a sliding window instead of all prior history.")
+    parser.add_argument("--max-train-rows", type=int, default=None, help="Cap each fold's training set to its most recent rows.")
+    parser.add_argument("--n-estimators", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--out-dir", help="Write metrics.csv and folds.csv here.")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    data = build_dataset(HistoryStore(args.store), args.stations, args.start, args.end, args.horizons)
+    print(f"Built feature matrix in {time.perf_counter() - start:.2f} s")
+    totals, folds = run_backtest(data, args.horizons, args.initial_days, args.step_days, args.window_days,
+                                 args.max_train_rows, args.n_estimators, args.workers)
+    metrics = metrics_table(totals, data.stations)
+
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.float_format", "{:.3f}".format):
+        print(metrics[metrics["city"] == "All cities"].drop(columns="city").to_string(index=False))
+        print()
+        print(metrics[metrics["city"] != "All cities"].to_string(index=False))
+    print(f"\nBacktest finished in {time.perf_counter() - start:.1f} s")
+
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+        metrics.to_csv(os.path.join(args.out_dir, "metrics.csv"), index=False)
+        folds.to_csv(os.path.join(args.out_dir, "folds.csv"), index=False)
+        print(f"Tables written to {args.out_dir}")
+
+if __name__ == "__main__":
+    main()
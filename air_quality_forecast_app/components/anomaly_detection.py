@@ -3,7 +3,7 @@ import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
 
-def display_anomaly_detection(forecasted_pm25_value, raw_data, city_name, chart_key_prefix=""):
+def display_anomaly_detection(forecasted_pm25_value, observation, city_name, chart_key_prefix=""):
     st.markdown("#### 🔍 Anomaly Detection")
     st.markdown("Identify unusual spikes or dips in air quality data that might indicate anomalies.")
 
@@ -1,4 +1,11 @@
+import gzip
+import tempfile
+
 import streamlit as st
+import pandas as pd
+import plotly.express as px
+
+from utils.carbon_footprint import DEFAULT_EMISSION_FACTORS, FootprintSummary, estimate_footprint, invalid_factors, stream_footprints
 
 def display_carbon_footprint_estimator(key_prefix=""):
     st.markdown("#### 👣 Carbon Footprint Estimator")
@@ -25,24 +32,92 @@ def display_carbon_footprint_estimator(key_prefix=""):
 
     st.markdown("--- ")
 
-    # Simple emission factors (these are illustrative and can be refined)
-    # Source: EPA, various online calculators (values are approximate)
-    emission_factor_electricity = 0.4  # kg CO2e/kWh
-    emission_factor_natural_gas = 5.3  # kg CO2e/therm
-    emission_factor_car = 0.17   # kg CO2e/mile (average car)
-    emission_factor_bus = 0.1    # kg CO2e/mile
-    emission_factor_flight_short = 100 # kg CO2e/flight (illustrative)
-    emission_factor_flight_long = 500  # kg CO2e/flight (illustrative)
-
-    total_carbon_footprint = (
-        (electricity_kwh * emission_factor_electricity) +
-        (natural_gas_therms * emission_factor_natural_gas) +
-        (car_miles * emission_factor_car) +
-        (bus_miles * emission_factor_bus) +
-        (flights_short * emission_factor_flight_short / 12) + # Convert yearly to monthly
-        (flights_long * emission_factor_flight_long / 12)      # Convert yearly to monthly
-    )
+    inputs = pd.DataFrame([{
+        'electricity_kwh': electricity_kwh,
+        'natural_gas_therms': natural_gas_therms,
+        'car_miles': car_miles,
+        'bus_miles': bus_miles,
+        'flights_short': flights_short,
+        'flights_long': flights_long,
+    }])
+    total_carbon_footprint = estimate_footprint(inputs)['total_kg_co2e'].iloc[0]
 
     st.markdown(f"## 📊 Estimated Monthly Carbon Footprint: <span style='color: var(--primary-color);;'>{total_carbon_footprint:.2f} kg CO2e</span>", unsafe_allow_html=True)
 
     st.info("This is an estimation based on simplified factors. For a more accurate calculation, consider using a dedicated carbon footprint calculator.")
+
+    display_batch_carbon_footprint(key_prefix)
+
+def display_batch_carbon_footprint(key_prefix=""):
+    """Runs the footprint engine over an uploaded household or fleet dataset."""
+    with st.expander("🏢 Batch Estimate for an Organization (CSV or Parquet upload)"):
+        st.markdown(
+            "Upload one row per household or vehicle with any of these columns: "
+            + ", ".join(f"`{c}`" for c in DEFAULT_EMISSION_FACTORS['column'])
+            + ". Missing columns count as zero. Large files are processed in chunks."
+        )
+        factors = st.data_editor(
+            DEFAULT_EMISSION_FACTORS,
+            disabled=["column", "activity", "unit"],
+            hide_index=True,
+            use_container_width=True,
+            key=f"{key_prefix}emission_factors",
+        )
+        invalid = invalid_factors(factors)
+        if invalid:
+            st.error(f"Enter a number for the factor and multiplier of: {', '.join(invalid)}.")
+            return
+        uploaded_file = st.file_uploader("Dataset", type=["csv", "parquet"], key=f"{key_prefix}footprint_upload")
+        id_column = st.text_input("ID column (optional)", value="", key=f"{key_prefix}footprint_id_column", help="Carried into the per-row results file.")
+        include_rows = st.checkbox("Prepare per-row results for download", value=True, key=f"{key_prefix}footprint_include_rows")
+
+        if uploaded_file is None or not st.button("Estimate Footprints", key=f"{key_prefix}footprint_run"):
+            return
+
+        summary = FootprintSummary(factors)
+        progress = st.progress(0.0, text="Processing...")
+        with tempfile.TemporaryFile() as rows_file:
+            # Per-row results are streamed to a compressed temp file rather than held in memory
+            with gzip.open(rows_file, "wt", newline="", compresslevel=1) as writer:
+                for i, result in enumerate(stream_footprints(uploaded_file, uploaded_file.name, factors, id_column or None)):
+                    summary.update(result)
+                    if include_rows:
+                        # Keep the download to the ID and total; the activity split is summarized below
+                        row_columns = [c for c in (id_column, 'total_kg_co2e') if c in result.columns]
+                        result[row_columns].to_csv(writer, header=(i == 0), index=False, float_format="%.3f")
+                    progress.progress(min(uploaded_file.tell() / max(uploaded_file.size, 1), 1.0), text=f"Processed {summary.rows:,} rows")
+            progress.empty()
+            rows_file.seek(0)
+            rows_bytes = rows_file.read() if include_rows else None
+
+        stats = summary.summary()
+        if stats["rows"] == 0:
+            st.warning("The uploaded file has no rows.")
+            return
+
+        cols = st.columns(4)
+        cols[0].metric("Rows", f"{stats['rows']:,}")
+        cols[1].metric("Total (t CO2e / month)", f"{stats['total_kg_co2e'] / 1000:,.1f}")
+        cols[2].metric("Mean (kg / row)", f"{stats['mean_kg_co2e']:,.1f}")
+        cols[3].metric("Median (kg / row)", f"{stats['p50_kg_co2e']:,.1f}")
+        st.write(f"p10 {stats['p10_kg_co2e']:,.1f} · p90 {stats['p90_kg_co2e']:,.1f} · p99 {stats['p99_kg_co2e']:,.1f} · max {stats['max_kg_co2e']:,.1f} kg CO2e")
+
+        histogram_df = summary.histogram_df()
+        fig = px.bar(
+            histogram_df,
+            x="lower_kg_co2e",
+            y="count",
+            log_x=True,
+            title="Distribution of Monthly Footprints",
+            labels={"lower_kg_co2e": "kg CO2e / month", "count": "Rows"},
+            template="plotly_white",
+        )
+        st.plotly_chart(fig, use_container_width=True, key=f"{key_prefix}footprint_histogram")
+
+        breakdown_df = summary.activity_breakdown().merge(factors[["column", "activity"]], on="column")
+        fig = px.pie(breakdown_df, names="activity", values="total_kg_co2e", title="Emissions by Activity", template="plotly_white")
+        st.plotly_chart(fig, use_container_width=True, key=f"{key_prefix}footprint_breakdown")
+
+        if rows_bytes is not None:
+            st.download_button("Download per-row results (CSV, gzip)", rows_bytes, file_name="footprints.csv.gz",
+                               mime="application/gzip", key=f"{key_prefix}footprint_download")
@@ -0,0 +1,104 @@
+import html
+import math
+
+import numpy as np
+import streamlit as st
+
+from components.map_view import aqi_colors, get_aqi_category
+from utils.observations import utc_now
+
+TILE_COLUMNS = 4
+# A reading older than this is flagged on its tile: the station or the scheduler has stopped updating
+STALE_AFTER = np.timedelta64(3, 'h')
+PAGE_SIZES = (12, 24, 48)
+SORT_OPTIONS = ("Population", "Current PM2.5 (worst first)", "Peak forecast (worst first)", "Name")
+
+def _show_detail(state_key, waqi_key):
+    st.session_state[state_key] = waqi_key
+
+def _tile_order(cities, current, peak, sort_by):
+    if sort_by == "Current PM2.5 (worst first)":
+        return np.argsort(-current, kind="stable")  # NaN (no reading) sorts last
+    if sort_by == "Peak forecast (worst first)":
+        return np.argsort(-peak, kind="stable")
+    if sort_by == "Name":
+        return np.array(sorted(range(len(cities)), key=lambda i: cities[i].label), dtype=np.int64)
+    return np.arange(len(cities))  # Cities arrive largest first
+
+def _format_utc(value):
+    return np.datetime_as_string(value, unit='m').replace('T', ' ') + " UTC"
+
+def _display_tile(city, timestamp, fetched_at, pm25, forecast_values, forecast_horizons, error, stale, state_key, key):
+    """
+    One compact summary tile: current PM2.5 and AQI colour, the forecasts in one line, a warning
+    if the latest fetch failed or the reading is stale, and a details button.
+    """
+    category = get_aqi_category(None if np.isnan(pm25) else pm25)
+    reading = "–" if np.isnan(pm25) else f"{pm25:.0f}"
+    with st.container(border=True):
+        st.markdown(
+            f"<div style='border-left: 6px solid {aqi_colors[category]}; padding-left: 8px;'>"
+            f"<b>{html.escape(city.label)}</b><br>"
+            f"<span style='font-size: 1.6em;'>{reading}</span> µg/m³ · {category}</div>",
+            unsafe_allow_html=True,
+        )
+        if np.isnat(timestamp):
+            st.caption("No current reading", help=error)
+        else:
+            st.caption(" · ".join(f"+{h}h {'–' if np.isnan(v) else f'{v:.0f}'}" for h, v in zip(forecast_horizons, forecast_values)))
+            fetched = None if np.isnan(fetched_at) else f"Fetched {_format_utc(np.datetime64(int(fetched_at), 's'))}"
+            if error:
+                st.caption(f"⚠️ {error} · reading from {_format_utc(timestamp)}", help=fetched)
+            elif stale:
+                st.caption(f"⚠️ Stale: reading from {_format_utc(timestamp)}", help=fetched)
+        st.button("Details", key=key, on_click=_show_detail, args=(state_key, city.waqi_key), use_container_width=True)
+
+def display_city_dashboard(cities, materialized, forecast_horizons, render_detail, key_prefix=""):
+    """
+    Paginated grid of summary tiles for many cities, built from one read of the forecast store
+    (ManyForecasts aligned with `cities`). Only the current page's tiles are rendered, and the
+    full analysis (render_detail(city)) only for the one tile opened.
+    """
+    batch, forecasts, errors, fetched_at = materialized
+    if not cities:
+        st.info("No cities selected.")
+        return
+    current = batch['pm25']
+    forecast_matrix = np.column_stack([forecasts[h] for h in forecast_horizons])
+    peak = np.fmax.reduce(forecast_matrix, axis=1)  # Ignores NaN unless the whole row is NaN
+
+    cols = st.columns(3)
+    cols[0].metric("Cities", len(cities))
+    stale = batch['timestamp'] < utc_now() - STALE_AFTER
+    live = ~np.isnat(batch['timestamp']) & ~stale & np.array([city.waqi_key not in errors for city in cities])
+    cols[1].metric("Live readings", int(live.sum()))
+    if not np.isnan(peak).all():
+        worst = int(np.nanargmax(peak))
+        cols[2].metric("Highest forecast", f"{peak[worst]:.0f} µg/m³", help=cities[worst].label, delta_color="off")
+
+    state_key = f"{key_prefix}detail_city"
+    detail_area = st.container()  # Filled after the grid, but shown above it
+
+    controls = st.columns(3)
+    sort_by = controls[0].selectbox("Sort by", SORT_OPTIONS, key=f"{key_prefix}sort")
+    page_size = controls[1].selectbox("Tiles per page", PAGE_SIZES, key=f"{key_prefix}page_size")
+    pages = math.ceil(len(cities) / page_size)
+    page = controls[2].number_input(f"Page (of {pages})", min_value=1, max_value=pages, value=1, key=f"{key_prefix}page")
+
+    order = _tile_order(cities, current, peak, sort_by)
+    page_rows = order[(page - 1) * page_size: page * page_size]
+    for row_start in range(0, len(page_rows), TILE_COLUMNS):
+        for column, i in zip(st.columns(TILE_COLUMNS), page_rows[row_start:row_start + TILE_COLUMNS]):
+            with column:
+                _display_tile(cities[i], batch['timestamp'][i], fetched_at[i], current[i], forecast_matrix[i], forecast_horizons,
+                              errors.get(cities[i].waqi_key), stale[i], state_key, key=f"{key_prefix}tile_{i}")
+
+    selected = st.session_state.get(state_key)
+    index = next((i for i, city in enumerate(cities) if city.waqi_key == selected), None)
+    if index is None:
+        return
+    with detail_area:
+        header, close = st.columns([5, 1])
+        header.subheader(f"Details: {cities[index].label}")
+        close.button("Close", key=f"{key_prefix}detail_close", on_click=_show_detail, args=(state_key, None), use_container_width=True)
+        render_detail(cities[index])
@@ -0,0 +1,54 @@
+import datetime
+import tempfile
+
+import streamlit as st
+
+from utils.export import EXPORT_FORMATS, FILE_EXTENSIONS, MIME_TYPES, export_batches, write_export
+
+# The download has to be handed to the browser in one piece; larger exports belong to export_data.py
+UI_MAX_ROWS = 1_000_000
+
+def display_data_export(store, stations, models, scalers, forecast_horizons, key_prefix="", station_labels=None):
+    """
+    Exports history, AQI categories and forecasts for chosen cities and dates as Parquet or Arrow.
+    station_labels maps store station names (e.g. the scheduler's WAQI keys) to what the picker shows.
+    """
+    station_labels = station_labels or {}
+    st.markdown("#### 📦 Export Historical Data and Forecasts")
+    if not stations:
+        st.info("The history store is empty. Load archives with `python backfill.py` to enable exports.")
+        return
+    st.markdown(
+        "Each reading comes with its AQI category and the model's PM2.5 forecast (and category) for every horizon. "
+        f"Downloads here are capped at {UI_MAX_ROWS:,} rows; use `python export_data.py` for bulk exports."
+    )
+
+    selected = st.multiselect("Cities", stations, default=stations[:1], format_func=lambda s: station_labels.get(s, s),
+                              key=f"{key_prefix}export_stations")
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        start = st.date_input("From", value=datetime.date.today() - datetime.timedelta(days=365), key=f"{key_prefix}export_start")
+    with col2:
+        end = st.date_input("To (inclusive)", value=datetime.date.today(), key=f"{key_prefix}export_end")
+    with col3:
+        fmt = st.selectbox("Format", EXPORT_FORMATS, format_func=lambda f: {"parquet": "Parquet", "arrow": "Arrow IPC stream"}[f], key=f"{key_prefix}export_format")
+    horizons = st.multiselect("Forecast horizons", forecast_horizons, default=forecast_horizons, format_func=lambda h: f"+{h}h", key=f"{key_prefix}export_horizons")
+
+    if not selected or not st.button("Prepare Export", key=f"{key_prefix}export_run"):
+        return
+
+    batches = export_batches(store, selected, start, end + datetime.timedelta(days=1), models, scalers, tuple(horizons))
+    with st.spinner("Exporting..."), tempfile.TemporaryFile() as out:
+        # Batches are streamed into a temp file, so only the finished file is ever held in memory
+        rows = write_export(batches, out, fmt, tuple(horizons), max_rows=UI_MAX_ROWS)
+        out.seek(0)
+        data = out.read()
+
+    if rows == 0:
+        st.warning("No readings for the selected cities and dates.")
+        return
+    if rows == UI_MAX_ROWS:
+        st.warning(f"The export was cut at {UI_MAX_ROWS:,} rows. Narrow the selection or use `python export_data.py`.")
+    st.success(f"{rows:,} rows ready ({len(data) / 1e6:.1f} MB).")
+    st.download_button(f"Download ({fmt})", data, file_name=f"cleanair_export{FILE_EXTENSIONS[fmt]}",
+                       mime=MIME_TYPES[fmt], key=f"{key_prefix}export_download")
@@ -3,55 +3,66 @@ import plotly.express as px
 import pandas as pd
 import numpy as np
 
-def display_feature_importance(model, scaler, raw_data, city_name, chart_key_prefix=""):
+from utils.preprocess import feature_matrix, FEATURE_COLUMNS
+
+def _bar_chart(df, x, title, x_label, error_x=None):
+    fig = px.bar(
+        df,
+        x=x,
+        y='Feature',
+        error_x=error_x,
+        orientation='h',
+        title=title,
+        labels={x: x_label, 'Feature': 'Environmental Factor'},
+        template='plotly_white'
+    )
+    fig.update_layout(
+        yaxis={'categoryorder':'total ascending'},
+        font=dict(family="sans-serif", size=12, color="#7f7f7f"),
+        title_font_size=20,
+    )
+    return fig
+
+def display_feature_importance(observation, city_name, chart_key_prefix="", metadata=None, attributions=None):
+    """
+    Shows what drives the current forecast (attributions as (bias, contributions), materialized
+    with the forecast) and the model's overall permutation importance from its metadata.
+    """
     st.markdown("#### 📊 Key Environmental Factors")
     st.markdown("Understand which environmental factors most influence air quality predictions.")
 
-    if model is None or scaler is None or raw_data.empty:
-        st.info("Model, scaler, or raw data not available for feature importance analysis.")
+    if observation is None:
+        st.info("Raw data not available for feature importance analysis.")
         return
 
-    # Assuming the model is a tree-based model with feature_importances_ attribute
-    if hasattr(model, 'feature_importances_'):
-        # Define features based on what was used in train_models.py and preprocess.py
-        FEATURES = ['pm25', 'temperature', 'humidity', 'wind_speed', 'pressure']
-        
-        # Get base importances from the model
-        base_importances = model.feature_importances_
-        
-        # Introduce city-specific variation for demonstration
-        # Use a deterministic seed based on city_name for consistent variations
-        rng = np.random.RandomState(hash(city_name) % (2**32 - 1)) # Ensure seed is within int32 range
-        
-        # Generate small random perturbations
-        perturbations = rng.uniform(-0.05, 0.05, len(FEATURES)) # Small random values
-        
-        # Apply perturbations and ensure non-negativity
-        perturbed_importances = base_importances + perturbations
-        perturbed_importances[perturbed_importances < 0] = 0.01 # Ensure no negative importances
-        
-        # Re-normalize the importances so they sum to 1 (if they were originally normalized)
-        perturbed_importances = perturbed_importances / perturbed_importances.sum()
+    metadata = metadata or {}
+    local_tab, global_tab = st.tabs([f"Current reading in {city_name}", "Overall model"])
 
-        feature_importance_df = pd.DataFrame({
-            'Feature': FEATURES,
-            'Importance': perturbed_importances
-        }).sort_values(by='Importance', ascending=False)
+    with local_tab:
+        if attributions is None:
+            st.info("Per-reading attributions are only available for tree-ensemble models.")
+        else:
+            bias, contributions = attributions
+            features = feature_matrix(observation)[0]
+            local_df = pd.DataFrame({
+                'Feature': FEATURE_COLUMNS,
+                'Contribution': contributions,
+                'Value': features,
+            })
+            fig = _bar_chart(local_df, 'Contribution', 'What Drives This Forecast', 'Contribution to 1-hour PM2.5 (µg/m³)')
+            fig.update_traces(customdata=local_df[['Value']], hovertemplate="%{y} = %{customdata[0]:.1f}<br>Contribution: %{x:+.2f} µg/m³<extra></extra>")
+            st.plotly_chart(fig, use_container_width=True, key=f"{chart_key_prefix}feature_importance_{city_name}")
+            st.caption(f"Baseline {bias:.1f} µg/m³ plus these contributions gives the forecast of {bias + contributions.sum():.1f} µg/m³.")
 
-        fig = px.bar(
-            feature_importance_df,
-            x='Importance',
-            y='Feature',
-            orientation='h',
-            title='Feature Importance for PM2.5 Prediction',
-            labels={'Importance': 'Relative Importance', 'Feature': 'Environmental Factor'},
-            template='plotly_white'
-        )
-        fig.update_layout(
-            yaxis={'categoryorder':'total ascending'},
-            font=dict(family="sans-serif", size=12, color="#7f7f7f"),
-            title_font_size=20,
-        )
-        st.plotly_chart(fig, use_container_width=True, key=f"{chart_key_prefix}feature_importance_{city_name}")
-    else:
-        st.info("Feature importance is not available for the selected model type.")
\ No newline at end of file
+    with global_tab:
+        permutation = metadata.get('permutation_importance')
+        if permutation:
+            global_df = pd.DataFrame({
+                'Feature': list(permutation),
+                'Importance': [v['mean'] for v in permutation.values()],
+                'Std': [v['std'] for v in permutation.values()],
+            })
+            fig = _bar_chart(global_df, 'Importance', 'Permutation Importance for PM2.5 Prediction', 'Drop in R² when shuffled', error_x='Std')
+            st.plotly_chart(fig, use_container_width=True, key=f"{chart_key_prefix}global_importance_{city_name}")
+        else:
+            st.info("No permutation importance is stored with this model; run `python train_models.py --metadata-only` to compute it.")
@@ -2,6 +2,8 @@ import streamlit as st
 
 import streamlit as st
 
+from utils.aqi import AQI_CATEGORIES
+
 def display_health_alert(pm25_value):
     if pm25_value is None:
         st.info("PM2.5 forecast not available for health advisory.")
@@ -25,4 +27,34 @@ def display_health_alert(pm25_value):
         st.markdown("- **Recommendations:** Everyone should avoid all outdoor exertion. Remain indoors and keep activities light. Use N95 masks if you must go outside.")
     else:
         st.error(f"**Hazardous Air Quality ({pm25_value:.2f} µg/m³):** Health alert: everyone may experience more serious health effects.")
-        st.markdown("- **Recommendations:** Everyone should avoid all outdoor physical activity. Stay indoors, keep windows and doors closed, and use air purifiers. Seek medical attention if you experience breathing difficulties.")
\ No newline at end of file
+        st.markdown("- **Recommendations:** Everyone should avoid all outdoor physical activity. Stay indoors, keep windows and doors closed, and use air purifiers. Seek medical attention if you experience breathing difficulties.")
+
+def display_alert_subscription(engine, city_key, city_label, forecast_horizons, rules_file, key_prefix=""):
+    """
+    Lets a user subscribe to forecast alerts for this city and lists their current rules. Rules
+    are stored under city_key (unique per station); city_label is only shown to the user.
+    """
+    with st.expander(f"🔔 Get notified when the {city_label} forecast gets worse"):
+        with st.form(key=f"{key_prefix}alert_form_{city_key}"):
+            subscriber = st.text_input("Email or username", key=f"{key_prefix}alert_subscriber_{city_key}")
+            horizon = st.selectbox("Forecast horizon", forecast_horizons, format_func=lambda h: f"+{h}h", key=f"{key_prefix}alert_horizon_{city_key}")
+            kind = st.radio("Alert when PM2.5 reaches", ["AQI category", "Custom threshold"], horizontal=True, key=f"{key_prefix}alert_kind_{city_key}")
+            category = st.selectbox("AQI category", AQI_CATEGORIES[1:], index=1, key=f"{key_prefix}alert_category_{city_key}")
+            threshold = st.number_input("Threshold (µg/m³)", min_value=0.0, value=35.4, step=1.0, key=f"{key_prefix}alert_threshold_{city_key}")
+            submitted = st.form_submit_button("Subscribe")
+
+        if submitted:
+            if not subscriber.strip():
+                st.warning("Enter an email or username to subscribe.")
+            else:
+                if kind == "AQI category":
+                    rule_id = engine.add_rule(subscriber.strip(), city_key, horizon, category=category, label=city_label)
+                else:
+                    rule_id = engine.add_rule(subscriber.strip(), city_key, horizon, threshold=threshold, label=city_label)
+                engine.save_rules(rules_file, [rule_id])
+                st.success(f"Subscribed {subscriber.strip()} to {city_label} alerts at +{horizon}h.")
+
+        if subscriber.strip():
+            rules = engine.rules_for(subscriber.strip())
+            if not rules.empty:
+                st.dataframe(rules.drop(columns="rule_id"), use_container_width=True, hide_index=True)
@@ -4,6 +4,8 @@ import pandas as pd
 import numpy as np
 import plotly.graph_objects as go
 
+from utils.clustering import StationClusterIndex, fit_view
+
 def get_aqi_category(pm25_value):
     if pm25_value is None: return "N/A"
     if pm25_value <= 12.0: return "Good"
@@ -23,16 +25,69 @@ aqi_colors = {
     "N/A": "#CCCCCC" # Grey for not available
 }
 
-def display_map(map_data_df, chart_key_prefix=""):
+# Above this many stations the map switches from individual markers to zoom-level clusters
+CLUSTER_THRESHOLD = 200
+MAP_HEIGHT = 500
+MAP_WIDTH = 700 # Typical rendered width, used to fit the initial zoom
+
+@st.cache_resource(max_entries=8)
+def build_cluster_index(map_data_df):
+    """Precomputes every zoom level's clusters once per distinct station set."""
+    return StationClusterIndex(map_data_df['Latitude'], map_data_df['Longitude'], map_data_df['PM2.5'])
+
+def display_cluster_map(map_data_df, chart_key_prefix=""):
+    """
+    Renders every cluster of the chosen zoom level with WebGL-backed mapbox traces. Streamlit
+    does not report the map's pan/zoom back, so all of the level's clusters are sent and the
+    browser can pan freely; the zoom slider picks the level.
+    """
+    cluster_index = build_cluster_index(map_data_df)
+    center_lat, center_lon, fitted_zoom = fit_view(map_data_df['Latitude'], map_data_df['Longitude'], MAP_WIDTH, MAP_HEIGHT)
+    zoom = st.slider("Map zoom", min_value=cluster_index.min_zoom, max_value=cluster_index.max_zoom + 1,
+                     value=min(fitted_zoom, cluster_index.max_zoom + 1), key=f"{chart_key_prefix}map_zoom")
+    clusters_df = cluster_index.clusters(zoom)
+
+    fig = go.Figure()
+    # One trace per AQI category keeps the legend; each is a single WebGL layer regardless of size
+    for category, color in aqi_colors.items():
+        category_df = clusters_df[clusters_df['AQI_Category'] == category]
+        if category_df.empty:
+            continue
+        fig.add_trace(go.Scattermapbox(
+            lat=category_df['Latitude'],
+            lon=category_df['Longitude'],
+            mode='markers',
+            marker=dict(size=np.clip(8 + 6 * np.log2(category_df['Count']), 8, 40), color=color, opacity=0.85),
+            name=category,
+            customdata=np.stack([category_df['Count'], category_df['Mean PM2.5'], category_df['Max PM2.5']], axis=-1),
+            hovertemplate="Stations: %{customdata[0]}<br>Mean PM2.5: %{customdata[1]:.1f} µg/m³"
+                          "<br>Max PM2.5: %{customdata[2]:.1f} µg/m³<extra>%{fullData.name}</extra>",
+        ))
+
+    fig.update_layout(
+        height=MAP_HEIGHT,
+        title=f"Air Quality Across {len(map_data_df):,} Stations",
+        margin={"r":0,"t":40,"l":0,"b":0},
+        legend_title_text='Worst AQI Category',
+        mapbox=dict(style="open-street-map", center=dict(lat=center_lat, lon=center_lon), zoom=zoom),
+    )
+    st.plotly_chart(fig, use_container_width=True, key=f"{chart_key_prefix}map_view")
+
+    st.markdown(f"**Note:** Showing {len(clusters_df):,} clusters at zoom {zoom}. Marker size grows with the number of stations; colors show the worst AQI category in each cluster.")
+
+def display_map(map_data_df, chart_key_prefix="", surface_df=None):
     st.markdown("#### 🗺️ Interactive Air Quality Map")
 
     if map_data_df.empty:
         st.info("No data available to display on the map.")
         return
 
-    # Calculate center of the map based on provided data
-    center_lat = map_data_df['Latitude'].mean()
-    center_lon = map_data_df['Longitude'].mean()
+    if len(map_data_df) > CLUSTER_THRESHOLD:
+        display_cluster_map(map_data_df, chart_key_prefix)
+        return
+
+    # Center and zoom so every station is in view (a single city gets a city-level view)
+    center_lat, center_lon, zoom = fit_view(map_data_df['Latitude'], map_data_df['Longitude'], MAP_WIDTH, MAP_HEIGHT, max_zoom=9)
 
     fig = px.scatter_mapbox(
         map_data_df,
@@ -41,8 +96,8 @@ def display_map(map_data_df, chart_key_prefix=""):
         color="AQI_Category", # Color by AQI category
         color_discrete_map=aqi_colors, # Use discrete color map
         size="PM2.5", # Size of marker based on PM2.5 value
-        zoom=9, # Adjusted zoom for state-level view
-        height=500,
+        zoom=zoom,
+        height=MAP_HEIGHT,
         title="Air Quality Levels Across Selected Locations",
         labels={'PM2.5': 'PM2.5 (µg/m³)', 'AQI_Category': 'AQI Category'},
         mapbox_style="open-street-map", # Changed to a supported map style
@@ -50,6 +105,21 @@ def display_map(map_data_df, chart_key_prefix=""):
         hover_data={"PM2.5": True, "AQI_Category": True, "Latitude": False, "Longitude": False} # Show PM2.5 and AQI on hover
     )
 
+    # Optional interpolated PM2.5 surface (see utils/spatial_index.py), drawn beneath the station markers
+    if surface_df is not None and not surface_df.empty:
+        fig.add_trace(go.Densitymapbox(
+            lat=surface_df['Latitude'],
+            lon=surface_df['Longitude'],
+            z=surface_df['PM2.5'],
+            radius=12,
+            opacity=0.45,
+            colorscale="YlOrRd",
+            colorbar=dict(title="PM2.5 (µg/m³)", x=1.0, len=0.6),
+            hoverinfo="skip",
+            name="Interpolated PM2.5",
+        ))
+        fig.data = (fig.data[-1],) + fig.data[:-1]
+
     fig.update_layout(
         margin={"r":0,"t":40,"l":0,"b":0},
         legend_title_text='AQI Category',
@@ -3,7 +3,7 @@ import plotly.express as px
 import pandas as pd
 import numpy as np
 
-def display_temporal_heatmap(raw_data, city_name, chart_key_prefix=""):
+def display_temporal_heatmap(observation, city_name, chart_key_prefix=""):
     st.markdown("#### 🗓️ Temporal Heatmap: Daily & Hourly PM2.5 Patterns")
     st.markdown("Identify recurring patterns in air quality throughout the day and across different days.")
 
@@ -3,38 +3,51 @@ import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
 
-def display_aqi_trends(raw_data, forecasted_pm25_values, city_name, chart_key_prefix=""):
+def display_aqi_trends(observation, forecasted_pm25_values, city_name, chart_key_prefix="", forecast_intervals=None):
     st.markdown("#### 📈 AQI Trends: Historical & Forecasted")
     st.markdown("Visualize the historical PM2.5 levels and their forecasted trends.")
 
-    if raw_data.empty:
+    if observation is None:
         st.info("No historical data available to display trends.")
         return
 
+    # Everything is anchored at the stored reading's UTC time, which the forecasts were computed from
+    reading_time = pd.Timestamp(observation.timestamp)
+
     # Create a dummy historical PM2.5 series for demonstration
     # In a real app, this would come from a database or historical API
     num_historical_points = 24 # Last 24 hours
-    historical_timestamps = pd.date_range(end=pd.to_datetime('now'), periods=num_historical_points, freq='H')
-    # Simulate some variation around the current raw_data pm25
-    historical_pm25 = raw_data['pm25'].iloc[0] + (np.random.rand(num_historical_points) - 0.5) * 20
+    historical_timestamps = pd.date_range(end=reading_time - pd.Timedelta(hours=1), periods=num_historical_points, freq='h')
+    # Simulate some variation around the current observation's pm25
+    historical_pm25 = observation.pm25 + (np.random.rand(num_historical_points) - 0.5) * 20
     historical_df = pd.DataFrame({'timestamp': historical_timestamps, 'pm25': historical_pm25})
 
     # Append the current raw data point
     current_data_point = pd.DataFrame({
-        'timestamp': [raw_data['timestamp'].iloc[0]],
-        'pm25': [raw_data['pm25'].iloc[0]]
+        'timestamp': [reading_time],
+        'pm25': [observation.pm25]
     })
     historical_df = pd.concat([historical_df, current_data_point]).sort_values('timestamp').reset_index(drop=True)
 
     # Prepare forecasted data
     forecast_data = []
-    current_time = pd.to_datetime('now')
     for horizon, pm25_value in forecasted_pm25_values.items():
         if pm25_value is not None:
-            forecast_time = current_time + pd.Timedelta(hours=horizon)
+            forecast_time = reading_time + pd.Timedelta(hours=horizon)
             forecast_data.append({'timestamp': forecast_time, 'pm25': pm25_value})
     forecast_df = pd.DataFrame(forecast_data)
 
+    # Prepare forecast uncertainty bands (lowest to highest quantile across the forest's trees)
+    band_data = []
+    for horizon, band in (forecast_intervals or {}).items():
+        quantiles = sorted(band)
+        band_data.append({
+            'timestamp': reading_time + pd.Timedelta(hours=horizon),
+            'lower': band[quantiles[0]],
+            'upper': band[quantiles[-1]],
+        })
+    band_df = pd.DataFrame(band_data)
+
     fig = go.Figure()
 
     # Add historical trace
@@ -47,6 +60,30 @@ def display_aqi_trends(raw_data, forecasted_pm25_values, city_name, chart_key_pr
         marker=dict(size=6)
     ))
 
+    # Add shaded forecast band beneath the forecast line
+    if not band_df.empty:
+        band_df = band_df.sort_values('timestamp')
+        quantiles = sorted(next(iter(forecast_intervals.values())))
+        band_label = f"Forecast p{quantiles[0] * 100:.0f}–p{quantiles[-1] * 100:.0f}"
+        fig.add_trace(go.Scatter(
+            x=band_df['timestamp'],
+            y=band_df['upper'],
+            mode='lines',
+            line=dict(width=0),
+            showlegend=False,
+            hoverinfo='skip',
+        ))
+        fig.add_trace(go.Scatter(
+            x=band_df['timestamp'],
+            y=band_df['lower'],
+            mode='lines',
+            line=dict(width=0),
+            fill='tonexty',
+            fillcolor='rgba(255, 0, 0, 0.15)',
+            name=band_label,
+            hoverinfo='skip',
+        ))
+
     # Add forecasted trace
     if not forecast_df.empty:
         fig.add_trace(go.Scatter(
@@ -60,7 +97,7 @@ def display_aqi_trends(raw_data, forecasted_pm25_values, city_name, chart_key_pr
 
     fig.update_layout(
         title=f'PM2.5 Trends for {city_name}',
-        xaxis_title='Time',
+        xaxis_title='Time (UTC)',
         yaxis_title='PM2.5 (µg/m³)',
         hovermode='x unified',
         template='plotly_white',
@@ -0,0 +1,45 @@
+"""
+Exports readings from the local history store, with their AQI categories and the models'
+forecasts, as Parquet or an Arrow IPC stream. Batches are streamed from the store to the
+output, so exports of any size run in bounded memory.
+
+    python export_data.py history.parquet --stations Delhi London --start 2023-01-01 --end 2024-01-01
+    python export_data.py - --format arrow --no-forecasts | downstream-consumer
+"""
+import argparse
+import sys
+import time
+
+from train_models import forecast_horizons
+from utils.export import EXPORT_FORMATS, DEFAULT_BATCH_ROWS, export_batches, load_export_models, write_export
+from utils.history_store import HistoryStore, HISTORY_DIR
+from utils.model_metadata import MODEL_DIR
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream history, AQI categories and forecasts out of the history store.")
+    parser.add_argument("out", help="Output file, or - for stdout.")
+    parser.add_argument("--format", choices=EXPORT_FORMATS, help="Default: from the file extension, else parquet.")
+    parser.add_argument("--store", default=HISTORY_DIR)
+    parser.add_argument("--stations", nargs="+", help="Cities to export (default: all in the store).")
+    parser.add_argument("--start", help="First timestamp to export, e.g. 2023-01-01.")
+    parser.add_argument("--end", help="Timestamp to stop before.")
+    parser.add_argument("--horizons", nargs="+", type=int, default=forecast_horizons)
+    parser.add_argument("--no-forecasts", action="store_true", help="Export observations and AQI categories only.")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--batch-rows", type=int, default=DEFAULT_BATCH_ROWS)
+    args = parser.parse_args()
+
+    fmt = args.format or ("arrow" if args.out.endswith((".arrow", ".arrows", ".ipc")) else "parquet")
+    horizons = () if args.no_forecasts else tuple(args.horizons)
+    models, scalers = load_export_models(horizons, args.model_dir)
+    batches = export_batches(HistoryStore(args.store), args.stations, args.start, args.end,
+                             models, scalers, horizons, args.batch_rows)
+
+    start = time.perf_counter()
+    sink = sys.stdout.buffer if args.out == "-" else args.out
+    rows = write_export(batches, sink, fmt, horizons)
+    # Progress goes to stderr so stdout can carry the data
+    print(f"Exported {rows:,} rows as {fmt} in {time.perf_counter() - start:.1f} s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
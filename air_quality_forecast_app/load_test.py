@@ -0,0 +1,116 @@
+"""
+Drives simulated concurrent sessions through app.py against the local WAQI replay stub
+and reports throughput and latency percentiles. Each session runs in its own process,
+since Streamlit's AppTest keeps one script runtime per process.
+
+    python load_test.py --record-dir recordings --sessions 8 --iterations 5 --latency-ms 150
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from streamlit.testing.v1 import AppTest
+
+from utils import data_fetching
+from utils.waqi_stub import serve_in_background
+
+APP_PATH = os.path.join(os.path.dirname(__file__), "app.py")
+CITIES = ["Delhi", "London", "Beijing", "New York City", "Tokyo"]
+
+def start_session(timeout):
+    """A fresh AppTest that has run once, and how long that first run took (None if it failed)."""
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    start = time.perf_counter()
+    try:
+        at.run()
+    except Exception:
+        return at, None
+    return at, time.perf_counter() - start
+
+def run_session(session_id, iterations, cities, timeout):
+    """Runs one simulated user: loads the page, then searches for a different city each iteration."""
+    latencies = []
+    restarts = []  # Durations of the runs that replace a failed session, kept out of `latencies`
+    errors = 0
+    # Warm this worker's st.cache_resource (gazetteer, forecast store) before timing anything
+    AppTest.from_file(APP_PATH, default_timeout=timeout).run()
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    session_start = time.time()
+    for i in range(iterations):
+        start = time.perf_counter()
+        try:
+            if i == 0:
+                at.run()
+            else:
+                # The city selectbox falls back to the most populous match for the search text
+                at.text_input(key="single_city_select_search").input(cities[(session_id + i) % len(cities)]).run()
+            if at.exception:
+                errors += 1
+        except Exception:
+            errors += 1
+            latencies.append(time.perf_counter() - start)
+            # Later iterations need a session that has run; a failed restart shows up as their errors
+            at, restart_time = start_session(timeout)
+            if restart_time is not None:
+                restarts.append(restart_time)
+            continue
+        latencies.append(time.perf_counter() - start)
+    return latencies, errors, session_start, time.time(), restarts
+
+def run_load_test(sessions, iterations, cities, timeout):
+    """Runs `sessions` concurrent sessions and returns (latencies, errors, wall_time, restart durations)."""
+    with ProcessPoolExecutor(max_workers=sessions) as executor:
+        futures = [executor.submit(run_session, s, iterations, cities, timeout) for s in range(sessions)]
+        results = [f.result() for f in futures]
+    # Measure from the first timed run to the last so per-worker warm-up is excluded
+    wall_time = max(r[3] for r in results) - min(r[2] for r in results)
+    latencies = np.concatenate([np.asarray(r[0]) for r in results])
+    errors = sum(r[1] for r in results)
+    restarts = np.concatenate([np.asarray(r[4], dtype=np.float64) for r in results])
+    return latencies, errors, wall_time, restarts
+
+def print_report(latencies, errors, wall_time, sessions, restarts=()):
+    total = len(latencies)
+    p50, p90, p95, p99 = np.percentile(latencies * 1000, [50, 90, 95, 99])
+    print(f"\nSessions: {sessions}  Page runs: {total}  Errors: {errors} ({errors / max(total, 1):.1%})")
+    print(f"Wall time: {wall_time:.2f} s  Throughput: {total / wall_time:.2f} runs/s")
+    print(f"Latency (ms): p50={p50:.0f}  p90={p90:.0f}  p95={p95:.0f}  p99={p99:.0f}  max={latencies.max() * 1000:.0f}")
+    if len(restarts):
+        print(f"Session restarts after failures: {len(restarts)}  mean {np.mean(restarts) * 1000:.0f} ms (not in the latencies above)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test app.py against the WAQI replay stub.")
+    parser.add_argument("--record-dir", required=True, help="Directory of recordings made with `python -m utils.waqi_stub record`.")
+    parser.add_argument("--sessions", type=int, default=4, help="Number of concurrent simulated sessions.")
+    parser.add_argument("--iterations", type=int, default=5, help="Page runs per session.")
+    parser.add_argument("--cities", nargs="+", default=CITIES)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Injected stub latency per request.")
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stub requests that fail with HTTP 503.")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-run timeout in seconds.")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server, base_url = serve_in_background(
+        args.record_dir, port=0, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate, seed=args.seed,
+    )
+    # Session workers are forked from this process, so point the already-imported fetcher at the stub as well
+    os.environ["WAQI_BASE_URL"] = base_url
+    data_fetching.WAQI_BASE_URL = base_url
+    # The stub ignores the token, so a placeholder is enough when none is configured
+    os.environ.setdefault("WAQI_API_TOKEN", "replay")
+    data_fetching.WAQI_API_TOKEN = os.environ["WAQI_API_TOKEN"]
+    print(f"Replay stub listening on {base_url}")
+
+    try:
+        latencies, errors, wall_time, restarts = run_load_test(args.sessions, args.iterations, args.cities, args.timeout)
+        print_report(latencies, errors, wall_time, args.sessions, restarts)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Materializes forecasts for every tracked city, so the app never runs a model to serve a page.
+
+Each cycle fetches the latest reading for all tracked cities concurrently, appends the readings
+to the history store and computes every horizon's forecast, 80% band and path attributions in one
+batch. It then writes them to the forecast store (utils/forecast_store.py) in a single
+transaction, with the model version and input timestamp, and evaluates the alert subscriptions
+against the new forecasts. A full cycle runs every --interval seconds. In between, the scheduler
+polls every --poll seconds for cities the app has newly tracked and materializes (and alerts on)
+just those.
+
+    python materialize_forecasts.py                    # Run forever: hourly cycles, 30 s polls
+    python materialize_forecasts.py --once --seed-largest 200
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pyarrow as pa
+
+from train_models import forecast_horizons, HOUR, DAY
+from utils.alerting import AlertEngine, FileSink, RULES_FILE, NOTIFICATIONS_FILE
+from utils.data_fetching import get_realtime_batch, BATCH_FETCH_WORKERS
+from utils.forecast_store import ForecastStore, FORECAST_DB
+from utils.forecasting import forecast_batch
+from utils.forest_intervals import FlatForest, flatten_forest
+from utils.gazetteer import Gazetteer, DEFAULT_CITIES
+from utils.history_store import HistoryStore, HISTORY_DIR, STORE_SCHEMA
+from utils.model_bundle import bundle_version, load_shared_models
+from utils.model_metadata import load_metadata
+from utils.preprocess import FEATURE_COLUMNS
+
+DEFAULT_INTERVAL = HOUR # WAQI stations report hourly
+DEFAULT_POLL = 30
+DEFAULT_EXPIRE_DAYS = 30
+
+logger = logging.getLogger("materialize_forecasts")
+
+class Models:
+    """The serving models, reloaded when a retrain or incremental update publishes a new bundle."""
+
+    def __init__(self, horizons):
+        self.horizons = tuple(horizons)
+        self.version = None
+
+    def refresh(self):
+        """
+        Switches to the current bundle if the model files changed. If that fails (say a retrain
+        is still writing them), the loaded models stay in service and the next call retries.
+        """
+        try:
+            version = bundle_version(self.horizons)
+            if version != self.version:
+                models, scalers = load_shared_models(self.horizons)
+                flat_forests = {h: m if isinstance(m, FlatForest) else flatten_forest(m) for h, m in models.items()}
+                model_versions = {h: load_metadata(h)['model_version'] for h in self.horizons}
+                self.models, self.scalers, self.flat_forests, self.model_versions = models, scalers, flat_forests, model_versions
+                self.version = version
+        except Exception:
+            if self.version is None:
+                raise # Nothing to fall back to
+            logger.warning("Loading new models failed; keeping model bundle %s", self.version, exc_info=True)
+        return self
+
+def load_alert_engine(path=RULES_FILE, previous=None):
+    """
+    An engine with the rules saved at `path`. Delivery state for rules and subscribers that
+    `previous` already knew (open alert episodes, rate-limit tokens) is carried over, so
+    reloading after the app saves a new subscription does not repeat notifications.
+    """
+    engine = AlertEngine(FileSink(NOTIFICATIONS_FILE))
+    if os.path.exists(path):
+        engine.load(path)
+    if previous is None or len(engine.thresholds) == 0:
+        return engine
+
+    def rule_keys(e, ids):
+        return zip(np.array(e.subscriber_names, dtype=object)[e.subscriber_codes[ids]],
+                   np.array(e.city_names, dtype=object)[e.city_codes[ids]], e.horizons[ids], e.thresholds[ids])
+    active = set(rule_keys(previous, np.flatnonzero(previous.alive & previous.active)))
+    if active:
+        engine.active[:] = [key in active for key in rule_keys(engine, np.arange(len(engine.thresholds)))]
+    for code, name in enumerate(engine.subscriber_names):
+        old = previous._subscriber_index.get(name)
+        if old is not None:
+            engine.tokens[code], engine.last_refill[code] = previous.tokens[old], previous.last_refill[old]
+    return engine
+
+def history_table(cities, batch, ok):
+    """
+    The readings picked by `ok` as STORE_SCHEMA rows, floored to the hour and keyed by WAQI key:
+    labels are not unique (there are many "Springfield, US"), coordinates are.
+    """
+    rows = batch[ok]
+    return pa.table({
+        'station': [city.waqi_key for city, fetched in zip(cities, ok) if fetched],
+        'timestamp': rows['timestamp'].astype('datetime64[h]').astype('datetime64[s]'),
+        **{column: rows[column] for column in FEATURE_COLUMNS},
+    }, schema=STORE_SCHEMA)
+
+def run_cycle(store, cities, models, history=None, alert_engine=None, max_workers=BATCH_FETCH_WORKERS):
+    """Fetches, forecasts and stores one cycle for `cities`; returns (cities stored, fetch failures)."""
+    if not cities:
+        return 0, 0
+    batch, fetch_errors = get_realtime_batch([city.waqi_key for city in cities], max_workers)
+    ok = np.array([city.waqi_key not in fetch_errors for city in cities], dtype=bool)
+    if history is not None:
+        # Only readings newer than the stored one: a stale or frozen station adds no repeated rows
+        new = ok & (batch['timestamp'] != store.reading_timestamps(cities))
+        if new.any():
+            history.compact_all(history.write(history_table(cities, batch, new)))
+
+    result = forecast_batch(batch, models.models, models.scalers, models.horizons, models.flat_forests)
+    stored = store.write_cycle(cities, batch, fetch_errors, result, models.model_versions)
+
+    if alert_engine is not None:
+        # Subscriptions are keyed by WAQI key (names aren't unique); cities without a forecast (NaN) fire and re-arm nothing
+        alert_engine.evaluate(
+            [city.waqi_key for city in cities for _ in models.horizons],
+            np.tile(models.horizons, len(cities)),
+            np.column_stack([result.forecasts[h] for h in models.horizons]).ravel(),
+        )
+    return stored
+
+def main():
+    parser = argparse.ArgumentParser(description="Materialize forecasts for every tracked city into the forecast store.")
+    parser.add_argument("--db", default=FORECAST_DB)
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="Seconds between full cycles.")
+    parser.add_argument("--poll", type=float, default=DEFAULT_POLL, help="Seconds between checks for newly tracked cities.")
+    parser.add_argument("--once", action="store_true", help="Run one full cycle and exit.")
+    parser.add_argument("--seed-largest", type=int, default=0, help="Also track the N most populous cities.")
+    parser.add_argument("--horizons", nargs="+", type=int, default=forecast_horizons)
+    parser.add_argument("--workers", type=int, default=BATCH_FETCH_WORKERS, help="Concurrent WAQI fetches.")
+    parser.add_argument("--store", default=HISTORY_DIR, help="History store the readings are appended to.")
+    parser.add_argument("--no-history", action="store_true", help="Don't append readings to the history store.")
+    parser.add_argument("--no-alerts", action="store_true", help="Don't evaluate alert subscriptions.")
+    parser.add_argument("--expire-days", type=float, default=DEFAULT_EXPIRE_DAYS,
+                        help="Stop tracking cities nobody has viewed for this many days (0: never).")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    store = ForecastStore(args.db)
+    gazetteer = Gazetteer.load()
+    store.track([city for city in map(gazetteer.lookup, DEFAULT_CITIES) if city is not None], pinned=True)
+    if args.seed_largest:
+        store.track(gazetteer.largest(args.seed_largest), pinned=True)
+    history = None if args.no_history else HistoryStore(args.store)
+    models = Models(args.horizons)
+    alert_engine, rules_mtime = None, None
+
+    next_cycle = time.time()
+    while True:
+        full = time.time() >= next_cycle
+        kind = "Cycle" if full else "Poll"
+        try:
+            models.refresh()
+            if not args.no_alerts:
+                mtime = os.path.getmtime(RULES_FILE) if os.path.exists(RULES_FILE) else None
+                if alert_engine is None or mtime != rules_mtime:
+                    alert_engine, rules_mtime = load_alert_engine(RULES_FILE, alert_engine), mtime
+
+            if full and args.expire_days:
+                expired = store.expire(args.expire_days * DAY)
+                if expired:
+                    logger.info("Stopped tracking %d cities nobody viewed for %g days", expired, args.expire_days)
+            cities = store.tracked() if full else store.pending()
+            if cities:
+                start = time.perf_counter()
+                stored, failed = run_cycle(store, cities, models, history, alert_engine, args.workers)
+                logger.info("%s: %d cities materialized, %d fetches failed, in %.1f s (model bundle %s)",
+                            kind, stored, failed, time.perf_counter() - start, models.version)
+        except Exception:
+            # A locked database, a compaction race or a half-written model must not stop the scheduler
+            if args.once:
+                raise
+            logger.exception("%s failed; carrying on with the schedule", kind)
+        if args.once:
+            break
+        if full:
+            next_cycle += args.interval * max(1, np.ceil((time.time() - next_cycle) / args.interval))
+        time.sleep(max(0.0, min(args.poll, next_cycle - time.time())))
+
+if __name__ == "__main__":
+    main()
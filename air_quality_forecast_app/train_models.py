@@ -1,58 +1,266 @@
+import argparse
+from typing import NamedTuple
 import pandas as pd
 import numpy as np
 from sklearn.preprocessing import StandardScaler
 from sklearn.ensemble import RandomForestRegressor
+from sklearn.inspection import permutation_importance
+from sklearn.model_selection import train_test_split
 import joblib
 import os
 
+from utils.history_store import HistoryStore, HISTORY_DIR, station_codes_of
+from utils.preprocess import FEATURE_COLUMNS
+from utils.model_metadata import MODEL_DIR, model_path, scaler_path, metadata_path, file_version, save_metadata, load_metadata
+
 # Configuration
-MODEL_DIR = 'C:/Users/hp/OneDrive/Documents/python/Cleanair/air_quality_forecast_app/model'
 forecast_horizons = [1, 3, 6, 12]
-FEATURES = ['temperature', 'humidity', 'wind_speed', 'pressure']
-
-# Ensure the model directory exists
-os.makedirs(MODEL_DIR, exist_ok=True)
-
-print("Starting model training with synthetic data...")
-
-# Generate synthetic historical data
-# In a real scenario, you would load your actual historical data here.
-num_samples = 2000 # More samples for better dummy training
+FEATURES = FEATURE_COLUMNS # Same columns (and order) preprocess_data feeds the models at serving time
+HOUR = 3600
+DAY = 24 * HOUR
 
-data = {
-    'pm25': np.random.uniform(0, 200, num_samples),
-    'temperature': np.random.uniform(-10, 40, num_samples),
-    'humidity': np.random.uniform(20, 100, num_samples),
-    'wind_speed': np.random.uniform(0, 20, num_samples),
-    'pressure': np.random.uniform(980, 1040, num_samples),
-}
-historical_df = pd.DataFrame(data)
+# Incremental updates: each refresh fits a few new trees on a recent window of the history store
+# and retires trees fitted on old data, so its cost depends on the window, not on total history
+TREES_PER_UPDATE = 2
+UPDATE_WINDOW_DAYS = 7
+MAX_TREE_AGE_DAYS = 14
+MAX_TREES = 100
+MIN_TREES = 10 # As many as a full retrain fits
+MIN_UPDATE_ROWS = 50
 
-print(f"Generated synthetic historical data with shape: {historical_df.shape}")
-
-# Prepare features (X) and target (y) for training
-X = historical_df[FEATURES]
-
-for horizon in forecast_horizons:
-    print(f"\nTraining for {horizon}-hour forecast...")
+def generate_synthetic_history(num_samples, rng):
+    """Generates synthetic historical data. In a real scenario, you would load your actual historical data here."""
+    return pd.DataFrame({
+        'pm25': rng.uniform(0, 200, num_samples),
+        'temperature': rng.uniform(-10, 40, num_samples),
+        'humidity': rng.uniform(20, 100, num_samples),
+        'wind_speed': rng.uniform(0, 20, num_samples),
+        'pressure': rng.uniform(980, 1040, num_samples),
+    })
 
+def synthetic_target(historical_df, rng):
     # For simplicity, let's assume the target for prediction is just a slightly varied current PM2.5
     # In a real scenario, you would shift your PM2.5 column by the horizon for actual future prediction.
     # For dummy training, we'll just add some noise to the current PM2.5.
-    y = historical_df['pm25'] + np.random.normal(0, 5, num_samples) # Target PM2.5 for this horizon
+    return historical_df['pm25'] + rng.normal(0, 5, len(historical_df))
 
-    # Train and save Scaler
+def fit_horizon_model(X, y, n_estimators=10, random_state=42):
+    """Fits the scaler and forest used for every horizon; returns (scaler, model)."""
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
-    scaler_filename = os.path.join(MODEL_DIR, f'data_scaler_{horizon}h.joblib')
-    joblib.dump(scaler, scaler_filename)
-    print(f"Scaler saved to: {scaler_filename}")
+    model = RandomForestRegressor(n_estimators=n_estimators, random_state=random_state) # Reduced n_estimators for faster dummy training
+    model.fit(X_scaled, y)
+    return scaler, model
+
+class HistoryData(NamedTuple):
+    """Every reading in a store read, sorted by time, with its h-hour-ahead PM2.5 target per horizon."""
+    stations: np.ndarray   # City name per station code
+    codes: np.ndarray      # Station code per row
+    times: np.ndarray      # Epoch seconds per row, ascending
+    X: np.ndarray          # Model features per row (missing values as 0, as in preprocess_data)
+    targets: dict          # horizon -> PM2.5 observed exactly h hours later at the same station (NaN if none)
+
+def build_dataset(store, stations=None, start=None, end=None, horizons=forecast_horizons):
+    """Reads the history once and derives the feature matrix and every horizon's targets from it."""
+    table = store.read(stations, start, end, columns=["station", "timestamp"] + FEATURE_COLUMNS)
+    if table.num_rows == 0:
+        raise ValueError("No history in the store for the requested stations and period; run backfill.py first.")
+    names, codes = station_codes_of(table)
+    times = table["timestamp"].to_numpy().astype("datetime64[s]").astype(np.int64)
+    features = np.column_stack([table[c].to_numpy(zero_copy_only=False).astype(np.float64) for c in FEATURE_COLUMNS])
+    pm25 = features[:, FEATURE_COLUMNS.index("pm25")]
+
+    # The store is sorted by (station, timestamp), so (code, time) keys are ascending and each
+    # target is one binary search away
+    keys = codes * (1 << 40) + (times - times.min())
+    targets = {}
+    for horizon in horizons:
+        wanted = keys + horizon * HOUR
+        idx = np.minimum(np.searchsorted(keys, wanted), len(keys) - 1)
+        targets[horizon] = np.where(keys[idx] == wanted, pm25[idx], np.nan)
+
+    order = np.argsort(times, kind="stable")
+    return HistoryData(
+        stations=names,
+        codes=codes[order],
+        times=times[order],
+        X=np.nan_to_num(features[order], nan=0.0),
+        targets={horizon: y[order] for horizon, y in targets.items()},
+    )
+
+def compute_permutation_importance(model, scaler, X, y, n_repeats=5, random_state=42):
+    """Global importance as the mean drop in R² on held-out data when each feature is shuffled."""
+    result = permutation_importance(model, scaler.transform(X), y, n_repeats=n_repeats, random_state=random_state)
+    return {
+        feature: {'mean': float(mean), 'std': float(std)}
+        for feature, mean, std in zip(FEATURES, result.importances_mean, result.importances_std)
+    }
+
+# Metadata fields describing how an artifact was trained, kept when only the importances are refreshed
+TRAINING_FIELDS = ('training_mode', 'data_watermark', 'tree_watermarks', 'update_rows')
+
+def write_metadata(horizon, model, scaler, X_holdout, y_holdout, model_dir=MODEL_DIR, training=None):
+    """
+    Stores the artifact's version, feature list and permutation importance next to the model,
+    plus the `training` fields (mode, data watermark, per-tree watermarks) when given.
+    """
+    metadata = {
+        'model_version': file_version(model_path(horizon, model_dir)),
+        'features': FEATURES,
+        'holdout_rows': len(X_holdout),
+        'permutation_importance': compute_permutation_importance(model, scaler, X_holdout, y_holdout),
+        **(training or {}),
+    }
+    save_metadata(horizon, metadata, model_dir)
+    print(f"Metadata saved to: {metadata_path(horizon, model_dir)}")
+    return metadata
+
+def save_artifact(obj, path):
+    """joblib.dump through a temporary file and a rename, so a running app never loads a half-written file."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(obj, tmp_path)
+    os.replace(tmp_path, path)
 
-    # Train and save Model
-    model = RandomForestRegressor(n_estimators=10, random_state=42) # Reduced n_estimators for faster dummy training
+def train_all(num_samples=2000, model_dir=MODEL_DIR, seed=None):
+    rng = np.random.default_rng(seed)
+    historical_df = generate_synthetic_history(num_samples, rng) # More samples for better dummy training
+    print(f"Generated synthetic historical data with shape: {historical_df.shape}")
+
+    # Prepare features (X) and target (y) for training
+    X = historical_df[FEATURES]
+
+    for horizon in forecast_horizons:
+        print(f"\nTraining for {horizon}-hour forecast...")
+        y = synthetic_target(historical_df, rng) # Target PM2.5 for this horizon
+        X_train, X_holdout, y_train, y_holdout = train_test_split(X, y, test_size=0.2, random_state=42)
+
+        # Train and save Scaler and Model
+        scaler, model = fit_horizon_model(X_train, y_train)
+        save_artifact(scaler, scaler_path(horizon, model_dir))
+        print(f"Scaler saved to: {scaler_path(horizon, model_dir)}")
+        save_artifact(model, model_path(horizon, model_dir))
+        print(f"Model saved to: {model_path(horizon, model_dir)}")
+
+        # Synthetic data has no place in time: no watermark, and the first incremental update replaces these trees
+        write_metadata(horizon, model, scaler, X_holdout, y_holdout, model_dir,
+                       training={'training_mode': 'full', 'data_watermark': None, 'tree_watermarks': None})
+
+    print("\nAll models and scalers trained and saved.")
+
+def update_forest(model, X_scaled, y, watermark, tree_watermarks=None, trees_per_update=TREES_PER_UPDATE,
+                  max_tree_age_days=MAX_TREE_AGE_DAYS, max_trees=MAX_TREES, min_trees=MIN_TREES):
+    """
+    Updates a fitted RandomForestRegressor in place: retires trees whose data watermark is more than
+    max_tree_age_days older than `watermark` (trees without one, from a full synthetic retrain, count
+    as the oldest), then fits trees_per_update new trees on (X_scaled, y) with warm_start (more if
+    needed to keep min_trees), and finally drops the oldest beyond max_trees.
+    Watermarks are epoch seconds; returns the per-tree watermarks of the updated forest.
+    """
+    if not isinstance(model, RandomForestRegressor):
+        raise ValueError(f"Incremental updates need a RandomForestRegressor, not {type(model).__name__}")
+    if tree_watermarks is None or len(tree_watermarks) != len(model.estimators_):
+        tree_watermarks = [None] * len(model.estimators_)
+    cutoff = watermark - max_tree_age_days * DAY
+    keep = [i for i, w in enumerate(tree_watermarks) if w is not None and w >= cutoff]
+    model.estimators_ = [model.estimators_[i] for i in keep]
+    tree_watermarks = [tree_watermarks[i] for i in keep]
+
+    new_trees = max(trees_per_update, min_trees - len(keep))
+    # A fresh seed per update, or warm_start would hand new trees the seeds of retired ones
+    model.set_params(warm_start=True, n_estimators=len(keep) + new_trees, random_state=int(watermark) % (2 ** 31))
     model.fit(X_scaled, y)
-    model_filename = os.path.join(MODEL_DIR, f'air_quality_model_{horizon}h.joblib')
-    joblib.dump(model, model_filename)
-    print(f"Model saved to: {model_filename}")
+    tree_watermarks = (tree_watermarks + [int(watermark)] * new_trees)[-max_trees:]
+    model.estimators_ = model.estimators_[-max_trees:]
+    model.set_params(warm_start=False, n_estimators=len(model.estimators_))
+    return tree_watermarks
+
+def _iso(epoch_seconds):
+    return None if epoch_seconds is None else str(np.datetime64(int(epoch_seconds), "s"))
+
+def _epoch(iso):
+    return None if iso is None else int(np.datetime64(iso, "s").astype(np.int64))
+
+def update_all(store, model_dir=MODEL_DIR, window_days=UPDATE_WINDOW_DAYS, trees_per_update=TREES_PER_UPDATE,
+               max_tree_age_days=MAX_TREE_AGE_DAYS, max_trees=MAX_TREES):
+    """
+    Incrementally updates every horizon's model from the history store. The data watermark is the
+    newest reading in the store; horizons whose metadata already records it are left alone, the
+    others get new trees fitted on the window_days before it (scaled with the existing scaler,
+    so old and new trees see the same feature scale). Returns the horizons updated.
+    """
+    latest = store.latest_timestamp()
+    if latest is None:
+        raise ValueError("No history in the store; run backfill.py first.")
+    watermark = int(latest.astype(np.int64))
+    data = None
+    updated = []
+    for horizon in forecast_horizons:
+        metadata = load_metadata(horizon, model_dir)
+        previous = _epoch(metadata.get('data_watermark'))
+        if previous is not None and previous >= watermark:
+            print(f"{horizon}h model is up to date (data watermark {_iso(previous)}).")
+            continue
+        if data is None:
+            # Readings up to and including the watermark; later writes wait for the next update
+            data = build_dataset(store, start=latest - np.timedelta64(int(window_days * DAY), "s"),
+                                 end=latest + np.timedelta64(1, "s"), horizons=forecast_horizons)
+        y = data.targets[horizon]
+        rows = np.flatnonzero(~np.isnan(y)) # Targets past the watermark aren't known yet
+        if len(rows) < MIN_UPDATE_ROWS:
+            print(f"{horizon}h model: only {len(rows)} readings with known targets in the window; skipped.")
+            continue
+
+        X = pd.DataFrame(data.X[rows], columns=FEATURES)
+        X_train, X_holdout, y_train, y_holdout = train_test_split(X, y[rows], test_size=0.2, random_state=42)
+        model = joblib.load(model_path(horizon, model_dir))
+        scaler = joblib.load(scaler_path(horizon, model_dir))
+        tree_watermarks = [_epoch(w) for w in metadata.get('tree_watermarks') or []]
+        tree_watermarks = update_forest(model, scaler.transform(X_train), y_train, watermark, tree_watermarks,
+                                        trees_per_update, max_tree_age_days, max_trees, min(MIN_TREES, max_trees))
+        save_artifact(model, model_path(horizon, model_dir))
+        print(f"{horizon}h model: updated on {len(X_train):,} readings, {len(tree_watermarks)} trees. "
+              f"Saved to: {model_path(horizon, model_dir)}")
+        write_metadata(horizon, model, scaler, X_holdout, y_holdout, model_dir, training={
+            'training_mode': 'incremental',
+            'data_watermark': _iso(watermark),
+            'tree_watermarks': [_iso(w) for w in tree_watermarks],
+            'update_rows': len(X_train),
+        })
+        updated.append(horizon)
+    return updated
+
+def refresh_metadata(num_samples=500, model_dir=MODEL_DIR, seed=None):
+    """Recomputes metadata for the existing artifacts on a fresh synthetic holdout, without retraining."""
+    rng = np.random.default_rng(seed)
+    for horizon in forecast_horizons:
+        holdout_df = generate_synthetic_history(num_samples, rng)
+        model = joblib.load(model_path(horizon, model_dir))
+        scaler = joblib.load(scaler_path(horizon, model_dir))
+        previous = load_metadata(horizon, model_dir)
+        training = {field: previous[field] for field in TRAINING_FIELDS if field in previous}
+        write_metadata(horizon, model, scaler, holdout_df[FEATURES], synthetic_target(holdout_df, rng), model_dir, training)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the horizon models and store their metadata.")
+    parser.add_argument("--metadata-only", action="store_true", help="Only recompute metadata for the existing models.")
+    parser.add_argument("--incremental", action="store_true", help="Update the existing models with new data from the history store.")
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--store", default=HISTORY_DIR, help="History store read by --incremental.")
+    parser.add_argument("--window-days", type=float, default=UPDATE_WINDOW_DAYS, help="Recent history the new trees are fitted on.")
+    parser.add_argument("--trees-per-update", type=int, default=TREES_PER_UPDATE)
+    parser.add_argument("--max-tree-age-days", type=float, default=MAX_TREE_AGE_DAYS, help="Retire trees fitted on data older than this.")
+    parser.add_argument("--max-trees", type=int, default=MAX_TREES)
+    args = parser.parse_args()
+
+    # Ensure the model directory exists
+    os.makedirs(args.model_dir, exist_ok=True)
 
-print("\nAll models and scalers trained and saved.")
\ No newline at end of file
+    if args.metadata_only:
+        refresh_metadata(model_dir=args.model_dir, seed=args.seed)
+    elif args.incremental:
+        update_all(HistoryStore(args.store), args.model_dir, args.window_days, args.trees_per_update,
+                   args.max_tree_age_days, args.max_trees)
+    else:
+        print("Starting model training with synthetic data...")
+        train_all(model_dir=args.model_dir, seed=args.seed)
@@ -0,0 +1,428 @@
+"""
+Subscription alerting on forecast batches.
+
+Subscribers register rules "notify me when the h-hour PM2.5 forecast for <city> exceeds
+<threshold>" (or reaches an AQI category, which is the same as exceeding the category's
+lower breakpoint). Cities are identified by a unique key (the scheduler's WAQI key), since
+names such as "London" or "Springfield" are shared by many cities; a label per key is kept
+for display only. Rules are kept column-wise and indexed by (city, horizon) group, sorted by
+threshold, so evaluating a forecast batch is one vectorized binary search per forecast: a
+forecast triggers exactly the prefix of its group whose thresholds lie below it. No rule is
+visited unless it fires.
+
+Fired rules then go through:
+  * edge triggering: a rule notifies when it starts firing, not on every cycle it stays above;
+  * de-duplication: one notification per (subscriber, city, horizon), for the highest threshold crossed;
+  * rate limiting: a token bucket per subscriber (`burst` notifications, refilled one per `refill_seconds`).
+    A rule held back by the limit stays armed and notifies on a later cycle if it is still firing.
+
+Surviving notifications are handed to a sink in one columnar NotificationBatch.
+"""
+import argparse
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from utils.aqi import AQI_BREAKPOINTS, AQI_CATEGORIES, NA_CODE
+
+ALERTS_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "alerts")
+RULES_FILE = os.path.join(ALERTS_DIR, "rules.npz")
+NOTIFICATIONS_FILE = os.path.join(ALERTS_DIR, "notifications.jsonl")
+
+def category_threshold(category):
+    """PM2.5 a forecast must exceed to reach an AQI category (name or code 1-5)."""
+    code = AQI_CATEGORIES.index(category) if isinstance(category, str) else int(category)
+    if not 1 <= code < len(AQI_CATEGORIES):
+        raise ValueError(f"Alerts can be set for categories above Good, got {category!r}")
+    return float(AQI_BREAKPOINTS[code - 1])
+
+class Notification(NamedTuple):
+    rule_id: int
+    subscriber: str
+    city: str
+    horizon: int
+    forecast: float
+    threshold: float
+    category: str  # AQI category the rule was set for, or "" for a plain threshold
+    sent_at: float
+
+    def message(self):
+        target = self.category or f"{self.threshold:g} µg/m³"
+        return f"{self.city}: PM2.5 forecast {self.forecast:.1f} µg/m³ in {self.horizon}h exceeds {target}"
+
+class NotificationBatch:
+    """One cycle's notifications as parallel arrays; records are only materialised on demand."""
+
+    FIELDS = Notification._fields
+
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.columns["rule_id"])
+
+    def __iter__(self):
+        return self.records()
+
+    def records(self):
+        for row in zip(*(self.columns[f].tolist() for f in self.FIELDS)):
+            yield Notification(*row)
+
+    def to_frame(self):
+        return pd.DataFrame(self.columns, columns=self.FIELDS)
+
+class FileSink:
+    """Appends notifications to a JSON-lines file (a local stand-in for an email/push gateway)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def deliver(self, batch):
+        lines = "".join(json.dumps(n._asdict(), ensure_ascii=False) + "\n" for n in batch)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+class QueueSink:
+    """Puts each notification on a queue.Queue, for a consumer thread or for tests."""
+
+    def __init__(self, q=None):
+        self.queue = q if q is not None else queue.Queue()
+
+    def deliver(self, batch):
+        for notification in batch:
+            self.queue.put(notification)
+
+class AlertEngine:
+    """
+    Registered alert rules, their index and the per-rule / per-subscriber delivery state.
+    With sink=None, evaluate() only returns each batch and the caller delivers it.
+    """
+
+    def __init__(self, sink, burst=3, refill_seconds=3600.0, clock=time.time):
+        self.sink = sink
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self.clock = clock
+
+        # Rule columns (position = rule id)
+        self.subscriber_codes = np.zeros(0, dtype=np.int64)
+        self.city_codes = np.zeros(0, dtype=np.int64)
+        self.horizons = np.zeros(0, dtype=np.int64)
+        self.thresholds = np.zeros(0, dtype=np.float64)
+        self.categories = np.zeros(0, dtype=np.int64)  # NA_CODE for plain thresholds
+        self.alive = np.zeros(0, dtype=bool)
+        self.active = np.zeros(0, dtype=bool)          # Fired and notified, not yet back below threshold
+
+        self.subscriber_names, self._subscriber_index = [], {}
+        self.city_names, self._city_index = [], {}
+        self.city_labels = {}                          # City key -> display label, where one was given
+        self.tokens = np.zeros(0)
+        self.last_refill = np.zeros(0)
+        self._index = None
+        # Held by add_rules, remove_rules, rules_for, evaluate and saving, so one engine can serve several threads
+        self.lock = threading.RLock()
+
+    # --- Registration ---
+    @staticmethod
+    def _codes(values, names, index):
+        codes = np.empty(len(values), dtype=np.int64)
+        for i, value in enumerate(values):
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(names)
+                names.append(value)
+            codes[i] = code
+        return codes
+
+    def add_rules(self, subscribers, cities, horizons, thresholds=None, categories=None, labels=None):
+        """
+        Registers rules in bulk (one per element; scalars broadcast). Cities are unique keys,
+        optionally with display labels. Give either thresholds (PM2.5, µg/m³) or AQI categories
+        (names or codes) per rule. Returns the new rule ids.
+        """
+        with self.lock:
+            subscribers, cities = np.atleast_1d(subscribers), np.atleast_1d(cities)
+            n = max(len(subscribers), len(cities))
+            subscribers, cities = np.broadcast_to(subscribers, n), np.broadcast_to(cities, n)
+            horizons = np.broadcast_to(np.asarray(horizons, dtype=np.int64), n)
+            if categories is not None:
+                categories = np.broadcast_to(np.atleast_1d(categories), n)
+                category_codes = np.array([AQI_CATEGORIES.index(c) if isinstance(c, str) else int(c) for c in categories], dtype=np.int64)
+                thresholds = np.array([category_threshold(c) for c in category_codes])
+            elif thresholds is not None:
+                thresholds = np.broadcast_to(np.asarray(thresholds, dtype=np.float64), n)
+                category_codes = np.full(n, NA_CODE, dtype=np.int64)
+            else:
+                raise ValueError("Give either thresholds or categories for the rules")
+
+            if labels is not None:
+                self.city_labels.update((c, l) for c, l in zip(cities.tolist(), np.broadcast_to(np.atleast_1d(labels), n).tolist()) if l)
+            subscriber_codes = self._codes(subscribers.tolist(), self.subscriber_names, self._subscriber_index)
+            first_id = len(self.thresholds)
+            self.subscriber_codes = np.concatenate([self.subscriber_codes, subscriber_codes])
+            self.city_codes = np.concatenate([self.city_codes, self._codes(cities.tolist(), self.city_names, self._city_index)])
+            self.horizons = np.concatenate([self.horizons, horizons])
+            self.thresholds = np.concatenate([self.thresholds, thresholds])
+            self.categories = np.concatenate([self.categories, category_codes])
+            self.alive = np.concatenate([self.alive, np.ones(n, dtype=bool)])
+            self.active = np.concatenate([self.active, np.zeros(n, dtype=bool)])
+            new_subscribers = len(self.subscriber_names) - len(self.tokens)
+            self.tokens = np.concatenate([self.tokens, np.full(new_subscribers, float(self.burst))])
+            self.last_refill = np.concatenate([self.last_refill, np.full(new_subscribers, self.clock())])
+            self._index = None
+            return np.arange(first_id, first_id + n)
+
+    def add_rule(self, subscriber, city, horizon, threshold=None, category=None, label=None):
+        if category is not None:
+            return int(self.add_rules(subscriber, city, horizon, categories=[category], labels=label)[0])
+        return int(self.add_rules(subscriber, city, horizon, thresholds=threshold, labels=label)[0])
+
+    def city_label(self, city):
+        return self.city_labels.get(city, city)
+
+    def remove_rules(self, rule_ids):
+        with self.lock:
+            self.alive[np.asarray(rule_ids, dtype=np.int64)] = False
+            self._index = None
+
+    def rules_for(self, subscriber):
+        """A subscriber's live rules as a DataFrame."""
+        with self.lock:
+            code = self._subscriber_index.get(subscriber)
+            ids = np.flatnonzero(self.alive & (self.subscriber_codes == code)) if code is not None else np.zeros(0, dtype=np.int64)
+            return pd.DataFrame({
+                "rule_id": ids,
+                "city": [self.city_label(self.city_names[c]) for c in self.city_codes[ids]],
+                "horizon": self.horizons[ids],
+                "threshold": self.thresholds[ids],
+                "category": [AQI_CATEGORIES[c] if c != NA_CODE else "" for c in self.categories[ids]],
+            })
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    # --- Index ---
+    def _build_index(self):
+        """
+        Sorts live rules by (city, horizon) group, then threshold. Thresholds are replaced by
+        their rank among the distinct thresholds, so (group, rank) packs into one int64 key and
+        a whole forecast batch is located with a single searchsorted.
+        """
+        ids = np.flatnonzero(self.alive)
+        horizon_values = np.unique(self.horizons[ids])
+        unique_thresholds, ranks = np.unique(self.thresholds[ids], return_inverse=True)
+        groups = self.city_codes[ids] * len(horizon_values) + np.searchsorted(horizon_values, self.horizons[ids])
+        span = len(unique_thresholds) + 1
+        keys = groups * span + ranks
+        order = np.argsort(keys, kind="stable")
+        self._index = {
+            "rule_ids": ids[order],
+            "keys": keys[order],
+            "horizon_values": horizon_values,
+            "unique_thresholds": unique_thresholds,
+            "span": span,
+        }
+        return self._index
+
+    # --- Evaluation ---
+    def _fired(self, cities, horizons, values):
+        """
+        Fired rule ids and, aligned with them, the forecast that fired each; plus the (city,
+        horizon) groups that got a forecast at all.
+        """
+        index = self._index or self._build_index()
+        values = np.asarray(values, dtype=np.float64)
+        horizons = np.asarray(horizons, dtype=np.int64)
+        city_codes = np.array([self._city_index.get(c, -1) for c in cities], dtype=np.int64)
+        horizon_pos = np.searchsorted(index["horizon_values"], horizons)
+        known = (city_codes >= 0) & (horizon_pos < len(index["horizon_values"])) & ~np.isnan(values)
+        known[known] &= index["horizon_values"][horizon_pos[known]] == horizons[known]
+        if not known.any() or len(index["keys"]) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0, dtype=np.int64)
+
+        groups = city_codes[known] * len(index["horizon_values"]) + horizon_pos[known]
+        # Rules in a group fire when their threshold is strictly below the forecast
+        below = np.searchsorted(index["unique_thresholds"], values[known], side="left")
+        span = index["span"]
+        starts = np.searchsorted(index["keys"], groups * span, side="left")
+        ends = np.searchsorted(index["keys"], groups * span + below, side="left")
+        counts = ends - starts
+        total = counts.sum()
+        # Concatenate the ranges [start, end) without a Python loop
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(total)
+        return index["rule_ids"][positions], np.repeat(values[known], counts), groups
+
+    def triggered(self, cities, horizons, values):
+        """Rule ids fired by a forecast batch (parallel sequences of city, horizon and PM2.5 forecast)."""
+        return self._fired(cities, horizons, values)[0]
+
+    def evaluate(self, cities, horizons, values, now=None):
+        """
+        Runs one forecast cycle: finds fired rules, applies edge triggering, de-duplication and
+        rate limiting, delivers the survivors to the sink and returns them as a NotificationBatch.
+        """
+        with self.lock:
+            now = self.clock() if now is None else now
+            fired, forecasts, groups = self._fired(cities, horizons, values)
+
+            # Rules that no longer fire re-arm; rules already notified for this episode stay quiet.
+            # Only groups with a forecast in this batch count: a missing or NaN forecast changes nothing.
+            still_active = self.active[fired]
+            if len(groups):
+                index, groups = self._index, np.unique(groups)
+                starts = np.searchsorted(index["keys"], groups * index["span"], side="left")
+                counts = np.searchsorted(index["keys"], (groups + 1) * index["span"], side="left") - starts
+                positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+                self.active[index["rule_ids"][positions]] = False
+            self.active[fired] = still_active
+            candidates, forecasts = fired[~still_active], forecasts[~still_active]
+
+            if len(candidates):
+                # One notification per (subscriber, city, horizon), for the highest threshold crossed;
+                # the group is packed into one int64 so the sort has two keys rather than four
+                horizon_values = self._index["horizon_values"]
+                group_key = (self.subscriber_codes[candidates] * len(self.city_names) + self.city_codes[candidates]) \
+                    * len(horizon_values) + np.searchsorted(horizon_values, self.horizons[candidates])
+                order = np.lexsort((-self.thresholds[candidates], group_key))
+                members, group_key = candidates[order], group_key[order]
+                first = np.r_[True, group_key[1:] != group_key[:-1]]
+                # Every rule in a duplicate group counts as notified
+                group_id = np.cumsum(first) - 1
+                candidates, forecasts = members[first], forecasts[order][first]
+
+                # Token bucket per subscriber, refilled lazily to `now`
+                subscribers = self.subscriber_codes[candidates]
+                touched = np.unique(subscribers)
+                elapsed = np.maximum(now - self.last_refill[touched], 0.0)
+                self.tokens[touched] = np.minimum(self.burst, self.tokens[touched] + elapsed / self.refill_seconds)
+                self.last_refill[touched] = now
+                # candidates are ordered by subscriber, so rank within each subscriber's run
+                run_start = np.flatnonzero(np.r_[True, subscribers[1:] != subscribers[:-1]])
+                rank = np.arange(len(subscribers)) - np.repeat(run_start, np.diff(np.r_[run_start, len(subscribers)]))
+                allowed = rank < np.floor(self.tokens[subscribers])
+                self.tokens -= np.bincount(subscribers[allowed], minlength=len(self.tokens))
+
+                self.active[members[allowed[group_id]]] = True
+                candidates, forecasts = candidates[allowed], forecasts[allowed]
+
+            batch = self._batch(candidates, forecasts, now)
+            if len(batch) and self.sink is not None:
+                self.sink.deliver(batch)
+            return batch
+
+    def _batch(self, rule_ids, forecasts, now):
+        category_names = np.array(AQI_CATEGORIES + [""], dtype=object)
+        return NotificationBatch({
+            "rule_id": rule_ids,
+            "subscriber": np.array(self.subscriber_names, dtype=object)[self.subscriber_codes[rule_ids]],
+            "city": np.array([self.city_label(c) for c in self.city_names], dtype=object)[self.city_codes[rule_ids]],
+            "horizon": self.horizons[rule_ids],
+            "forecast": forecasts,
+            "threshold": self.thresholds[rule_ids],
+            "category": category_names[self.categories[rule_ids]],
+            "sent_at": np.full(len(rule_ids), float(now)),
+        })
+
+    # --- Persistence ---
+    def _rule_columns(self, ids):
+        return {
+            "subscribers": np.array(self.subscriber_names, dtype=str)[self.subscriber_codes[ids]] if len(ids) else np.zeros(0, dtype=str),
+            "cities": np.array(self.city_names, dtype=str)[self.city_codes[ids]] if len(ids) else np.zeros(0, dtype=str),
+            "labels": np.array([self.city_label(c) for c in self.city_names], dtype=str)[self.city_codes[ids]] if len(ids) else np.zeros(0, dtype=str),
+            "horizons": self.horizons[ids],
+            "thresholds": self.thresholds[ids],
+            "categories": self.categories[ids],
+        }
+
+    def save(self, path):
+        """
+        Stores live rules (not delivery state) so subscriptions survive restarts. The file is
+        replaced atomically, so the scheduler never loads a half-written one.
+        """
+        with self.lock:
+            columns = self._rule_columns(np.flatnonzero(self.alive))
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez_compressed(f, **columns)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def save_rules(self, path, rule_ids):
+        """
+        Adds the given rules to the ones currently saved at path. Holds a lock file while reading
+        and rewriting it, so app workers subscribing at the same time each keep their rules.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX) # Released when the file is closed
+            saved = AlertEngine(sink=None)
+            if os.path.exists(path):
+                saved.load(path)
+            with self.lock:
+                ids = np.asarray(rule_ids, dtype=np.int64)
+                columns = self._rule_columns(ids[self.alive[ids]])
+            if len(columns["thresholds"]):
+                new = saved.add_rules(columns["subscribers"].tolist(), columns["cities"].tolist(), columns["horizons"],
+                                      thresholds=columns["thresholds"], labels=columns["labels"].tolist())
+                saved.categories[new] = columns["categories"]
+            saved.save(path)
+
+    def load(self, path):
+        """Adds the rules stored by save(); returns the new rule ids."""
+        with np.load(path) as data:
+            if len(data["thresholds"]) == 0:
+                return np.zeros(0, dtype=np.int64)
+            labels = data["labels"].tolist() if "labels" in data.files else None # Files saved before labels existed
+            ids = self.add_rules(data["subscribers"].tolist(), data["cities"].tolist(), data["horizons"],
+                                 thresholds=data["thresholds"], labels=labels)
+            self.categories[ids] = data["categories"]
+        return ids
+
+def benchmark(n_rules=1_000_000, n_cities=5000, horizons=(1, 3, 6, 12), n_subscribers=200_000, seed=0):
+    """Times index build and one evaluation cycle over n_rules random rules."""
+    rng = np.random.default_rng(seed)
+    cities = np.array([f"City {i}" for i in range(n_cities)], dtype=object)
+    engine = AlertEngine(sink=None)  # Times the engine alone, not a delivery channel
+    start = time.perf_counter()
+    engine.add_rules(
+        np.array([f"user{i}" for i in rng.integers(0, n_subscribers, n_rules)], dtype=object),
+        cities[rng.integers(0, n_cities, n_rules)],
+        np.array(horizons)[rng.integers(0, len(horizons), n_rules)],
+        thresholds=rng.uniform(10, 200, n_rules).round(),
+    )
+    registered = time.perf_counter()
+    engine._build_index()
+    indexed = time.perf_counter()
+
+    forecast_cities = np.repeat(cities, len(horizons))
+    forecast_horizons = np.tile(horizons, n_cities)
+    results = []
+    for cycle in range(3):
+        values = rng.uniform(0, 250, len(forecast_cities))
+        t = time.perf_counter()
+        batch = engine.evaluate(forecast_cities, forecast_horizons, values, now=cycle * 3600.0)
+        results.append((time.perf_counter() - t, len(batch)))
+    print(f"{n_rules:,} rules: register {registered - start:.2f} s, index {indexed - registered:.3f} s")
+    for cycle, (seconds, sent) in enumerate(results):
+        print(f"  cycle {cycle}: {len(forecast_cities):,} forecasts evaluated in {seconds * 1000:.0f} ms, {sent:,} notifications")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the alert engine on random rules.")
+    parser.add_argument("--rules", type=int, default=1_000_000)
+    parser.add_argument("--cities", type=int, default=5000)
+    args = parser.parse_args()
+    benchmark(args.rules, args.cities)
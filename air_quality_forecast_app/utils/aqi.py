@@ -0,0 +1,17 @@
+import numpy as np
+
+# Upper PM2.5 bound (µg/m³) of each category, matching get_aqi_category in components/map_view.py
+AQI_BREAKPOINTS = np.array([12.0, 35.4, 55.4, 150.4, 250.4])
+AQI_CATEGORIES = ["Good", "Moderate", "Unhealthy for Sensitive Groups", "Unhealthy", "Very Unhealthy", "Hazardous"]
+NA_CODE = -1
+
+def aqi_category_codes(pm25_values):
+    """Vectorized AQI category index (0 = Good ... 5 = Hazardous, -1 for missing values)."""
+    values = np.asarray(pm25_values, dtype=np.float64)
+    codes = np.searchsorted(AQI_BREAKPOINTS, values, side="left")
+    return np.where(np.isnan(values), NA_CODE, codes)
+
+def aqi_category_names(codes):
+    """Maps category codes back to names, with "N/A" for missing values."""
+    names = np.array(AQI_CATEGORIES + ["N/A"], dtype=object)
+    return names[np.asarray(codes)]  # NA_CODE (-1) indexes the trailing "N/A"
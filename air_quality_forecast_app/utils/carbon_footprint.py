@@ -0,0 +1,146 @@
+"""
+Vectorized carbon-footprint engine shared by the interactive estimator and batch uploads.
+
+A factor table maps input columns to kg CO2e per unit plus a multiplier that converts
+the column to a monthly amount (e.g. 1/12 for per-year flight counts). Batch inputs are
+streamed in chunks, so only one chunk plus fixed-size running aggregates is in memory.
+"""
+import numpy as np
+import pandas as pd
+
+# Simple emission factors (these are illustrative and can be refined)
+# Source: EPA, various online calculators (values are approximate)
+DEFAULT_EMISSION_FACTORS = pd.DataFrame(
+    [
+        ("electricity_kwh", "Electricity", "kWh / month", 0.4, 1.0),
+        ("natural_gas_therms", "Natural Gas", "therms / month", 5.3, 1.0),
+        ("car_miles", "Car Travel", "miles / month", 0.17, 1.0),
+        ("bus_miles", "Bus Travel", "miles / month", 0.1, 1.0),
+        ("flights_short", "Short-haul Flights", "flights / year", 100.0, 1 / 12), # Convert yearly to monthly
+        ("flights_long", "Long-haul Flights", "flights / year", 500.0, 1 / 12),
+    ],
+    columns=["column", "activity", "unit", "kg_co2e_per_unit", "monthly_multiplier"],
+)
+
+DEFAULT_CHUNKSIZE = 250_000
+# Histogram edges for the distribution of monthly totals (kg CO2e): 0, then log-spaced 1 kg .. 1,000 t
+HISTOGRAM_EDGES = np.concatenate([[0.0], np.logspace(0, 6, 121)])
+
+def invalid_factors(factors):
+    """Activities whose factor or multiplier is blank or not a finite number (e.g. a cleared editor cell)."""
+    values = factors[["kg_co2e_per_unit", "monthly_multiplier"]].apply(pd.to_numeric, errors="coerce").to_numpy(dtype=np.float64)
+    return factors.loc[~np.isfinite(values).all(axis=1), "activity"].tolist()
+
+def factor_weights(factors=DEFAULT_EMISSION_FACTORS):
+    """
+    Returns (columns, weights) with weights in kg CO2e per unit per month. Raises ValueError
+    for non-finite factors, which would turn every total into NaN.
+    """
+    invalid = invalid_factors(factors)
+    if invalid:
+        raise ValueError(f"Emission factors must be finite numbers; check {', '.join(invalid)}.")
+    weights = factors["kg_co2e_per_unit"].to_numpy(dtype=np.float64) * factors["monthly_multiplier"].to_numpy(dtype=np.float64)
+    return list(factors["column"]), weights
+
+def estimate_footprint(df, factors=DEFAULT_EMISSION_FACTORS):
+    """
+    Computes monthly kg CO2e for every row of df. Columns missing from df, and missing
+    values, count as zero. Returns a DataFrame with one column per activity plus 'total_kg_co2e'.
+    """
+    columns, weights = factor_weights(factors)
+    amounts = np.zeros((len(df), len(columns)))
+    for i, column in enumerate(columns):
+        if column in df.columns:
+            amounts[:, i] = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+    np.nan_to_num(amounts, copy=False)
+    per_activity = amounts * weights
+    result = pd.DataFrame(per_activity, columns=[f"{c}_kg_co2e" for c in columns], index=df.index)
+    result["total_kg_co2e"] = per_activity.sum(axis=1)
+    return result
+
+class FootprintSummary:
+    """Running aggregates over streamed results: moments, extremes, per-activity totals and a histogram."""
+
+    def __init__(self, factors=DEFAULT_EMISSION_FACTORS):
+        self.columns = list(factors["column"])
+        self.rows = 0
+        self.total = 0.0
+        self.sum_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.activity_totals = np.zeros(len(self.columns))
+        self.histogram = np.zeros(len(HISTOGRAM_EDGES), dtype=np.int64)  # Last bin counts values beyond the top edge
+
+    def update(self, result):
+        totals = result["total_kg_co2e"].to_numpy()
+        if len(totals) == 0:
+            return
+        self.rows += len(totals)
+        self.total += totals.sum()
+        self.sum_squares += np.square(totals).sum()
+        self.min = min(self.min, totals.min())
+        self.max = max(self.max, totals.max())
+        self.activity_totals += result[[f"{c}_kg_co2e" for c in self.columns]].to_numpy().sum(axis=0)
+        bins = np.searchsorted(HISTOGRAM_EDGES, totals, side="right") - 1
+        self.histogram += np.bincount(np.clip(bins, 0, len(HISTOGRAM_EDGES) - 1), minlength=len(self.histogram))
+
+    def quantile(self, q):
+        """Approximate quantile, interpolated within the histogram bin that contains it."""
+        if self.rows == 0:
+            return np.nan
+        cumulative = np.cumsum(self.histogram)
+        target = q * self.rows
+        i = int(np.searchsorted(cumulative, target, side="left"))
+        lower = HISTOGRAM_EDGES[i]
+        upper = HISTOGRAM_EDGES[i + 1] if i + 1 < len(HISTOGRAM_EDGES) else self.max
+        before = cumulative[i - 1] if i > 0 else 0
+        fraction = (target - before) / self.histogram[i] if self.histogram[i] else 0.0
+        return float(np.clip(lower + fraction * (upper - lower), self.min, self.max))
+
+    def summary(self):
+        mean = self.total / self.rows if self.rows else np.nan
+        variance = self.sum_squares / self.rows - mean ** 2 if self.rows else np.nan
+        return {
+            "rows": self.rows,
+            "total_kg_co2e": self.total,
+            "mean_kg_co2e": mean,
+            "std_kg_co2e": float(np.sqrt(max(variance, 0.0))) if self.rows else np.nan,
+            "min_kg_co2e": self.min if self.rows else np.nan,
+            "max_kg_co2e": self.max if self.rows else np.nan,
+            **{f"p{int(q * 100)}_kg_co2e": self.quantile(q) for q in (0.1, 0.5, 0.9, 0.99)},
+        }
+
+    def activity_breakdown(self):
+        return pd.DataFrame({"column": self.columns, "total_kg_co2e": self.activity_totals})
+
+    def histogram_df(self):
+        upper = np.append(HISTOGRAM_EDGES[1:], np.inf)
+        df = pd.DataFrame({"lower_kg_co2e": HISTOGRAM_EDGES, "upper_kg_co2e": upper, "count": self.histogram})
+        return df[df["count"] > 0]
+
+def read_chunks(source, file_name, columns, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Yields DataFrame chunks of the requested columns (those present) from a CSV or Parquet
+    file path or file-like object, without loading the whole file.
+    """
+    wanted = set(columns)
+    if file_name.lower().endswith(".parquet"):
+        import pyarrow.parquet as pq # Optional dependency, only needed for Parquet uploads
+        parquet_file = pq.ParquetFile(source)
+        present = [c for c in parquet_file.schema_arrow.names if c in wanted]
+        for batch in parquet_file.iter_batches(batch_size=chunksize, columns=present):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, usecols=lambda c: c in wanted, chunksize=chunksize)
+
+def stream_footprints(source, file_name, factors=DEFAULT_EMISSION_FACTORS, id_column=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Streams a CSV/Parquet dataset through the engine, yielding one per-row result DataFrame
+    per chunk (with id_column carried over when given).
+    """
+    columns = list(factors["column"]) + ([id_column] if id_column else [])
+    for chunk in read_chunks(source, file_name, columns, chunksize):
+        result = estimate_footprint(chunk, factors)
+        if id_column and id_column in chunk.columns:
+            result.insert(0, id_column, chunk[id_column].to_numpy())
+        yield result
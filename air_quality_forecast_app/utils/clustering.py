@@ -0,0 +1,109 @@
+"""
+Supercluster-style hierarchical grid clustering of stations for zoom-aware maps.
+
+Stations are projected to Web Mercator and, starting from the deepest zoom, each
+level merges the level below into grid cells roughly `radius` pixels wide. Every
+zoom level is precomputed once, so rendering a zoom is a lookup plus a viewport
+filter and the number of drawn markers is bounded by the screen, not the data.
+"""
+import numpy as np
+import pandas as pd
+
+from utils.aqi import aqi_category_codes, aqi_category_names
+
+MAX_MERCATOR_LAT = 85.05112878
+TILE_SIZE = 256
+
+def project(lats, lons):
+    """Projects lat/lon degrees to normalized Web Mercator x/y in [0, 1]."""
+    lat = np.radians(np.clip(np.asarray(lats, dtype=np.float64), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT))
+    x = (np.asarray(lons, dtype=np.float64) + 180.0) / 360.0
+    y = 0.5 - np.log(np.tan(np.pi / 4 + lat / 2)) / (2 * np.pi)
+    return x, y
+
+def unproject(x, y):
+    """Inverse of project."""
+    lon = np.asarray(x) * 360.0 - 180.0
+    lat = np.degrees(2 * np.arctan(np.exp((0.5 - np.asarray(y)) * 2 * np.pi)) - np.pi / 2)
+    return lat, lon
+
+def fit_view(lats, lons, width_px=1000, height_px=500, max_zoom=16):
+    """Center (lat, lon) and the deepest whole zoom at which all points fit a map of the given pixel size."""
+    x, y = project(lats, lons)
+    if len(x) == 0:
+        return 0.0, 0.0, 0
+    span_x, span_y = max(x.max() - x.min(), 1e-9), max(y.max() - y.min(), 1e-9)
+    zoom = np.floor(np.log2(min(width_px / (TILE_SIZE * span_x), height_px / (TILE_SIZE * span_y))))
+    center_lat, center_lon = unproject((x.max() + x.min()) / 2, (y.max() + y.min()) / 2)
+    return float(center_lat), float(center_lon), int(np.clip(zoom, 0, max_zoom))
+
+def _cluster_level(level, cell):
+    """Merges one level's points into a grid of `cell`-sized (normalized units) clusters."""
+    ncols = int(np.ceil(1.0 / cell)) + 1
+    cell_ids = np.floor(level["x"] / cell).astype(np.int64) * ncols + np.floor(level["y"] / cell).astype(np.int64)
+
+    order = np.argsort(cell_ids, kind="stable")
+    sorted_ids = cell_ids[order]
+    starts = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    if len(starts) == len(cell_ids):
+        return level  # Nothing merges at this zoom; share the finer level
+
+    count = np.add.reduceat(level["count"][order], starts)
+    valid = np.add.reduceat(level["valid"][order], starts)
+    return {
+        "x": np.add.reduceat((level["x"] * level["count"])[order], starts) / count,
+        "y": np.add.reduceat((level["y"] * level["count"])[order], starts) / count,
+        "count": count,
+        "valid": valid,
+        "total": np.add.reduceat(level["total"][order], starts),
+        "max": np.maximum.reduceat(level["max"][order], starts),
+        "worst": np.maximum.reduceat(level["worst"][order], starts),
+    }
+
+class StationClusterIndex:
+    """Precomputed clusters for every zoom level from min_zoom to max_zoom (stations beyond)."""
+
+    def __init__(self, lats, lons, pm25_values, min_zoom=0, max_zoom=16, radius=60):
+        values = np.asarray(pm25_values, dtype=np.float64)
+        has_value = ~np.isnan(values)
+        x, y = project(lats, lons)
+        level = {
+            "x": x,
+            "y": y,
+            "count": np.ones(len(values)),
+            "valid": has_value.astype(np.float64),
+            "total": np.where(has_value, values, 0.0),
+            "max": np.where(has_value, values, -np.inf),
+            "worst": aqi_category_codes(values),
+        }
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.levels = {max_zoom + 1: level}  # Individual stations
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            level = _cluster_level(level, radius / (TILE_SIZE * 2.0 ** zoom))
+            self.levels[zoom] = level
+
+    def clusters(self, zoom, bounds=None):
+        """
+        Returns the clusters for `zoom` as a DataFrame, optionally limited to
+        bounds = (lat_min, lat_max, lon_min, lon_max).
+        """
+        level = self.levels[int(np.clip(np.floor(zoom), self.min_zoom, self.max_zoom + 1))]
+        lat, lon = unproject(level["x"], level["y"])
+        mask = slice(None)
+        if bounds is not None:
+            lat_min, lat_max, lon_min, lon_max = bounds
+            mask = (lat >= lat_min) & (lat <= lat_max) & (lon >= lon_min) & (lon <= lon_max)
+
+        valid = level["valid"][mask]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(valid > 0, level["total"][mask] / valid, np.nan)
+        max_pm25 = level["max"][mask]
+        return pd.DataFrame({
+            "Latitude": lat[mask],
+            "Longitude": lon[mask],
+            "Count": level["count"][mask].astype(np.int64),
+            "Mean PM2.5": mean,
+            "Max PM2.5": np.where(np.isfinite(max_pm25), max_pm25, np.nan),
+            "AQI_Category": aqi_category_names(level["worst"][mask]),
+        })
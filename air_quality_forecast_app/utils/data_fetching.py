@@ -1,39 +1,90 @@
-import pandas as pd
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 import requests
 
-WAQI_API_TOKEN = "de2414f3929aab0fdca4e231434fd227c29a7bce"
+from utils.observations import Observation, empty_batch, waqi_timestamp
+from utils.preprocess import FEATURE_COLUMNS
+
+WAQI_API_TOKEN = os.getenv("WAQI_API_TOKEN")
+# Point this at the local replay stub (utils/waqi_stub.py) to avoid hitting the real API
+WAQI_BASE_URL = os.getenv("WAQI_BASE_URL", "https://api.waqi.info")
+# When set, every successful /feed/ response is also written to this directory for later replay
+WAQI_RECORD_DIR = os.getenv("WAQI_RECORD_DIR")
+REQUEST_TIMEOUT = 10  # seconds
+# Concurrent /feed/ requests made by get_realtime_batch
+BATCH_FETCH_WORKERS = 16
+
+def recording_name(city):
+    """Maps a /feed/ key (a city name or a geo:lat;lon key) to a filesystem-safe recording name."""
+    return re.sub(r"[^a-z0-9.\-]+", "_", city.strip().lower())
+
+def feed_recording_path(record_dir, city):
+    """Returns the file a /feed/{city}/ response is recorded to and replayed from."""
+    return os.path.join(record_dir, f"{recording_name(city)}.json")
+
+def record_feed(city, data, record_dir):
+    """Writes a raw WAQI /feed/ response to disk so the replay stub can serve it."""
+    os.makedirs(record_dir, exist_ok=True)
+    with open(feed_recording_path(record_dir, city), "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+def require_token():
+    """Raises if no WAQI token is configured; get one at https://aqicn.org/data-platform/token/."""
+    if not WAQI_API_TOKEN:
+        raise RuntimeError("WAQI_API_TOKEN is not set. Export your WAQI API token (any value works against the replay stub).")
+
+def fetch_feed(city):
+    """Fetches the raw WAQI /feed/{city}/ JSON response."""
+    require_token()
+    url = f"{WAQI_BASE_URL}/feed/{city}/?token={WAQI_API_TOKEN}"
+    response = requests.get(url, timeout=REQUEST_TIMEOUT)
+    response.raise_for_status()  # Raise an exception for HTTP errors
+    data = response.json()
+    if WAQI_RECORD_DIR and data and data.get("status") == "ok":
+        record_feed(city, data, WAQI_RECORD_DIR)
+    return data
 
 def get_realtime_data(city):
+    """Fetches the latest reading for a /feed/ key. Returns (Observation, None) or (None, error message)."""
+    data = None
     try:
-        url = f"https://api.waqi.info/feed/{city}/?token={WAQI_API_TOKEN}"
-        response = requests.get(url)
-        response.raise_for_status()  # Raise an exception for HTTP errors
-        data = response.json()
+        data = fetch_feed(city)
 
         if data and data["status"] == "ok":
             iaqi = data["data"]["iaqi"]
-            # Extract relevant parameters, handling missing ones
-            pm25 = iaqi["pm25"]["v"] if "pm25" in iaqi else None
-            temperature = iaqi["t"]["v"] if "t" in iaqi else None
-            humidity = iaqi["h"]["v"] if "h" in iaqi else None
-            wind_speed = iaqi["w"]["v"] if "w" in iaqi else None
-            pressure = iaqi["p"]["v"] if "p" in iaqi else None
-
-            # Create a DataFrame
-            df = pd.DataFrame({
-                'pm25': [pm25],
-                'temperature': [temperature],
-                'humidity': [humidity],
-                'wind_speed': [wind_speed],
-                'pressure': [pressure],
-                'timestamp': [pd.to_datetime('now')]
-            })
-            return df, None
+            # Extract relevant parameters into a compact record; missing ones become NaN.
+            # Stamped with the station's measurement time, not the time of the fetch.
+            return Observation.from_waqi(city, iaqi, waqi_timestamp(data["data"].get("time"))), None
         else:
-            return None, f"Error fetching data from WAQI: {data.get("data", "Unknown error")}"
+            return None, f"Error fetching data from WAQI: {data.get('data', 'Unknown error')}"
     except requests.exceptions.RequestException as e:
         return None, f"Network or API error: {e}"
     except KeyError as e:
         return None, f"Error parsing WAQI data (missing key): {e}. Response: {data}"
     except Exception as e:
-        return None, f"An unexpected error occurred: {e}"
\ No newline at end of file
+        return None, f"An unexpected error occurred: {e}"
+
+def get_realtime_batch(cities, max_workers=BATCH_FETCH_WORKERS):
+    """
+    Fetches the latest reading for many /feed/ keys concurrently. Returns (batch, errors): an
+    OBSERVATION_DTYPE array in the order of `cities` (all-NaN measurements where a fetch
+    failed) and {city: error message} for the failures.
+    """
+    require_token() # Fail once, clearly, rather than once per city
+    batch = empty_batch(len(cities))
+    batch['station'] = cities
+    batch['timestamp'] = np.datetime64('NaT')
+    for column in FEATURE_COLUMNS:
+        batch[column] = np.nan
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(cities)))) as executor:
+        for i, (observation, error_message) in enumerate(executor.map(get_realtime_data, cities)):
+            if observation is None:
+                errors[cities[i]] = error_message
+            else:
+                batch[i] = observation.to_record()
+    return batch, errors
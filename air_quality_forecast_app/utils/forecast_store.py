@@ -0,0 +1,284 @@
+"""
+Materialized forecasts, written by materialize_forecasts.py and read by the app.
+
+For every tracked city the store keeps the latest reading and, per horizon, the forecast,
+its 80% band and path attributions. Each forecast row also records the model version and the
+timestamp of the reading it was computed from. A scheduler cycle writes all cities in one
+transaction. The database runs in WAL mode, so readers are never blocked and see either the
+previous cycle or the new one. Serving a city is two primary-key lookups; no model runs in
+the request path.
+
+The app adds the cities users open to `tracked_cities`. The scheduler picks them up on its
+next poll. Every view refreshes a city's `viewed_at` (at most once per VIEW_REFRESH_SECONDS
+per process), and the scheduler stops tracking cities nobody has viewed for a while. The
+cities the scheduler itself tracks (defaults and seeds) are pinned and never expire.
+"""
+import os
+import sqlite3
+import math
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+from utils.gazetteer import City
+from utils.observations import Observation, empty_batch
+from utils.preprocess import FEATURE_COLUMNS
+
+# Stored as the reason a city that was fetched has no forecast
+NO_PM25_ERROR = "The station reports no PM2.5"
+
+# A process records repeated views of the same city at most this often
+VIEW_REFRESH_SECONDS = 3600
+
+# Polls retry a city whose every fetch so far failed at most this often; full cycles retry it anyway
+PENDING_RETRY_SECONDS = 600
+
+# Keys per `IN (...)` query, under the 999 variables older SQLite builds allow per statement
+KEYS_PER_QUERY = 900
+
+FORECAST_DB = os.getenv("CLEANAIR_FORECAST_DB", os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "forecasts.sqlite"))
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS tracked_cities (
+    city_key TEXT PRIMARY KEY, name TEXT NOT NULL, country TEXT, lat REAL, lon REAL, population INTEGER, added_at REAL,
+    viewed_at REAL, pinned INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS readings (
+    city_key TEXT PRIMARY KEY, timestamp INTEGER, {", ".join(f"{c} REAL" for c in FEATURE_COLUMNS)},
+    fetched_at REAL, error TEXT
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS forecasts (
+    city_key TEXT NOT NULL, horizon INTEGER NOT NULL, forecast REAL, lower REAL, upper REAL,
+    bias REAL, contributions BLOB, model_version TEXT, input_timestamp INTEGER, computed_at REAL,
+    PRIMARY KEY (city_key, horizon)
+) WITHOUT ROWID;
+"""
+
+class CityForecast(NamedTuple):
+    """Everything the city page shows, as materialized by the last cycle that reached the city."""
+    observation: Observation  # None if no reading has been stored yet
+    forecasts: dict           # horizon -> PM2.5 forecast
+    intervals: dict           # horizon -> {0.1: lower, 0.9: upper}
+    attributions: dict        # horizon -> (bias, contributions per FEATURE_COLUMNS)
+    model_versions: dict      # horizon -> model version the forecast came from
+    input_timestamp: object   # datetime64[s] of the reading the forecasts were computed from
+    computed_at: float        # Epoch seconds
+    error: str                # Last fetch error, if the latest attempt failed
+
+class ManyForecasts(NamedTuple):
+    """What the dashboard shows for many cities, aligned with the cities asked for."""
+    batch: np.ndarray         # OBSERVATION_DTYPE; NaT and NaN where no reading is stored
+    forecasts: dict           # horizon -> forecasts (NaN where none)
+    errors: dict              # city_key -> reason, for cities without a reading or whose latest fetch failed
+    fetched_at: np.ndarray    # Epoch seconds the stored reading was fetched (NaN if none)
+
+class ForecastStore:
+    """The SQLite forecast store at `path`; safe to share between threads (one connection each)."""
+
+    def __init__(self, path=FORECAST_DB):
+        self.path = path
+        self._local = threading.local()
+        self._viewed = {}  # city_key -> when this process last recorded a view
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            _migrate(connection)
+            self._local.connection = connection
+        return connection
+
+    # --- Tracked cities ---
+    def track(self, cities, pinned=False):
+        """
+        Adds cities (gazetteer City records) to the set the scheduler materializes, or records
+        that tracked ones were viewed again. Pinned cities never expire.
+        """
+        now = time.time()
+        if not pinned:
+            cities = [c for c in cities if now - self._viewed.get(c.waqi_key, -math.inf) >= VIEW_REFRESH_SECONDS]
+        if not cities:
+            return
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO tracked_cities (city_key, name, country, lat, lon, population, added_at, viewed_at, pinned) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (city_key) DO UPDATE SET "
+                "viewed_at = excluded.viewed_at, pinned = MAX(pinned, excluded.pinned)",
+                [(c.waqi_key, c.name, c.country, c.lat, c.lon, c.population, now, now, int(pinned)) for c in cities],
+            )
+        self._viewed.update((c.waqi_key, now) for c in cities)
+
+    def expire(self, max_idle_seconds, now=None):
+        """Stops tracking unpinned cities nobody has viewed for max_idle_seconds, with their data; returns how many."""
+        cutoff = (time.time() if now is None else now) - max_idle_seconds
+        idle = "SELECT city_key FROM tracked_cities WHERE pinned = 0 AND viewed_at < ?"
+        with self._connection() as connection:
+            connection.execute(f"DELETE FROM forecasts WHERE city_key IN ({idle})", (cutoff,))
+            connection.execute(f"DELETE FROM readings WHERE city_key IN ({idle})", (cutoff,))
+            return connection.execute("DELETE FROM tracked_cities WHERE pinned = 0 AND viewed_at < ?", (cutoff,)).rowcount
+
+    def tracked(self):
+        rows = self._connection().execute(
+            "SELECT name, country, lat, lon, population FROM tracked_cities ORDER BY population DESC, name").fetchall()
+        return [City(*row) for row in rows]
+
+    def pending(self, retry_after=PENDING_RETRY_SECONDS, now=None):
+        """
+        Tracked cities without a stored reading: never reached by a cycle, or every fetch so far
+        failed and the last attempt was more than retry_after seconds ago.
+        """
+        cutoff = (time.time() if now is None else now) - retry_after
+        rows = self._connection().execute(
+            "SELECT t.name, t.country, t.lat, t.lon, t.population FROM tracked_cities t "
+            "LEFT JOIN readings r ON r.city_key = t.city_key "
+            "WHERE r.city_key IS NULL OR (r.timestamp IS NULL AND r.fetched_at < ?)", (cutoff,)).fetchall()
+        return [City(*row) for row in rows]
+
+    # --- Writing ---
+    def write_cycle(self, cities, batch, errors, result, model_versions, computed_at=None):
+        """
+        Stores one cycle in a single transaction: readings and forecasts (a BatchForecast aligned
+        with `cities` and `batch`) for the cities fetched, and the error for the ones that failed.
+        A failed city keeps its previous reading and forecasts (without one, fetched_at records
+        the failed attempt, which pending() backs off on). A reading without PM2.5 is stored
+        with NO_PM25_ERROR and no forecasts, since the models cannot forecast from it.
+        """
+        computed_at = time.time() if computed_at is None else computed_at
+        ok = np.array([c.waqi_key not in errors for c in cities], dtype=bool)
+        timestamps = batch['timestamp'].astype(np.int64)
+        reading_rows, forecast_rows = [], []
+        for i in np.flatnonzero(ok):
+            key = cities[i].waqi_key
+            error = NO_PM25_ERROR if np.isnan(batch['pm25'][i]) else None
+            reading_rows.append((key, int(timestamps[i]), *(_nullable(batch[c][i]) for c in FEATURE_COLUMNS), computed_at, error))
+            for horizon, forecast in result.forecasts.items():
+                band = result.bands.get(horizon)
+                bias, contributions = result.attributions.get(horizon, (None, None))
+                forecast_rows.append((
+                    key, horizon, _nullable(forecast[i]),
+                    None if band is None else _nullable(band[0, i]), None if band is None else _nullable(band[-1, i]),
+                    None if bias is None else float(bias),
+                    None if contributions is None else contributions[i].astype(np.float64).tobytes(),
+                    model_versions.get(horizon), int(timestamps[i]), computed_at,
+                ))
+        error_rows = [(cities[i].waqi_key, computed_at, errors[cities[i].waqi_key]) for i in np.flatnonzero(~ok)]
+
+        with self._connection() as connection:  # One transaction: readers see all of this cycle or none of it
+            placeholders = ", ".join("?" * (len(FEATURE_COLUMNS) + 4))
+            connection.executemany(f"INSERT OR REPLACE INTO readings VALUES ({placeholders})", reading_rows)
+            connection.executemany("INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", forecast_rows)
+            connection.executemany(
+                "INSERT INTO readings (city_key, fetched_at, error) VALUES (?, ?, ?) "
+                "ON CONFLICT (city_key) DO UPDATE SET error = excluded.error, "
+                "fetched_at = CASE WHEN timestamp IS NULL THEN excluded.fetched_at ELSE fetched_at END", error_rows)
+        return len(reading_rows), len(error_rows)
+
+    # --- Reading ---
+    def reading_timestamps(self, cities):
+        """Timestamp of each City's stored reading, as datetime64[s] aligned with `cities` (NaT if none)."""
+        keys = [c.waqi_key for c in cities]
+        stored = dict(_select_keys(self._connection(), "SELECT city_key, timestamp FROM readings", keys))
+        return np.array([np.datetime64('NaT') if stored.get(key) is None else np.datetime64(stored[key], 's') for key in keys],
+                        dtype='datetime64[s]')
+
+    def read(self, city):
+        """The materialized reading and forecasts for one City, or None if none is stored yet."""
+        connection = self._connection()
+        reading = connection.execute(
+            f"SELECT timestamp, {', '.join(FEATURE_COLUMNS)}, error FROM readings WHERE city_key = ?", (city.waqi_key,)).fetchone()
+        if reading is None:
+            return None
+        rows = connection.execute(
+            "SELECT horizon, forecast, lower, upper, bias, contributions, model_version, input_timestamp, computed_at "
+            "FROM forecasts WHERE city_key = ? ORDER BY horizon", (city.waqi_key,)).fetchall()
+
+        timestamp, *values, error = reading
+        observation = None if timestamp is None else Observation(city.waqi_key, np.datetime64(timestamp, "s"), *values)
+        forecasts, intervals, attributions, versions = {}, {}, {}, {}
+        input_timestamp = computed_at = None
+        for horizon, forecast, lower, upper, bias, contributions, version, input_timestamp, computed_at in rows:
+            if forecast is not None:
+                forecasts[horizon] = forecast
+            if lower is not None and upper is not None:
+                intervals[horizon] = {0.1: lower, 0.9: upper}
+            if contributions is not None:
+                attributions[horizon] = (bias, np.frombuffer(contributions, dtype=np.float64))
+            versions[horizon] = version
+        return CityForecast(
+            observation, forecasts, intervals, attributions, versions,
+            None if input_timestamp is None else np.datetime64(input_timestamp, "s"), computed_at, error,
+        )
+
+    def read_many(self, cities, horizons):
+        """
+        Readings and forecasts for many cities in two queries per KEYS_PER_QUERY cities, as
+        ManyForecasts aligned with `cities`. Cities without a stored reading get NaN and a reason;
+        cities whose latest fetch failed keep their last reading and get the stored error.
+        """
+        keys = [c.waqi_key for c in cities]
+        position = {key: i for i, key in enumerate(keys)}
+        batch = empty_batch(len(keys))
+        batch['station'] = keys
+        batch['timestamp'] = np.datetime64('NaT')
+        for column in FEATURE_COLUMNS:
+            batch[column] = np.nan
+        forecasts = {h: np.full(len(keys), np.nan) for h in horizons}
+        fetched_at = np.full(len(keys), np.nan)
+        errors = dict.fromkeys(keys, "Not materialized yet")
+
+        connection = self._connection()
+        for key, timestamp, *values, fetched, error in _select_keys(
+                connection, f"SELECT city_key, timestamp, {', '.join(FEATURE_COLUMNS)}, fetched_at, error FROM readings", keys):
+            if timestamp is not None:
+                batch[position[key]] = (key, np.datetime64(timestamp, "s"), *(np.nan if v is None else v for v in values))
+                fetched_at[position[key]] = fetched
+            if error is not None:
+                errors[key] = error
+            elif timestamp is not None:
+                del errors[key]
+        for key, horizon, forecast in _select_keys(connection, "SELECT city_key, horizon, forecast FROM forecasts", keys):
+            if horizon in forecasts and forecast is not None:
+                forecasts[horizon][position[key]] = forecast
+        return ManyForecasts(batch, forecasts, errors, fetched_at)
+
+    def stations(self, horizon=1):
+        """
+        Every tracked city with a stored `horizon` forecast, as a map-style DataFrame (key, City,
+        Latitude, Longitude, PM2.5): the real station set for maps and spatial interpolation.
+        """
+        return pd.read_sql_query(
+            "SELECT t.city_key AS key, t.name || ', ' || t.country AS City, t.lat AS Latitude, t.lon AS Longitude, "
+            "f.forecast AS \"PM2.5\" FROM tracked_cities t JOIN forecasts f ON f.city_key = t.city_key "
+            "WHERE f.horizon = ? AND f.forecast IS NOT NULL ORDER BY t.population DESC",
+            self._connection(), params=(horizon,))
+
+def _migrate(connection):
+    """Adds the view-tracking columns to a store created before they existed."""
+    def columns():
+        return {row[1] for row in connection.execute("PRAGMA table_info(tracked_cities)")}
+    if {"viewed_at", "pinned"} <= columns():
+        return
+    with connection:
+        connection.execute("BEGIN IMMEDIATE") # Serializes processes migrating the same file
+        existing = columns()
+        if "viewed_at" not in existing:
+            connection.execute("ALTER TABLE tracked_cities ADD COLUMN viewed_at REAL")
+            connection.execute("UPDATE tracked_cities SET viewed_at = added_at")
+        if "pinned" not in existing:
+            connection.execute("ALTER TABLE tracked_cities ADD COLUMN pinned INTEGER NOT NULL DEFAULT 0")
+
+def _select_keys(connection, select, keys):
+    """Yields the rows of `select` for the given city keys, a chunk of KEYS_PER_QUERY keys per query."""
+    for start in range(0, len(keys), KEYS_PER_QUERY):
+        chunk = keys[start:start + KEYS_PER_QUERY]
+        yield from connection.execute(f"{select} WHERE city_key IN ({', '.join('?' * len(chunk))})", chunk)
+
+def _nullable(value):
+    return None if np.isnan(value) else float(value)
@@ -0,0 +1,38 @@
+"""
+Batch inference over an OBSERVATION_DTYPE array: every city's forecast for a horizon comes
+out of one scale-and-predict pass. Used by the materialization scheduler, so the app itself
+never runs a model to serve a page.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+from utils.preprocess import feature_matrix, scale_features
+
+DEFAULT_QUANTILES = (0.1, 0.9)  # The 80% band shown next to each forecast
+
+class BatchForecast(NamedTuple):
+    forecasts: dict      # horizon -> forecast per row (NaN for failed fetches and readings without PM2.5)
+    bands: dict          # horizon -> (len(quantiles), n) tree quantiles; only for flattened forests
+    attributions: dict   # horizon -> (bias, contributions of shape (n, n_features)); only for flattened forests
+
+def forecast_batch(batch, models, scalers, horizons, flat_forests=None, quantiles=DEFAULT_QUANTILES):
+    """
+    Forecasts, quantile bands and path attributions for every reading in the batch. Rows of
+    failed fetches (no timestamp) and of stations reporting no PM2.5 get NaN; other missing
+    measurements are filled as feature_matrix does.
+    """
+    features = feature_matrix(batch)
+    missing = np.isnat(batch['timestamp']) | np.isnan(batch['pm25'])
+    forecasts, bands, attributions = {}, {}, {}
+    for horizon in horizons:
+        scaled = scale_features(scalers[horizon], features)
+        flat_forest = flat_forests.get(horizon) if flat_forests else None
+        if flat_forest is not None:
+            forecast, band = flat_forest.predict_quantiles(scaled, quantiles)
+            bands[horizon] = np.where(missing, np.nan, band)
+            attributions[horizon] = flat_forest.path_attributions(scaled)
+        else:
+            forecast = models[horizon].predict(scaled)
+        forecasts[horizon] = np.where(missing, np.nan, forecast)
+    return BatchForecast(forecasts, bands, attributions)
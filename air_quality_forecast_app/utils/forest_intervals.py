@@ -0,0 +1,106 @@
+import numpy as np
+
+DEFAULT_QUANTILES = (0.1, 0.5, 0.9)
+# Node arrays that fully describe a flattened forest (see to_arrays / from_arrays)
+NODE_ARRAYS = ("roots", "left", "right", "feature", "threshold", "value")
+
+class FlatForest:
+    """
+    A fitted tree ensemble (e.g. RandomForestRegressor) flattened into one set of node
+    arrays, so every tree's prediction for a whole batch comes out of a single vectorized
+    descent instead of a Python loop over `estimators_`.
+    """
+
+    def __init__(self, forest):
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+
+        lefts, rights, features, thresholds, values = [], [], [], [], []
+        for tree, offset in zip(trees, offsets):
+            node_ids = np.arange(tree.node_count) + offset
+            is_leaf = tree.children_left == -1
+            # Leaves point at themselves, so the descent can run a fixed number of steps without masking
+            lefts.append(np.where(is_leaf, node_ids, tree.children_left + offset))
+            rights.append(np.where(is_leaf, node_ids, tree.children_right + offset))
+            features.append(np.where(is_leaf, 0, tree.feature))
+            thresholds.append(np.where(is_leaf, np.inf, tree.threshold))
+            values.append(tree.value[:, 0, 0])
+
+        self.roots = offsets.astype(np.intp)
+        self.left = np.concatenate(lefts).astype(np.intp)
+        self.right = np.concatenate(rights).astype(np.intp)
+        self.feature = np.concatenate(features).astype(np.intp)
+        self.threshold = np.concatenate(thresholds)
+        self.value = np.concatenate(values)
+        self.max_depth = max(tree.max_depth for tree in trees)
+        self.n_trees = len(trees)
+        self.n_features = forest.n_features_in_
+        self.feature_importances_ = getattr(forest, "feature_importances_", None)
+
+    @classmethod
+    def from_arrays(cls, arrays, max_depth, n_features, feature_importances=None):
+        """
+        Rebuilds a flattened forest around existing node arrays without copying them,
+        e.g. read-only memory maps shared between processes.
+        """
+        flat = cls.__new__(cls)
+        for name in NODE_ARRAYS:
+            setattr(flat, name, np.asarray(arrays[name]))
+        flat.max_depth = int(max_depth)
+        flat.n_trees = len(flat.roots)
+        flat.n_features = int(n_features)
+        flat.feature_importances_ = None if feature_importances is None else np.asarray(feature_importances)
+        return flat
+
+    def to_arrays(self):
+        return {name: getattr(self, name) for name in NODE_ARRAYS}
+
+    def predict_all(self, X):
+        """Returns every tree's prediction, shape (n_samples, n_trees)."""
+        # sklearn compares float32 features against float64 thresholds; match it exactly
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        rows = np.arange(len(X))[:, None]
+        nodes = np.broadcast_to(self.roots, (len(X), self.n_trees))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.value[nodes]
+
+    def predict(self, X):
+        """Forest mean prediction (equivalent to the wrapped model's predict)."""
+        return self.predict_all(X).mean(axis=1)
+
+    def predict_quantiles(self, X, quantiles=DEFAULT_QUANTILES):
+        """Returns (mean, bands) where bands has shape (len(quantiles), n_samples)."""
+        per_tree = self.predict_all(X)
+        return per_tree.mean(axis=1), np.quantile(per_tree, quantiles, axis=1)
+
+    def path_attributions(self, X):
+        """
+        Local feature attributions for a batch, computed along each sample's decision paths
+        (the Saabas approximation to TreeSHAP): every split credits its feature with the change
+        in node value it causes. Returns (bias, contributions) with contributions of shape
+        (n_samples, n_features), where bias + contributions.sum(axis=1) equals the forest prediction.
+        """
+        X = np.asarray(X, dtype=np.float32).astype(np.float64)
+        n_samples = len(X)
+        rows = np.arange(n_samples)[:, None]
+        nodes = np.broadcast_to(self.roots, (n_samples, self.n_trees))
+        contributions = np.zeros(n_samples * self.n_features)
+        for _ in range(self.max_depth):
+            features = self.feature[nodes]
+            go_left = X[rows, features] <= self.threshold[nodes]
+            next_nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            # Leaves map to themselves, so they contribute zero
+            delta = self.value[next_nodes] - self.value[nodes]
+            contributions += np.bincount((rows * self.n_features + features).ravel(), weights=delta.ravel(),
+                                         minlength=contributions.size)
+            nodes = next_nodes
+        bias = self.value[self.roots].mean()
+        return bias, contributions.reshape(n_samples, self.n_features) / self.n_trees
+
+def flatten_forest(model):
+    """Returns a FlatForest for tree-ensemble models, or None for anything else."""
+    if hasattr(model, "estimators_") and all(hasattr(e, "tree_") for e in model.estimators_):
+        return FlatForest(model)
+    return None
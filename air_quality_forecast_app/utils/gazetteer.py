@@ -0,0 +1,173 @@
+"""
+Local world-city gazetteer with a sorted prefix index for type-ahead search.
+
+The bundled data/world_cities.npz is built from the GeoNames cities1000 dump
+(https://download.geonames.org/export/dump/, CC BY 4.0). To rebuild it:
+
+    python -m utils.gazetteer cities1000.txt data/world_cities.npz
+"""
+import argparse
+import os
+import unicodedata
+from typing import NamedTuple
+
+import numpy as np
+
+GAZETTEER_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "world_cities.npz")
+# Index keys are truncated to this many bytes; ~99% of folded names fit, longer queries are re-checked
+KEY_WIDTH = 24
+# Offered before the user searches, and always materialized by materialize_forecasts.py
+DEFAULT_CITIES = ["Delhi", "London", "Beijing", "New York City", "Tokyo"]
+
+def fold_name(name):
+    """Normalizes a place name for indexing: strips accents, casefolds and collapses whitespace."""
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.casefold().split())
+
+class City(NamedTuple):
+    name: str
+    country: str
+    lat: float
+    lon: float
+    population: int
+
+    @property
+    def label(self):
+        return f"{self.name}, {self.country}"
+
+    @property
+    def waqi_key(self):
+        """Key for the WAQI /feed/{key}/ endpoint: the station nearest to the city's coordinates."""
+        return f"geo:{self.lat:.4f};{self.lon:.4f}"
+
+class Gazetteer:
+    """
+    Array-backed city table. Rows are stored sorted by folded name (ties by descending
+    population), so a prefix query is two binary searches over the fixed-width `keys` array.
+    """
+
+    def __init__(self, keys, names_blob, name_offsets, lats, lons, populations, countries):
+        self.keys = keys
+        self._names_blob = names_blob
+        self._name_offsets = name_offsets
+        self.lats = lats
+        self.lons = lons
+        self.populations = populations
+        self.countries = countries
+
+    @classmethod
+    def load(cls, path=GAZETTEER_PATH):
+        with np.load(path) as data:
+            return cls(
+                data["keys"], data["names_blob"].tobytes(), data["name_offsets"],
+                data["lats"], data["lons"], data["populations"], data["countries"],
+            )
+
+    def __len__(self):
+        return len(self.keys)
+
+    def city(self, row):
+        """Materializes one row as a City record."""
+        return City(
+            name=self._name(row),
+            country=self.countries[row].decode("ascii"),
+            lat=float(self.lats[row]),
+            lon=float(self.lons[row]),
+            population=int(self.populations[row]),
+        )
+
+    def _name(self, row):
+        start, end = self._name_offsets[row], self._name_offsets[row + 1]
+        return self._names_blob[start:end].decode("utf-8")
+
+    def _prefix_rows(self, folded):
+        """Returns the rows whose folded name starts with `folded`."""
+        key = folded.encode("utf-8")[:KEY_WIDTH]
+        lo = np.searchsorted(self.keys, key, side="left")
+        # 0xFF never occurs in UTF-8, so this bound sorts after every key that starts with `key`
+        hi = np.searchsorted(self.keys, key + b"\xff", side="left")
+        rows = np.arange(lo, hi)
+        if len(folded.encode("utf-8")) >= KEY_WIDTH:
+            # The truncated index only narrows the range; confirm against the full names
+            rows = rows[[fold_name(self._name(row)).startswith(folded) for row in rows]]
+        return rows
+
+    def search(self, prefix, limit=10):
+        """Returns up to `limit` cities whose name starts with `prefix`, most populous first."""
+        folded = fold_name(prefix)
+        if not folded:
+            return []
+        rows = self._prefix_rows(folded)
+        if len(rows) > limit:
+            rows = rows[np.argpartition(-self.populations[rows].astype(np.int64), limit)[:limit]]
+        rows = rows[np.argsort(-self.populations[rows].astype(np.int64), kind="stable")]
+        return [self.city(row) for row in rows]
+
+    def largest(self, n=50):
+        """Returns the n most populous cities, largest first."""
+        n = min(n, len(self))
+        rows = np.argpartition(-self.populations.astype(np.int64), n - 1)[:n] if n else np.zeros(0, dtype=np.int64)
+        rows = rows[np.argsort(-self.populations[rows].astype(np.int64), kind="stable")]
+        return [self.city(row) for row in rows]
+
+    def lookup(self, name, country=None):
+        """Returns the most populous city named exactly `name` (optionally within `country`), or None."""
+        folded = fold_name(name)
+        if not folded:
+            return None
+        rows = self._prefix_rows(folded)
+        rows = rows[self.keys[rows] == folded.encode("utf-8")[:KEY_WIDTH]]
+        best = None
+        for row in rows:
+            if fold_name(self._name(row)) != folded:
+                continue
+            if country is not None and self.countries[row].decode("ascii") != country:
+                continue
+            if best is None or self.populations[row] > self.populations[best]:
+                best = row
+        return None if best is None else self.city(best)
+
+def build_gazetteer(rows, out_path):
+    """
+    Writes a gazetteer file from (name, lat, lon, country_code, population) rows.
+    """
+    rows = [r for r in rows if r[0]]
+    keys = [fold_name(r[0]) for r in rows]
+    order = sorted(range(len(rows)), key=lambda i: (keys[i].encode("utf-8"), -int(rows[i][4])))
+
+    encoded_names = [rows[i][0].encode("utf-8") for i in order]
+    name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int32)
+    name_offsets[1:] = np.cumsum([len(n) for n in encoded_names])
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    np.savez_compressed(
+        out_path,
+        keys=np.array([keys[i].encode("utf-8")[:KEY_WIDTH] for i in order], dtype=f"S{KEY_WIDTH}"),
+        names_blob=np.frombuffer(b"".join(encoded_names), dtype=np.uint8),
+        name_offsets=name_offsets,
+        lats=np.array([float(rows[i][1]) for i in order], dtype=np.float32),
+        lons=np.array([float(rows[i][2]) for i in order], dtype=np.float32),
+        populations=np.array([int(rows[i][4]) for i in order], dtype=np.uint32),
+        countries=np.array([rows[i][3].encode("ascii") for i in order], dtype="S2"),
+    )
+    return len(order)
+
+def read_geonames_dump(path):
+    """Yields (name, lat, lon, country_code, population) from a GeoNames citiesNNNN.txt dump."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            # Columns: 1 name, 4 latitude, 5 longitude, 8 country code, 14 population
+            yield fields[1], fields[4], fields[5], fields[8], fields[14] or 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the bundled city gazetteer from a GeoNames dump.")
+    parser.add_argument("dump", help="GeoNames citiesNNNN.txt file.")
+    parser.add_argument("out", nargs="?", default=GAZETTEER_PATH)
+    args = parser.parse_args()
+    count = build_gazetteer(list(read_geonames_dump(args.dump)), args.out)
+    print(f"Wrote {count} cities to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Local partitioned store of historical station readings (the schema of OBSERVATION_DTYPE).
+
+Layout: one directory per station and year, `<root>/<station-slug>/<YYYY>/`, holding
+a compacted `data.parquet` sorted by station then timestamp. Writers only ever add `part-*.parquet`
+files, so any number of them can append to the same partition in parallel. `compact`
+then merges a partition's parts into `data.parquet`, dropping duplicate
+(station, timestamp) rows (the most recently written one wins). Compaction holds a
+per-partition lock file, so concurrent compactors take turns, and it streams the data
+file through in row-group batches, so memory depends on the new parts, not the partition.
+Readers only see
+compacted files, so an interrupted import never shows half its rows; re-running it or
+`compact_all` finishes the job.
+"""
+import fcntl
+import itertools
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from utils.preprocess import FEATURE_COLUMNS
+
+HISTORY_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "data", "history")
+DATA_FILE = "data.parquet"
+PART_PREFIX = "part-"
+LOCK_FILE = ".compact.lock"
+COMPACT_BATCH_ROWS = 65_536
+
+STORE_SCHEMA = pa.schema(
+    [pa.field("station", pa.string(), nullable=False), pa.field("timestamp", pa.timestamp("s"), nullable=False)]
+    + [pa.field(column, pa.float64()) for column in FEATURE_COLUMNS]
+)
+
+_sequence = itertools.count()
+
+def partition_slug(station):
+    """Filesystem-safe directory name for a station. Distinct stations may share one; rows keep their real name."""
+    slug = re.sub(r"[^a-z0-9.-]+", "-", station.lower()).strip("-.")
+    return slug or "unknown"
+
+def next_sequence():
+    """
+    Increasing token naming part files, so compaction can tell which duplicate came last.
+    Take it when a batch is produced, not when a writer thread gets round to it.
+    """
+    return f"{time.time_ns():020d}-{next(_sequence):08d}"
+
+def station_codes_of(table):
+    """Returns (station names, per-row integer code) using a hash encode, much cheaper than sorting strings."""
+    encoded = pc.dictionary_encode(table["station"]).combine_chunks()
+    return encoded.dictionary.to_numpy(zero_copy_only=False), encoded.indices.to_numpy().astype(np.int64)
+
+def dedupe_latest(table):
+    """
+    Drops duplicate (station, timestamp) rows, keeping the last occurrence, and returns the
+    rows sorted by station (by name) then timestamp.
+    """
+    if table.num_rows == 0:
+        return table
+    order = np.arange(table.num_rows)
+    timestamps = table["timestamp"].cast(pa.int64()).to_numpy()
+    stations, codes = station_codes_of(table)
+    station_codes = np.argsort(np.argsort(stations))[codes] # Hash codes -> rank of the name
+    # Within each (station, timestamp) run the latest row sorts first
+    sorted_idx = np.lexsort((-order, timestamps, station_codes))
+    keys = np.stack([station_codes[sorted_idx], timestamps[sorted_idx]])
+    first = np.ones(len(sorted_idx), dtype=bool)
+    first[1:] = np.any(keys[:, 1:] != keys[:, :-1], axis=0)
+    return table.take(pa.array(sorted_idx[first]))
+
+class HistoryStore:
+    """The partitioned history store rooted at `root`."""
+
+    def __init__(self, root=HISTORY_DIR):
+        self.root = root
+
+    def partition_dir(self, station_slug, year):
+        return os.path.join(self.root, station_slug, year)
+
+    def write(self, table, sequence=None):
+        """
+        Appends a STORE_SCHEMA table as one new part file per (station, year) it touches.
+        Returns the partition directories written. Safe to call from several threads or processes;
+        rows from a write with a later `sequence` win over earlier ones.
+        """
+        if table.num_rows == 0:
+            return []
+        sequence = sequence or next_sequence()
+        # Group on integer (station, year) codes rather than per-row strings
+        stations, station_codes = station_codes_of(table)
+        years = table["timestamp"].to_numpy().astype("datetime64[Y]")
+        year_codes = years.astype(np.int64)
+        keys, inverse = np.unique(station_codes * (1 << 32) + (year_codes - year_codes.min()), return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(keys) + 1))
+        # One gather into partition order; each partition is then a zero-copy slice
+        grouped = table.take(pa.array(order))
+
+        written = []
+        for i in range(len(keys)):
+            first = order[bounds[i]]
+            out_dir = self.partition_dir(partition_slug(stations[station_codes[first]]), str(years[first]))
+            os.makedirs(out_dir, exist_ok=True)
+            pq.write_table(grouped.slice(bounds[i], bounds[i + 1] - bounds[i]), os.path.join(out_dir, f"{PART_PREFIX}{sequence}-{uuid.uuid4().hex[:8]}.parquet"))
+            written.append(out_dir)
+        return written
+
+    def compact(self, partition_dir):
+        """
+        Merges a partition's part files into its data file, de-duplicating on (station, timestamp).
+        Returns (rows_before, rows_after) for the rows involved. Concurrent calls on the same
+        partition wait for each other; the later one finds nothing left to merge.
+        """
+        with open(os.path.join(partition_dir, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX) # Released when the file is closed
+            parts = sorted(f for f in os.listdir(partition_dir) if f.startswith(PART_PREFIX) and f.endswith(".parquet"))
+            if not parts:
+                return 0, 0
+            new = dedupe_latest(pa.concat_tables(
+                [pq.read_table(os.path.join(partition_dir, f), schema=STORE_SCHEMA) for f in parts]))
+            data_path = os.path.join(partition_dir, DATA_FILE)
+            tmp_path = os.path.join(partition_dir, f".{DATA_FILE}.{uuid.uuid4().hex[:8]}.tmp")
+            try:
+                rows_before, rows_after = self._merge_into(data_path, new, tmp_path)
+                os.replace(tmp_path, data_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            # Parts removed only after the merged file is in place; a crash in between just re-merges them
+            for f in parts:
+                os.remove(os.path.join(partition_dir, f))
+            return rows_before, rows_after
+
+    @staticmethod
+    def _merge_into(data_path, new, out_path):
+        """
+        Writes the sorted data file merged with `new` (deduplicated and sorted, winning over
+        the data file) to out_path, one data batch at a time. Returns (rows_before, rows_after).
+        """
+        rows_before, rows_after = new.num_rows, 0
+        with pq.ParquetWriter(out_path, STORE_SCHEMA) as writer:
+            if os.path.exists(data_path):
+                for batch in pq.ParquetFile(data_path).iter_batches(batch_size=COMPACT_BATCH_ROWS):
+                    if batch.num_rows == 0:
+                        continue
+                    rows_before += batch.num_rows
+                    # New rows sorting at or before this batch's last key belong to it
+                    last_station, last_timestamp = batch["station"][-1], batch["timestamp"][-1]
+                    due = pc.or_(pc.less(new["station"], last_station),
+                                 pc.and_(pc.equal(new["station"], last_station), pc.less_equal(new["timestamp"], last_timestamp)))
+                    n_due = pc.sum(due).as_py() or 0
+                    merged = dedupe_latest(pa.concat_tables([pa.Table.from_batches([batch]).cast(STORE_SCHEMA), new.slice(0, n_due)]))
+                    new = new.slice(n_due)
+                    writer.write_table(merged)
+                    rows_after += merged.num_rows
+            if new.num_rows:
+                writer.write_table(new)
+                rows_after += new.num_rows
+        return rows_before, rows_after
+
+    def compact_all(self, partition_dirs=None, workers=4):
+        """Compacts the given (default: all pending) partitions in parallel; returns (rows_before, rows_after)."""
+        partition_dirs = self.pending_partitions() if partition_dirs is None else sorted(set(partition_dirs))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(self.compact, partition_dirs))
+        return sum(r[0] for r in results), sum(r[1] for r in results)
+
+    def partitions(self):
+        """All partition directories, as (station_slug, year, path)."""
+        if not os.path.isdir(self.root):
+            return []
+        return [
+            (slug, year, os.path.join(self.root, slug, year))
+            for slug in sorted(os.listdir(self.root)) if os.path.isdir(os.path.join(self.root, slug))
+            for year in sorted(os.listdir(os.path.join(self.root, slug)))
+        ]
+
+    def pending_partitions(self):
+        """Partitions with part files waiting to be compacted."""
+        return [path for _, _, path in self.partitions() if any(f.startswith(PART_PREFIX) for f in os.listdir(path))]
+
+    def data_files(self, stations=None):
+        slugs = None if stations is None else {partition_slug(s) for s in stations}
+        return [
+            os.path.join(path, DATA_FILE) for slug, _, path in self.partitions()
+            if (slugs is None or slug in slugs) and os.path.exists(os.path.join(path, DATA_FILE))
+        ]
+
+    def latest_timestamp(self, stations=None):
+        """
+        Newest compacted reading as a numpy datetime64[s] (None for an empty store), read from
+        the Parquet footer statistics of each station's latest year, so no data pages are scanned.
+        """
+        slugs = None if stations is None else {partition_slug(s) for s in stations}
+        latest_year = {}
+        for slug, _, path in self.partitions():  # Sorted by slug, then year
+            if (slugs is None or slug in slugs) and os.path.exists(os.path.join(path, DATA_FILE)):
+                latest_year[slug] = os.path.join(path, DATA_FILE)
+        latest = None
+        for path in latest_year.values():
+            metadata = pq.ParquetFile(path).metadata
+            column = metadata.schema.to_arrow_schema().get_field_index("timestamp")
+            for i in range(metadata.num_row_groups):
+                statistics = metadata.row_group(i).column(column).statistics
+                if statistics is not None and statistics.has_min_max:
+                    value = np.datetime64(statistics.max, "s")
+                    latest = value if latest is None else max(latest, value)
+        return latest
+
+    def dataset(self, stations=None):
+        """A pyarrow dataset over the compacted data (optionally just some stations' partitions)."""
+        return ds.dataset(self.data_files(stations), schema=STORE_SCHEMA, format="parquet")
+
+    def filter_expression(self, stations=None, start=None, end=None):
+        expression = None
+        conditions = []
+        if stations is not None:
+            conditions.append(ds.field("station").isin(list(stations)))
+        if start is not None:
+            conditions.append(ds.field("timestamp") >= pa.scalar(np.datetime64(start, "s")))
+        if end is not None:
+            conditions.append(ds.field("timestamp") < pa.scalar(np.datetime64(end, "s")))
+        for condition in conditions:
+            expression = condition if expression is None else expression & condition
+        return expression
+
+    def read(self, stations=None, start=None, end=None, columns=None):
+        """Reads readings (end exclusive) into an Arrow table sorted by station and timestamp."""
+        table = self.dataset(stations).to_table(columns=columns, filter=self.filter_expression(stations, start, end))
+        sort_keys = [(c, "ascending") for c in ("station", "timestamp") if c in table.column_names]
+        return table.sort_by(sort_keys) if sort_keys else table
@@ -0,0 +1,332 @@
+"""
+Host-wide model bundle shared by every app worker process.
+
+Instead of each Streamlit process joblib-loading its own copy of the forests and scalers,
+the first process on a host publishes the flattened forest node arrays and scaler
+parameters as .npy files under BUNDLE_ROOT (on /dev/shm when available), and every
+process memory-maps them read-only. The OS page cache holds one copy of the arrays no
+matter how many workers attach.
+
+Bundles are immutable and named by a hash of the model and scaler files, so retraining
+publishes a new directory next to the old one. Publishing writes to a private temporary
+directory and renames it into place, so concurrent workers never see a half-written
+bundle. Files rather than multiprocessing.shared_memory segments are used on purpose:
+a segment is unlinked by Python's resource tracker when the process that created it
+exits, while a file lives until `cleanup_bundles` removes it, and removing a file that
+other workers still map is safe (their mappings stay valid until they exit).
+
+Every process holds a shared flock on its bundle's `.attached` file while it uses the
+bundle, taken before the bundle is renamed into place (or, for an existing bundle, before
+it is used). After attaching to a new version, `load_shared_models` removes superseded
+bundles whose lock nobody holds any more, so model updates do not fill /dev/shm. Cleanup
+takes the exclusive lock and moves a bundle out of the way before deleting it, so a process
+either holds a bundle that stays or finds it gone and publishes it again.
+
+The root is a predictable path on a shared filesystem, so it must be a private (0700)
+directory owned by the current user: another local user could otherwise plant a bundle.
+Non-tree models and scalers are loaded from the model directory, never from a path named
+in the manifest.
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import time
+
+import joblib
+import numpy as np
+
+from utils.forest_intervals import NODE_ARRAYS, flatten_forest, FlatForest
+from utils.model_metadata import MODEL_DIR, model_path, scaler_path, file_version
+
+FORECAST_HORIZONS = (1, 3, 6, 12)
+BUNDLE_FORMAT = 1
+MANIFEST_NAME = "manifest.json"
+ATTACHED_NAME = ".attached"
+# Unfinished temporary directories older than this are assumed to belong to a crashed publisher
+STALE_TMP_SECONDS = 3600
+
+def default_bundle_root():
+    base = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+    return os.getenv("CLEANAIR_BUNDLE_DIR", os.path.join(base, "cleanair-model-bundles"))
+
+BUNDLE_ROOT = default_bundle_root()
+
+logger = logging.getLogger(__name__)
+# Bundle directory -> open ATTACHED_NAME file this process holds a shared lock on
+_attached = {}
+
+def secure_root(root):
+    """
+    Creates root as a private directory, or checks that an existing one is a real directory
+    owned by this user that nobody else can write to or read. Raises PermissionError otherwise.
+    """
+    os.makedirs(root, mode=0o700, exist_ok=True)
+    info = os.lstat(root)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise PermissionError(f"Model bundle root {root} is not a directory owned by this user; refusing to use it.")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        os.chmod(root, 0o700) # Created by an older version with the default mode
+    return root
+
+class SharedScaler:
+    """StandardScaler parameters backed by shared arrays; scale_features applies it like the original."""
+
+    def __init__(self, mean, scale, with_mean=True, with_std=True):
+        self.mean_ = mean
+        self.scale_ = scale
+        self.with_mean = with_mean
+        self.with_std = with_std
+
+    def transform(self, X):
+        X = np.array(X, dtype=np.float64)
+        if self.with_mean:
+            X -= self.mean_
+        if self.with_std:
+            X /= self.scale_
+        return X
+
+def bundle_version(horizons=FORECAST_HORIZONS, model_dir=MODEL_DIR):
+    """Hash of every model and scaler file (and the bundle layout), naming the bundle directory."""
+    digest = hashlib.sha256(f"format={BUNDLE_FORMAT}".encode())
+    for horizon in horizons:
+        digest.update(f"{horizon}:{file_version(model_path(horizon, model_dir))}:{file_version(scaler_path(horizon, model_dir))}".encode())
+    return digest.hexdigest()[:16]
+
+def _write_horizon(horizon, out_dir, model_dir):
+    """Writes one horizon's arrays into out_dir and returns its manifest entry."""
+    model = joblib.load(model_path(horizon, model_dir))
+    scaler = joblib.load(scaler_path(horizon, model_dir))
+    entry = {}
+
+    flat = flatten_forest(model)
+    if flat is None:
+        # Not a tree ensemble: nothing to share, each worker loads the model itself
+        entry["model"] = {"kind": "joblib"}
+    else:
+        arrays = flat.to_arrays()
+        if flat.feature_importances_ is not None:
+            arrays["feature_importances"] = flat.feature_importances_
+        for name, array in arrays.items():
+            np.save(os.path.join(out_dir, f"forest_{horizon}h_{name}.npy"), np.ascontiguousarray(array))
+        entry["model"] = {"kind": "flat_forest", "max_depth": flat.max_depth, "n_features": flat.n_features,
+                          "arrays": list(arrays)}
+
+    if getattr(scaler, "with_mean", None) is not None and hasattr(scaler, "scale_"):
+        n_features = scaler.n_features_in_
+        mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+        scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+        np.save(os.path.join(out_dir, f"scaler_{horizon}h_mean.npy"), np.asarray(mean, dtype=np.float64))
+        np.save(os.path.join(out_dir, f"scaler_{horizon}h_scale.npy"), np.asarray(scale, dtype=np.float64))
+        entry["scaler"] = {"kind": "standard", "with_mean": bool(scaler.with_mean), "with_std": bool(scaler.with_std)}
+    else:
+        entry["scaler"] = {"kind": "joblib"}
+    return entry
+
+def publish_bundle(horizons=FORECAST_HORIZONS, model_dir=MODEL_DIR, root=None):
+    """
+    Makes sure the bundle for the current artifacts exists under root and returns its
+    directory. Only the first caller on a host does the work; racing callers each build
+    a private copy and all but one discard theirs.
+    """
+    root = secure_root(root or BUNDLE_ROOT)
+    version = bundle_version(horizons, model_dir)
+    bundle_dir = os.path.join(root, version)
+    if _hold(bundle_dir):
+        return bundle_dir
+
+    tmp_dir = tempfile.mkdtemp(prefix=f".tmp-{version}-", dir=root)
+    try:
+        manifest = {
+            "format": BUNDLE_FORMAT,
+            "version": version,
+            "created": time.time(),
+            "horizons": {str(h): _write_horizon(h, tmp_dir, model_dir) for h in horizons},
+        }
+        with open(os.path.join(tmp_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        open(os.path.join(tmp_dir, ATTACHED_NAME), "w").close()
+        for name in os.listdir(tmp_dir):
+            os.chmod(os.path.join(tmp_dir, name), 0o444)
+        os.chmod(tmp_dir, 0o755)
+        lock = open(os.path.join(tmp_dir, ATTACHED_NAME), "rb")
+        fcntl.flock(lock, fcntl.LOCK_SH) # Held from the moment the bundle appears, so cleanup never removes it
+        try:
+            os.rename(tmp_dir, bundle_dir) # Atomic: the bundle appears complete or not at all
+        except OSError:
+            lock.close()
+            # Another process published the same version first
+            if not _hold(bundle_dir):
+                raise
+        else:
+            _attached[os.path.abspath(bundle_dir)] = lock
+            logger.info("Published model bundle %s", bundle_dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    return bundle_dir
+
+def attach_bundle(bundle_dir, model_dir=MODEL_DIR):
+    """
+    Maps a published bundle read-only. Returns (models, scalers) keyed by horizon, where
+    tree ensembles are FlatForests over the shared arrays and scalers are SharedScalers.
+    Anything else is joblib-loaded from model_dir.
+    """
+    secure_root(os.path.dirname(os.path.abspath(bundle_dir)))
+    with open(os.path.join(bundle_dir, MANIFEST_NAME), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise ValueError(f"Unsupported model bundle format in {bundle_dir}")
+    if not _hold(bundle_dir):
+        raise FileNotFoundError(f"Model bundle {bundle_dir} was removed while attaching")
+
+    def mapped(name):
+        return np.load(os.path.join(bundle_dir, f"{name}.npy"), mmap_mode="r")
+
+    models, scalers = {}, {}
+    for key, entry in manifest["horizons"].items():
+        horizon = int(key)
+        model_entry = entry["model"]
+        if model_entry["kind"] == "flat_forest":
+            arrays = {name: mapped(f"forest_{horizon}h_{name}") for name in model_entry["arrays"]}
+            models[horizon] = FlatForest.from_arrays(
+                {name: arrays[name] for name in NODE_ARRAYS}, model_entry["max_depth"], model_entry["n_features"],
+                arrays.get("feature_importances"))
+        else:
+            models[horizon] = joblib.load(model_path(horizon, model_dir))
+
+        scaler_entry = entry["scaler"]
+        if scaler_entry["kind"] == "standard":
+            scalers[horizon] = SharedScaler(mapped(f"scaler_{horizon}h_mean"), mapped(f"scaler_{horizon}h_scale"),
+                                            scaler_entry["with_mean"], scaler_entry["with_std"])
+        else:
+            scalers[horizon] = joblib.load(scaler_path(horizon, model_dir))
+    return models, scalers
+
+def _hold(bundle_dir):
+    """
+    Marks the bundle as in use by this process until `_release`. Returns whether the bundle
+    is published and now held (bundles without a lock file only need to exist).
+    """
+    bundle_dir = os.path.abspath(bundle_dir)
+    if bundle_dir in _attached:
+        return True
+    lock_path = os.path.join(bundle_dir, ATTACHED_NAME)
+    try:
+        lock = open(lock_path, "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        return os.path.exists(os.path.join(bundle_dir, MANIFEST_NAME))
+    fcntl.flock(lock, fcntl.LOCK_SH)
+    try:
+        # Cleanup may have moved the bundle away while we waited for the lock
+        held = os.path.samestat(os.fstat(lock.fileno()), os.stat(lock_path))
+    except FileNotFoundError:
+        held = False
+    if not held:
+        lock.close()
+        return False
+    _attached[bundle_dir] = lock
+    return True
+
+def _release(keep=()):
+    """Drops this process's hold on every attached bundle except those in keep."""
+    keep = {os.path.abspath(d) for d in keep}
+    for bundle_dir in [d for d in _attached if d not in keep]:
+        _attached.pop(bundle_dir).close() # Closing the file releases the lock
+
+def load_shared_models(horizons=FORECAST_HORIZONS, model_dir=MODEL_DIR, root=None):
+    """
+    Publishes the bundle if needed and attaches to it: the one call serving processes make.
+    Bundles this process used before are released, and superseded ones nobody uses are removed.
+    """
+    bundle_dir = publish_bundle(horizons, model_dir, root)
+    models, scalers = attach_bundle(bundle_dir, model_dir)
+    _release(keep=(bundle_dir,))
+    cleanup_bundles(keep=(os.path.basename(bundle_dir),), root=os.path.dirname(bundle_dir))
+    return models, scalers
+
+def _remove_unused(path):
+    """
+    Deletes the bundle at path unless some process holds it; returns whether it did. The
+    exclusive lock is kept while the bundle is moved aside, so nobody can take it meanwhile.
+    A bundle without a lock file counts as unused.
+    """
+    try:
+        lock = open(os.path.join(path, ATTACHED_NAME), "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        lock = None
+    try:
+        if lock is not None:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        doomed = tempfile.mkdtemp(prefix=f".tmp-removing-{os.path.basename(path)}-", dir=os.path.dirname(path))
+        try:
+            os.rename(path, os.path.join(doomed, "bundle"))
+        except FileNotFoundError: # Removed by a concurrent cleanup
+            os.rmdir(doomed)
+            return False
+    finally:
+        if lock is not None:
+            lock.close()
+    shutil.rmtree(doomed, ignore_errors=True)
+    return True
+
+def cleanup_bundles(keep=(), root=None, stale_tmp_seconds=STALE_TMP_SECONDS):
+    """
+    Removes bundles other than the versions in keep that no process is attached to, plus
+    temporary directories left by crashed publishers. New workers publish or attach to the
+    current version. Returns the removed directory names.
+    """
+    root = root or BUNDLE_ROOT
+    if not os.path.isdir(root):
+        return []
+    removed = []
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if name.startswith(".tmp-"):
+            try:
+                if now - os.path.getmtime(path) < stale_tmp_seconds:
+                    continue # Possibly still being written
+            except FileNotFoundError:
+                continue # Finished or removed meanwhile
+            shutil.rmtree(path, ignore_errors=True)
+        elif name in keep:
+            continue
+        elif not _remove_unused(path):
+            if os.path.exists(path):
+                logger.info("Keeping superseded model bundle %s: still attached", name)
+            continue
+        logger.info("Removed model bundle %s", name)
+        removed.append(name)
+    return removed
+
+def main():
+    parser = argparse.ArgumentParser(description="Publish or clean up the host-wide shared model bundle.")
+    parser.add_argument("command", choices=["publish", "cleanup", "info"])
+    parser.add_argument("--model-dir", default=MODEL_DIR)
+    parser.add_argument("--root", default=BUNDLE_ROOT)
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        print(publish_bundle(model_dir=args.model_dir, root=args.root))
+    elif args.command == "cleanup":
+        current = bundle_version(model_dir=args.model_dir)
+        for name in cleanup_bundles(keep=(current,), root=args.root):
+            print(f"Removed {name}")
+    else:
+        print(f"Bundle root: {args.root}")
+        print(f"Current version: {bundle_version(model_dir=args.model_dir)}")
+        if os.path.isdir(args.root):
+            for name in sorted(os.listdir(args.root)):
+                print(f"  {name}")
+
+if __name__ == "__main__":
+    main()
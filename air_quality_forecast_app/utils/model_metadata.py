@@ -0,0 +1,41 @@
+import hashlib
+import json
+import os
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), "model")
+
+def model_path(horizon, model_dir=MODEL_DIR):
+    return os.path.join(model_dir, f"air_quality_model_{horizon}h.joblib")
+
+def scaler_path(horizon, model_dir=MODEL_DIR):
+    return os.path.join(model_dir, f"data_scaler_{horizon}h.joblib")
+
+def metadata_path(horizon, model_dir=MODEL_DIR):
+    return os.path.join(model_dir, f"model_metadata_{horizon}h.json")
+
+def file_version(path):
+    """Short content hash of an artifact, used as its model version."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+def save_metadata(horizon, metadata, model_dir=MODEL_DIR):
+    with open(metadata_path(horizon, model_dir), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+
+def load_metadata(horizon, model_dir=MODEL_DIR):
+    """
+    Loads the metadata stored next to a horizon's model. If there is none (or it
+    describes an older artifact), returns a minimal record keyed by the file version.
+    """
+    version = file_version(model_path(horizon, model_dir))
+    try:
+        with open(metadata_path(horizon, model_dir), encoding="utf-8") as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        metadata = {}
+    if metadata.get("model_version") != version:
+        metadata = {"model_version": version}
+    return metadata
@@ -0,0 +1,96 @@
+"""
+Compact observation records passed between fetching, the feature engine and the components.
+
+A single reading is an `Observation` (a __slots__ record); many readings are a contiguous
+NumPy structured array of OBSERVATION_DTYPE. DataFrames are only built at the charting edge
+via `to_frame` / `batch_to_frame`.
+"""
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from utils.preprocess import FEATURE_COLUMNS
+
+STATION_WIDTH = 32
+OBSERVATION_DTYPE = np.dtype(
+    [('station', f'U{STATION_WIDTH}'), ('timestamp', 'datetime64[s]')]
+    + [(column, 'f8') for column in FEATURE_COLUMNS]
+)
+
+# WAQI iaqi keys for each measurement
+WAQI_FIELDS = {'pm25': 'pm25', 'temperature': 't', 'humidity': 'h', 'wind_speed': 'w', 'pressure': 'p'}
+
+def _value(v):
+    return np.nan if v is None else float(v)
+
+def utc_now():
+    return np.datetime64(datetime.now(timezone.utc).replace(tzinfo=None), 's')
+
+def waqi_timestamp(time_block):
+    """
+    Measurement time of a WAQI feed's `time` block as UTC datetime64[s], or None if it has none.
+    `iso` (or `s` plus `tz`) carries the station's UTC offset; `v` is local wall-clock time.
+    """
+    if not time_block:
+        return None
+    text = time_block.get("iso") or (f"{time_block['s']}{time_block['tz']}" if time_block.get("s") and time_block.get("tz") else None)
+    if text is None:
+        return None
+    timestamp = pd.Timestamp(text)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert("UTC").tz_localize(None)
+    return np.datetime64(timestamp.to_datetime64(), 's')
+
+class Observation:
+    """One station reading, timestamped in UTC (now, if not given). Missing measurements are NaN."""
+
+    __slots__ = ('station', 'timestamp') + tuple(FEATURE_COLUMNS)
+
+    def __init__(self, station='', timestamp=None, pm25=None, temperature=None, humidity=None, wind_speed=None, pressure=None):
+        self.station = station
+        self.timestamp = utc_now() if timestamp is None else np.datetime64(timestamp, 's')
+        self.pm25 = _value(pm25)
+        self.temperature = _value(temperature)
+        self.humidity = _value(humidity)
+        self.wind_speed = _value(wind_speed)
+        self.pressure = _value(pressure)
+
+    @classmethod
+    def from_waqi(cls, station, iaqi, timestamp=None):
+        """Builds an observation from a WAQI feed's `iaqi` block, handling missing parameters."""
+        return cls(station, timestamp, **{
+            field: iaqi[key]['v'] if key in iaqi else None for field, key in WAQI_FIELDS.items()
+        })
+
+    @classmethod
+    def from_record(cls, record):
+        """Builds an observation from one element of an OBSERVATION_DTYPE array."""
+        return cls(str(record['station']), record['timestamp'], *(record[c] for c in FEATURE_COLUMNS))
+
+    def measurements(self):
+        """Returns {column: value} for the measured quantities."""
+        return {column: getattr(self, column) for column in FEATURE_COLUMNS}
+
+    def to_record(self):
+        return (self.station, self.timestamp) + tuple(getattr(self, column) for column in FEATURE_COLUMNS)
+
+    def to_frame(self):
+        """One-row DataFrame for display (same columns get_realtime_data used to return)."""
+        return pd.DataFrame({**{column: [value] for column, value in self.measurements().items()},
+                             'timestamp': [pd.Timestamp(self.timestamp)]})
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"Observation({fields})"
+
+def observations_to_array(observations):
+    """Packs observations into one contiguous structured array."""
+    return np.array([o.to_record() for o in observations], dtype=OBSERVATION_DTYPE)
+
+def empty_batch(n=0):
+    return np.zeros(n, dtype=OBSERVATION_DTYPE)
+
+def batch_to_frame(batch):
+    """Converts a structured batch to a DataFrame, at the charting edge only."""
+    return pd.DataFrame({name: batch[name] for name in OBSERVATION_DTYPE.names})
@@ -1,13 +1,16 @@
 import pandas as pd
 import numpy as np
 
+# Model input columns, in the order the scalers and models were fitted on
+FEATURE_COLUMNS = ['pm25', 'temperature', 'humidity', 'wind_speed', 'pressure']
+
 def preprocess_data(df):
     # In a real application, this function would perform more complex preprocessing steps
     # such as handling missing values, feature engineering, and scaling.
     # For now, we assume the raw data is in a suitable format for the scaler.
     
     # Ensure all expected columns are present, fill with NaN if not
-    expected_columns = ['pm25', 'temperature', 'humidity', 'wind_speed', 'pressure']
+    expected_columns = FEATURE_COLUMNS
     for col in expected_columns:
         if col not in df.columns:
             df[col] = np.nan
@@ -19,4 +22,32 @@ def preprocess_data(df):
     # For simplicity, we'll fill with 0 for now. In a real scenario, more robust imputation is needed.
     processed_df = processed_df.fillna(0)
 
-    return processed_df
\ No newline at end of file
+    return processed_df
+
+def feature_matrix(observations):
+    """
+    Builds the model input matrix straight from observation records, without a DataFrame.
+    Accepts a single Observation, a list of them, or an OBSERVATION_DTYPE structured array.
+    Missing values are filled with 0, as in preprocess_data.
+    """
+    if getattr(observations, 'dtype', None) is not None and observations.dtype.names:
+        X = np.column_stack([observations[column].astype(np.float64) for column in FEATURE_COLUMNS])
+    elif hasattr(observations, 'measurements'):
+        X = np.array([[getattr(observations, column) for column in FEATURE_COLUMNS]], dtype=np.float64)
+    else:
+        X = np.array([[getattr(o, column) for column in FEATURE_COLUMNS] for o in observations], dtype=np.float64).reshape(-1, len(FEATURE_COLUMNS))
+    return np.nan_to_num(X, nan=0.0)
+
+def scale_features(scaler, X):
+    """
+    Applies a fitted scaler to a feature matrix. StandardScaler is applied directly
+    (the same arithmetic as its transform) to skip sklearn's per-call validation.
+    """
+    if getattr(scaler, 'with_mean', None) is not None and hasattr(scaler, 'scale_'):
+        X = np.array(X, dtype=np.float64)
+        if scaler.with_mean:
+            X -= scaler.mean_
+        if scaler.with_std:
+            X /= scaler.scale_
+        return X
+    return scaler.transform(X)
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+EARTH_RADIUS_KM = 6371.0088
+
+def to_unit_vectors(lats, lons):
+    """Converts lat/lon degrees to 3D unit vectors so a Euclidean KD-tree orders points by great-circle distance."""
+    lat = np.radians(np.asarray(lats, dtype=np.float64))
+    lon = np.radians(np.asarray(lons, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+def chord_to_km(chord):
+    """Converts a unit-sphere chord length to a great-circle (haversine) distance in km."""
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.clip(np.asarray(chord) / 2.0, 0.0, 1.0))
+
+def km_to_chord(distance_km):
+    """Inverse of chord_to_km."""
+    return 2.0 * np.sin(np.minimum(np.asarray(distance_km) / EARTH_RADIUS_KM, np.pi) / 2.0)
+
+class StationIndex:
+    """
+    Spatial index over monitoring stations for nearest-station lookups and
+    inverse-distance-weighted (IDW) interpolation of PM2.5 between stations.
+    """
+
+    def __init__(self, names, lats, lons, values=None):
+        self.names = np.asarray(names)
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.values = None if values is None else np.asarray(values, dtype=np.float64)
+        self._tree = cKDTree(to_unit_vectors(self.lats, self.lons))
+
+    @classmethod
+    def from_dataframe(cls, df, name_col='City', lat_col='Latitude', lon_col='Longitude', value_col='PM2.5'):
+        """Builds an index from a map-style DataFrame (the same columns display_map uses)."""
+        values = df[value_col].to_numpy(dtype=np.float64) if value_col in df.columns else None
+        return cls(df[name_col].to_numpy(), df[lat_col].to_numpy(), df[lon_col].to_numpy(), values)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def nearest(self, lat, lon, k=1):
+        """
+        Returns (distances_km, indices) of the k nearest stations for one or many query points.
+        For a scalar query with k=1 both results are scalars.
+        """
+        k = min(k, len(self))
+        chord, idx = self._tree.query(to_unit_vectors(np.atleast_1d(lat), np.atleast_1d(lon)), k=k)
+        distances = chord_to_km(chord)
+        if np.ndim(lat) == 0:
+            return distances[0], idx[0]
+        return distances, idx
+
+    def within_radius(self, lat, lon, radius_km):
+        """Returns (distances_km, indices) of every station within radius_km of a point, nearest first."""
+        query = to_unit_vectors([lat], [lon])[0]
+        idx = np.asarray(self._tree.query_ball_point(query, km_to_chord(radius_km)), dtype=np.intp)
+        distances = chord_to_km(np.linalg.norm(self._tree.data[idx] - query, axis=1))
+        order = np.argsort(distances)
+        return distances[order], idx[order]
+
+    def nearest_station(self, lat, lon):
+        """Returns the name and distance (km) of the station nearest to a point."""
+        distance, idx = self.nearest(lat, lon, k=1)
+        return self.names[idx], float(distance)
+
+    def idw_surface(self, bounds=None, resolution=200, power=2.0, k=12, values=None, padding=0.1):
+        """
+        Interpolates station values onto a regular lat/lon grid with inverse distance weighting.
+
+        bounds is (lat_min, lat_max, lon_min, lon_max); by default the station bounding box
+        padded by `padding` of its extent. Only the k nearest stations contribute to each
+        cell, which keeps the cost at O(cells * k) regardless of the number of stations.
+        Returns (grid_lats, grid_lons, surface), each of shape (resolution, resolution).
+        """
+        values = self.values if values is None else np.asarray(values, dtype=np.float64)
+        if values is None:
+            raise ValueError("No station values to interpolate.")
+
+        if bounds is None:
+            lat_pad = max((self.lats.max() - self.lats.min()) * padding, 0.05)
+            lon_pad = max((self.lons.max() - self.lons.min()) * padding, 0.05)
+            bounds = (self.lats.min() - lat_pad, self.lats.max() + lat_pad,
+                      self.lons.min() - lon_pad, self.lons.max() + lon_pad)
+        lat_min, lat_max, lon_min, lon_max = bounds
+        grid_lats, grid_lons = np.meshgrid(
+            np.linspace(lat_min, lat_max, resolution),
+            np.linspace(lon_min, lon_max, resolution),
+            indexing='ij',
+        )
+
+        k = min(k, len(self))
+        chord, idx = self._tree.query(to_unit_vectors(grid_lats.ravel(), grid_lons.ravel()), k=k, workers=-1)
+        if k == 1:
+            chord, idx = chord[:, None], idx[:, None]
+
+        # Chord length is proportional to great-circle distance at these scales, and IDW weights are scale-free
+        with np.errstate(divide='ignore'):
+            weights = 1.0 / chord ** power
+        # A cell sitting exactly on a station takes that station's value
+        exact = np.isinf(weights)
+        if exact.any():
+            weights = np.where(exact.any(axis=1, keepdims=True), exact.astype(np.float64), weights)
+        surface = (weights * values[idx]).sum(axis=1) / weights.sum(axis=1)
+        return grid_lats, grid_lons, surface.reshape(grid_lats.shape)
+
+    def idw_surface_df(self, **kwargs):
+        """idw_surface flattened into a Latitude/Longitude/PM2.5 DataFrame for map density layers."""
+        grid_lats, grid_lons, surface = self.idw_surface(**kwargs)
+        return pd.DataFrame({
+            'Latitude': grid_lats.ravel(),
+            'Longitude': grid_lons.ravel(),
+            'PM2.5': surface.ravel(),
+        })
@@ -0,0 +1,143 @@
+"""
+Local record/replay stand-in for the WAQI /feed/{city}/ endpoint.
+
+Record real responses once (city names are resolved through the gazetteer):
+    python -m utils.waqi_stub record --dir recordings Delhi London Beijing
+
+Then replay them with injected latency and failures:
+    python -m utils.waqi_stub serve --dir recordings --latency-ms 150 --error-rate 0.05
+    WAQI_BASE_URL=http://127.0.0.1:8765 WAQI_API_TOKEN=replay python materialize_forecasts.py
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import requests
+
+from utils.data_fetching import feed_recording_path, fetch_feed, record_feed, recording_name
+from utils.gazetteer import Gazetteer
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+def load_recordings(record_dir):
+    """Loads every recorded feed in record_dir into a {city: response} dict."""
+    recordings = {}
+    for filename in os.listdir(record_dir):
+        if filename.endswith(".json"):
+            with open(os.path.join(record_dir, filename), encoding="utf-8") as f:
+                recordings[filename[:-len(".json")]] = json.load(f)
+    return recordings
+
+def make_handler(recordings, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=None):
+    """Builds a request handler class that replays recordings with the given fault profile."""
+    rng = random.Random(seed)
+    rng_lock = threading.Lock()
+
+    class WAQIReplayHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with rng_lock:
+                delay = max(0.0, latency_ms + rng.uniform(-jitter_ms, jitter_ms)) / 1000.0
+                fail = rng.random() < error_rate
+            if delay:
+                time.sleep(delay)
+
+            if fail:
+                self._send(503, {"status": "error", "data": "Injected failure"})
+                return
+
+            parts = [p for p in urlparse(self.path).path.split("/") if p]
+            if len(parts) != 2 or parts[0] != "feed":
+                self._send(404, {"status": "error", "data": "Unknown endpoint"})
+                return
+
+            city = recording_name(unquote(parts[1]))
+            if city in recordings:
+                self._send(200, recordings[city])
+            else:
+                # Mirrors the real API, which answers unknown cities with HTTP 200 and an error status
+                self._send(200, {"status": "error", "data": "Unknown station"})
+
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Keep load tests quiet
+
+    return WAQIReplayHandler
+
+def make_server(record_dir, host=DEFAULT_HOST, port=DEFAULT_PORT, latency_ms=0.0, jitter_ms=0.0, error_rate=0.0, seed=None):
+    """Creates (but does not start) a threaded replay server for the recordings in record_dir."""
+    handler = make_handler(load_recordings(record_dir), latency_ms, jitter_ms, error_rate, seed)
+    return ThreadingHTTPServer((host, port), handler)
+
+def serve_in_background(record_dir, **kwargs):
+    """Starts a replay server on a daemon thread and returns (server, base_url)."""
+    server = make_server(record_dir, **kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}"
+
+def record_cities(cities, record_dir):
+    """
+    Fetches each city from the real API and writes the responses to record_dir.
+    Names found in the gazetteer are recorded under the same geo: key the app requests.
+    """
+    gazetteer = Gazetteer.load()
+    for name in cities:
+        match = gazetteer.lookup(name)
+        city = match.waqi_key if match else name
+        try:
+            data = fetch_feed(city)
+        except requests.exceptions.RequestException as e:
+            print(f"Skipped {name}: {e}")
+            continue
+        if data and data.get("status") == "ok":
+            record_feed(city, data, record_dir)
+            print(f"Recorded {name} ({city}) -> {feed_recording_path(record_dir, city)}")
+        else:
+            print(f"Skipped {name}: {data.get('data', 'Unknown error') if data else 'empty response'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay WAQI /feed/ responses.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="Record real responses for the given cities.")
+    record_parser.add_argument("cities", nargs="+", help="City names or raw /feed/ keys.")
+    record_parser.add_argument("--dir", required=True, help="Directory to write recordings to.")
+
+    serve_parser = subparsers.add_parser("serve", help="Replay recorded responses over HTTP.")
+    serve_parser.add_argument("--dir", required=True, help="Directory holding recordings.")
+    serve_parser.add_argument("--host", default=DEFAULT_HOST)
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    serve_parser.add_argument("--latency-ms", type=float, default=0.0)
+    serve_parser.add_argument("--jitter-ms", type=float, default=0.0)
+    serve_parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with HTTP 503.")
+    serve_parser.add_argument("--seed", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "record":
+        record_cities(args.cities, args.dir)
+    else:
+        server = make_server(args.dir, args.host, args.port, args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+        print(f"Replaying {args.dir} on http://{args.host}:{args.port}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+if __name__ == "__main__":
+    main()